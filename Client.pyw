@@ -8,29 +8,45 @@ Nilusink
 from plyer import notification
 from core.client import *
 from tkinter import ttk
-from typing import Dict
+from typing import Deque, Dict
+from collections import deque
+from functools import lru_cache
+from bisect import bisect_right
 import tkinter as tk
 
 
+# number of the latest unread messages shown in a notification
+NOTIFY_MESSAGES: int = 5
+
+
+@lru_cache(maxsize=4096)
 def newline_parser(string: str, line_length: int, word_sensitive=False):
-    new_string = string
-    active = False
-    newlines = 1
-    correction = int()
-    for i in range(len(string)):
-        i += correction
-        if i % line_length == 0 and i != 0:
-            active = word_sensitive
-            if not word_sensitive:
-                new_string = new_string[:i]+'\n'+new_string[i:]
-                newlines += 1
-
-        if string[i] == ' ' and active:
-            new_string = new_string[:i]+'\n'+new_string[i:].lstrip(' ')
-            newlines += 1
-            active = False
-
-    return new_string, newlines
+    """
+    break a string into lines of line_length characters (cached, the same texts are wrapped again and again)
+
+    :param word_sensitive: only break at spaces (after line_length characters)
+    :return: the string with newlines, the number of lines
+    """
+    if not word_sensitive:
+        lines = [string[i:i + line_length] for i in range(0, len(string), line_length)] or [""]
+        return "\n".join(lines), len(lines)
+
+    lines = []
+    start = 0
+    while len(string) - start > line_length:
+        end = string.find(" ", start + line_length)
+        if end == -1:
+            break
+
+        lines.append(string[start:end])
+
+        # the next line doesn't start with spaces
+        start = end
+        while start < len(string) and string[start] == " ":
+            start += 1
+
+    lines.append(string[start:])
+    return "\n".join(lines), len(lines)
 
 
 class ChatBox:
@@ -63,8 +79,156 @@ class ChatBox:
         self.canvas.grid_forget()
 
 
+class MessageList:
+    """
+    shows the messages in a Listbox. Only a window of at most max_rows rows is in the Listbox, all messages are
+    kept in a list (as text once they were shown) and loaded into the Listbox when scrolling to the window edges.
+    The messages are sorted by id, history pages arrive newest first
+    """
+    max_rows: int = 1000
+    chunk: int = 200  # rows loaded at once when scrolling
+
+    def __init__(self, listbox: tk.Listbox, scrollbar: tk.Scrollbar) -> None:
+        self.__listbox = listbox
+        self.__scrollbar = scrollbar
+
+        # every message (oldest first) and their ids, the rows start:end are in the Listbox
+        self.__rows: list[str | dict] = []
+        self.__ids: list[int] = []
+        self.__start = 0
+        self.__end = 0
+        self.__loading = False
+
+        listbox.config(yscrollcommand=self.__on_scroll)
+        scrollbar.config(command=listbox.yview)
+
+    def __len__(self) -> int:
+        return len(self.__rows)
+
+    def __line(self, index: int) -> str:
+        """
+        the text of a row, messages are only formatted (and decrypted) when they are shown the first time
+        """
+        row = self.__rows[index]
+        if not isinstance(row, str):
+            row = self.__rows[index] = f"{row['user']}>> {row['message']}"
+
+        return row
+
+    def __lines(self, start: int, end: int) -> list[str]:
+        return [self.__line(index) for index in range(start, end)]
+
+    def extend(self, messages: list[dict]) -> None:
+        """
+        add new messages, shown (in one update) if the newest messages are visible
+        """
+        if not messages:
+            return
+
+        following = self.__end == len(self.__rows) and self.__listbox.yview()[1] >= 1.0
+        newest = self.__ids[-1] if self.__ids else -1
+        messages = sorted(messages, key=lambda message: message["id"])
+        for message in messages:
+            if message["id"] < newest:
+                self.__insert(message, following)
+
+        messages = [message for message in messages if message["id"] > newest]
+        if following:
+            self.__listbox.yview(tk.END)
+
+        self.__rows.extend(messages)
+        self.__ids.extend(message["id"] for message in messages)
+        if not messages or not following:
+            # the user is reading older messages, they are loaded when scrolling down
+            return
+
+        start = max(self.__end, len(self.__rows) - self.max_rows)
+        if start > self.__end:
+            # more new messages than rows, replace all of them
+            self.__listbox.delete(0, tk.END)
+            self.__start = start
+
+        self.__listbox.insert(tk.END, *self.__lines(start, len(self.__rows)))
+        self.__end = len(self.__rows)
+        self.__trim_top()
+        self.__listbox.yview(tk.END)
+
+    def __insert(self, message: dict, following: bool) -> None:
+        """
+        add a message older than the newest one (from a history page) at its place
+
+        :param following: if the newest messages are visible (they stay in the Listbox)
+        """
+        index = bisect_right(self.__ids, message["id"])
+        self.__rows.insert(index, message)
+        self.__ids.insert(index, message["id"])
+        if index > self.__end:
+            # below the rows in the Listbox, loaded when scrolling down
+            return
+
+        if index < self.__start or (index == self.__start and self.__end - self.__start >= self.max_rows):
+            # above the rows in the Listbox, loaded when scrolling up
+            self.__start += 1
+            self.__end += 1
+            return
+
+        self.__listbox.insert(index - self.__start, self.__line(index))
+        self.__end += 1
+        if following:
+            self.__trim_top()
+
+        else:
+            self.__trim_bottom()
+
+    def __trim_top(self) -> None:
+        extra = self.__end - self.__start - self.max_rows
+        if extra > 0:
+            self.__listbox.delete(0, extra - 1)
+            self.__start += extra
+
+    def __trim_bottom(self) -> None:
+        extra = self.__end - self.__start - self.max_rows
+        if extra > 0:
+            self.__listbox.delete(self.max_rows, tk.END)
+            self.__end -= extra
+
+    def __on_scroll(self, first: str, last: str) -> None:
+        self.__scrollbar.set(first, last)
+        at_top = float(first) <= 0 and self.__start > 0
+        at_bottom = float(last) >= 1 and self.__end < len(self.__rows)
+        if (at_top or at_bottom) and not self.__loading:
+            # not while tkinter is updating the view
+            self.__loading = True
+            self.__listbox.after_idle(self.__load_more)
+
+    def __load_more(self) -> None:
+        """
+        load the next chunk of rows at the edge the user scrolled to
+        """
+        self.__loading = False
+        first, last = self.__listbox.yview()
+        if first <= 0 and self.__start > 0:
+            start = max(self.__start - self.chunk, 0)
+            self.__listbox.insert(0, *self.__lines(start, self.__start))
+            added = self.__start - start
+            self.__start = start
+            self.__trim_bottom()
+
+            # keep the same message at the top
+            self.__listbox.yview(added)
+
+        elif last >= 1 and self.__end < len(self.__rows):
+            top = self.__listbox.nearest(0)
+            end = min(self.__end + self.chunk, len(self.__rows))
+            self.__listbox.insert(tk.END, *self.__lines(self.__end, end))
+            self.__end = end
+
+            start = self.__start
+            self.__trim_top()
+            self.__listbox.yview(top - (self.__start - start))
+
+
 class Window:
-    __done_messages: list = []
     __done_objects: list = []
     __connection: Connection
 
@@ -81,8 +245,10 @@ class Window:
         self.__server_secret = server_secret
         self.__client_secret = client_secret
 
-        # later used variables
-        self.__unread_messages: list[dict] = []
+        # later used variables, only the latest unread messages are kept (for the notification)
+        self.__unread_messages: Deque[dict] = deque(maxlen=NOTIFY_MESSAGES)
+        self.__unread_count = 0
+        self.__unread_users: set[str] = set()
 
         # GUI color config
         self.__colors: Dict[str, str] = {
@@ -135,7 +301,8 @@ class Window:
 
         self.scrollbar = tk.Scrollbar(self.main_frame)
 
-        self.messages_frame = tk.Listbox(self.main_frame, yscrollcommand=self.scrollbar.set)
+        self.messages_frame = tk.Listbox(self.main_frame)
+        self.messages = MessageList(self.messages_frame, self.scrollbar)
 
         self.root.bind("<MouseWheel>", self.scroll_chat)
 
@@ -160,7 +327,7 @@ class Window:
         return self.__colors
 
     @property
-    def unread_messages(self) -> list[dict]:
+    def unread_messages(self) -> Deque[dict]:
         return self.__unread_messages
 
     def color_config(self, color_type: str, color: str) -> str:
@@ -267,23 +434,18 @@ class Window:
 
     def __update_messages(self, *_tk_trash) -> None:
         """
-        check if there are new messages
+        check if there are new messages, all of them are added in one update
         """
-        updated_messages: list[dict] = []
-        for message in self.__connection.new_messages:
-            if message not in self.__done_messages:
-                updated_messages.append(message)
-                self.messages_frame.insert(tk.END, f"{message['user']}>> {message['message']}")
-                self.__done_messages.append(message)
-
+        updated_messages = list(self.__connection.new_messages)
         if updated_messages:
-            self.messages_frame.yview(tk.END)
+            self.messages.extend(updated_messages)
 
             # if the window is not focused, send a notification
             if not self.root.focus_get():
-                self.__unread_messages += updated_messages
-                users = {message["user"] for message in self.unread_messages}
-                title = f"{len(self.unread_messages)} unread message(s) from {len(users)} user(s)"
+                self.__unread_messages.extend(updated_messages)
+                self.__unread_count += len(updated_messages)
+                self.__unread_users.update(message["user"] for message in updated_messages)
+                title = f"{self.__unread_count} unread message(s) from {len(self.__unread_users)} user(s)"
                 notify = "\n".join(f"{message['user']}: {message['message']}" for message in self.unread_messages)
 
                 notification.notify(
@@ -294,8 +456,11 @@ class Window:
 
         if self.root.focus_get():
             self.unread_messages.clear()
+            self.__unread_count = 0
+            self.__unread_users.clear()
 
-        self.root.after(200, self.__update_messages)
+        # tkinter may only be used from the main thread, checking the (deduplicated) queue is cheap
+        self.root.after(20, self.__update_messages)
 
     def send_message(self, *_tk_trash) -> None:
         """
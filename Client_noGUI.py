@@ -10,13 +10,15 @@ from core.client import Connection
 from traceback import format_exc
 from core import InvalidSecret
 from threading import Thread
-from time import sleep
 import signal
 import json
 import os
 
 CONNECTED: bool = False
 
+# messages are printed as they arrive, older history pages couldn't be shown above the newer messages
+Connection.ordered_history = True
+
 
 class Colors:
     """
@@ -49,24 +51,27 @@ def success(success_msg: str) -> None:
 
 class MessageUpdater:
     def __init__(self, c: Connection, update_delay: float = 0.2) -> None:
+        """
+        :param update_delay: how often to check if the updater should stop
+        """
         self.__connection = c
         self.update_delay = update_delay
         self.running: bool = True
 
-        # later used variables
-        self.__done_messages: list = []
-
     def run(self) -> None:
         """
-        receive messages while self.running
+        print messages as they arrive while self.running
         """
+        throttle_count = 0
         while self.running:
-            for message in self.__connection.new_messages:
-                if message not in self.__done_messages:
-                    print(f"\r{message['user']}>> {message['message']}", end="\n>> ")
-                    self.__done_messages.append(message)
-
-            sleep(self.update_delay)
+            message = self.__connection.get_message(timeout=self.update_delay)
+            if message is not None:
+                print(f"\r{message['user']}>> {message['message']}", end="\n>> ")
+
+            if self.__connection.throttle_count != throttle_count:
+                throttle_count = self.__connection.throttle_count
+                retry_after = self.__connection.throttled["retry_after"]
+                print(f"\r{Colors.FAIL}sending too fast, message dropped (retry in {retry_after}s){Colors.ENDC}", end="\n>> ")
 
     def run_thread(self) -> None:
         """
@@ -6,13 +6,78 @@ handle client messages and requests
 Author:
 Nilusink
 """
-from core.server import Connection
+from core.async_server import AsyncConnection
+from core.selector_server import SelectorConnection
+from core.cluster import Cluster
+from core.server import Connection, MESSAGES, RUNNING_CLIENTS
+from core.metrics import StatsServer
+from core.tracing import TRACER, profile_to_file
+from core.storage import SegmentLog
+import core.server
 import signal
 import json
 import sys
 
-secret = json.load(open("config.json", "r"))["server_secret"]
-serv = Connection(port=3333, server_secret=secret)
+# available server engines, "thread": one thread per user, "asyncio": one event loop for all users,
+# "selector": one thread waiting for all sockets and a pool of threads processing the requests
+ENGINES = {
+    "thread": Connection,
+    "asyncio": AsyncConnection,
+    "selector": SelectorConnection,
+}
+
+config = json.load(open("config.json", "r"))
+secret = config["server_secret"]
+engine = ENGINES[config.get("engine", "thread")]
+
+# users allowed to request the server statistics
+core.server.ADMINS = tuple(config.get("admins", ()))
+
+# compression algorithms clients may choose with the highest level allowed for each (bz2 and lzma are opt-in)
+if "compression" in config:
+    core.server.COMPRESSION_LEVELS = dict(config["compression"])
+
+# optionally run multiple server processes ("workers": number of processes, 0 for one per CPU core)
+if "workers" in config:
+    serv = Cluster(3333, secret, engine, workers=config["workers"], room_key=config.get("room_key", False))
+    if "history" in config:
+        print("persistent history is not supported with multiple workers, ignoring \"history\"")
+
+else:
+    serv = engine(port=3333, server_secret=secret)
+
+# optionally encrypt broadcasts only once, with a key shared by all clients
+if config.get("room_key", False) and "workers" not in config:
+    RUNNING_CLIENTS.enable_room_key()
+
+# optionally keep the message history on disk
+if "history" in config and "workers" not in config:
+    retention_days = config["history"].get("retention_days")
+    MESSAGES.attach(SegmentLog(
+        config["history"]["directory"],
+        segment_size=config["history"].get("segment_size", 16 * 1024 * 1024),
+        max_bytes=config["history"].get("max_bytes"),
+        max_age=retention_days * 24 * 3600 if retention_days is not None else None
+    ))
+
+
+# optionally trace a fraction of the received frames and profile the server for some time after starting
+if ("trace" in config or "profile" in config) and "workers" in config:
+    print("tracing and profiling are not supported with multiple workers, ignoring \"trace\" and \"profile\"")
+
+else:
+    if "trace" in config:
+        TRACER.configure(config["trace"].get("rate", 0.01), config["trace"].get("buffer", 10_000))
+
+    if "profile" in config:
+        profile_to_file(
+            config["profile"].get("seconds", 30),
+            config["profile"].get("file", "profile.txt"),
+            config["profile"].get("interval", 0.005)
+        )
+
+# optionally serve the statistics as JSON on http://127.0.0.1:<stats_port>/stats (started below)
+stats = None
 
 
 def term_func(*sign) -> None:
@@ -21,6 +86,15 @@ def term_func(*sign) -> None:
     """
     print("shutting down server...")
     serv.end()
+    if stats is not None:
+        stats.end()
+
+    if "trace" in config and "file" in config["trace"] and "workers" not in config:
+        TRACER.dump(config["trace"]["file"])
+
+    if MESSAGES.log is not None:
+        MESSAGES.log.close()
+
     sys.exit(sign[0])
 
 
@@ -29,9 +103,21 @@ signals = [signal.SIGINT, signal.SIGTERM]
 for s in signals:
     signal.signal(s, term_func)
 
-# run server
+# run server, the cluster has to fork its processes before any thread is started
 try:
-    serv.receive_clients()
+    if "workers" in config:
+        serv.receive_clients(thread=True)
+
+    # with multiple workers the statistics of every process, collected over the bus
+    if "stats_port" in config:
+        stats = StatsServer(config["stats_port"], snapshot=serv.stats if "workers" in config else None)
+        stats.start()
+
+    if "workers" in config:
+        serv.join()
+
+    else:
+        serv.receive_clients()
 
 except KeyboardInterrupt:
     term_func()
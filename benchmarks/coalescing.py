@@ -0,0 +1,98 @@
+#! /usr/bin/python3
+"""
+coalescing.py
+Measure the broadcast latency (send -> received by another client) with write coalescing on and off
+
+usage: python benchmarks/coalescing.py [--engine thread|asyncio|selector] [--clients 20] [--messages 2000] [--delay 0.001]
+                                      [--burst 10] [--pause 0.01]
+
+Author:
+Nilusink
+"""
+from common import BenchClient, load_secret, start_server, percentile
+
+from typing import Dict, Any
+import argparse
+import struct
+import time
+
+
+def measure(
+        port: int,
+        secret: bytes,
+        engine: str,
+        clients: int,
+        messages: int,
+        burst: int,
+        pause: float,
+        delay: float
+) -> Dict[str, Any]:
+    """
+    run one server with the given COALESCE_DELAY and measure the latencies
+    """
+    server = start_server(port, secret, engine, COALESCE_DELAY=delay, USER_MESSAGE_RATE=0, USER_REQUEST_RATE=0)
+    sent: Dict[int, int] = {}
+    latencies: list[float] = []
+
+    def on_message(message: Dict[str, Any], received: int) -> None:
+        (number,) = struct.unpack(">Q", message["message"])
+        if number in sent:
+            latencies.append((received - sent[number]) / 1000)
+
+    # only the first client measures, the others are load
+    users = [BenchClient(port, secret, "bench0", on_message)]
+    users += [BenchClient(port, secret, f"bench{i}") for i in range(1, clients)]
+    time.sleep(.2)
+
+    start = time.perf_counter()
+    for number in range(messages):
+        sent[number] = time.perf_counter_ns()
+        users[number % clients].send_message(struct.pack(">Q", number))
+
+        # bursts of messages with a short pause in between
+        if number % burst == burst - 1:
+            time.sleep(pause)
+
+    # wait for the last broadcasts
+    deadline = time.monotonic() + 10
+    while len(latencies) < messages and time.monotonic() < deadline:
+        time.sleep(.01)
+
+    duration = time.perf_counter() - start
+    for user in users:
+        user.end()
+
+    server.terminate()
+    server.join()
+    return {
+        "coalesce_delay": delay,
+        "received": len(latencies),
+        "p50_us": round(percentile(latencies, 50), 1),
+        "p99_us": round(percentile(latencies, 99), 1),
+        "messages_per_second": round(messages / duration),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", default="thread", choices=("thread", "asyncio", "selector"))
+    parser.add_argument("--port", type=int, default=33400)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=10, help="messages sent without a pause")
+    parser.add_argument("--pause", type=float, default=0.01, help="seconds between bursts")
+    parser.add_argument("--delay", type=float, default=0.001, help="COALESCE_DELAY when coalescing is on")
+    args = parser.parse_args()
+
+    secret = load_secret()
+    for offset, delay in enumerate((0.0, args.delay)):
+        result = measure(args.port + offset, secret, args.engine, args.clients, args.messages, args.burst, args.pause, delay)
+        print(
+            f"coalescing {'on ' if delay else 'off'} ({delay * 1000:.1f} ms): "
+            f"p50 {result['p50_us']:.0f} us, p99 {result['p99_us']:.0f} us, "
+            f"{result['messages_per_second']} messages/s, {result['received']} received"
+        )
+
+
+if __name__ == "__main__":
+    main()
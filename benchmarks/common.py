@@ -0,0 +1,185 @@
+"""
+common.py
+Helpers shared by the benchmarks: a server running in its own process, a minimal
+protocol version 2 client that timestamps every broadcast it receives and baselines to compare with
+
+Author:
+Nilusink
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.protocol import BinaryCodec
+from core import send_long, set_nodelay, FrameReader, print_traceback
+
+from cryptography.fernet import Fernet, MultiFernet
+from typing import Callable, Dict, Any, List
+from contextlib import suppress
+import multiprocessing
+import threading
+import base64
+import socket
+import json
+import time
+
+
+CONFIG_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "docker_config.json")
+
+
+def load_secret() -> bytes:
+    """
+    the server secret of docker_config.json
+    """
+    with open(CONFIG_PATH, "r") as config:
+        return json.load(config)["server_secret"].encode()
+
+
+def session_key() -> bytes:
+    """
+    one random Fernet key directly from the system CSPRNG, compared with KeyPool (batched) and key_func
+    """
+    return base64.urlsafe_b64encode(os.urandom(32))
+
+
+def _run_server(port: int, secret: bytes, engine: str, settings: Dict[str, Any]) -> None:
+    """
+    entry point of the server process, settings overwrite the module constants of core.server
+    """
+    import core.server
+    import core.async_server
+    import core.selector_server
+
+    for name, value in settings.items():
+        for module in (core.server, core.async_server, core.selector_server):
+            if hasattr(module, name):
+                setattr(module, name, value)
+
+    engines = {
+        "thread": core.server.Connection,
+        "asyncio": core.async_server.AsyncConnection,
+        "selector": core.selector_server.SelectorConnection,
+    }
+    serv = engines[engine](port, secret)
+    serv.receive_clients()
+
+
+def start_server(port: int, secret: bytes, engine: str = "thread", **settings) -> multiprocessing.Process:
+    """
+    start a server in its own process (so it doesn't share the GIL with the clients)
+
+    :param port: the port to run on
+    :param secret: the server secret
+    :param engine: "thread", "asyncio" or "selector"
+    :param settings: module constants of core.server to overwrite (e.g. COALESCE_DELAY=0.001)
+    """
+    process = multiprocessing.get_context("spawn").Process(
+        target=_run_server,
+        args=(port, secret, engine, settings),
+        daemon=True
+    )
+    process.start()
+
+    # wait until it accepts connections
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=.1):
+            break
+
+        time.sleep(.05)
+
+    return process
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    nearest-rank percentile of values (0 for no values)
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+class BenchClient:
+    def __init__(
+            self,
+            port: int,
+            secret: bytes,
+            username: str,
+            on_message: Callable[[Dict[str, Any], int], None] | None = None,
+            host: str = "127.0.0.1",
+            codec=BinaryCodec
+    ) -> None:
+        """
+        log in and receive broadcasts in a thread (the history isn't requested)
+
+        :param port: the port of the server
+        :param secret: the server secret
+        :param username: the name of the user
+        :param on_message: called with every broadcast and the time it was received (time.perf_counter_ns)
+        :param host: the ip of the server
+        :param codec: the protocol version to use (JsonCodec or BinaryCodec)
+        """
+        self.username = username
+        self.received: int = 0
+        self.__on_message = on_message
+        self.__codec = codec
+        self.__server_fer = Fernet(secret)
+
+        self.__socket = socket.create_connection((host, port))
+        set_nodelay(self.__socket)
+        self.__reader = FrameReader(self.__socket)
+
+        request = self.__server_fer.encrypt(codec.dumps({"username": username, "version": codec.version, "room_key": True}))
+        if codec.framed_handshake:
+            send_long(self.__socket, request)
+            reply = self.__reader.receive()
+
+        else:
+            self.__socket.send(request)
+            reply = self.__socket.recv(2048)
+
+        reply = codec.loads(self.__server_fer.decrypt(reply))
+        if not reply["success"]:
+            raise ConnectionError(f"Login failed: {reply['reason']}")
+
+        keys = [Fernet(reply["key"].encode())]
+        if "room_key" in reply:
+            keys.append(Fernet(reply["room_key"].encode()))
+
+        self.__fer = MultiFernet(keys)
+        self.__send_lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__receive, daemon=True)
+        self.__thread.start()
+
+    @print_traceback
+    def __receive(self) -> None:
+        with suppress(OSError):
+            while True:
+                frame = self.__reader.receive()
+                received = time.perf_counter_ns()
+
+                # clients that only generate load don't decrypt (that would slow down the benchmark process)
+                if self.__on_message is None:
+                    self.received += 1
+                    continue
+
+                message = self.__codec.loads(self.__fer.decrypt(frame))
+                if message.get("type") == "message":
+                    self.received += 1
+                    self.__on_message(message, received)
+
+    def send_message(self, blob: bytes) -> None:
+        """
+        send a message, blob is broadcast as it is (not end-to-end encrypted)
+        """
+        frame = self.__fer.encrypt(self.__codec.dumps({"type": "message", "message": blob, "time": "00:00:00"}))
+        with self.__send_lock:
+            send_long(self.__socket, frame)
+
+    def end(self) -> None:
+        with suppress(OSError):
+            send_long(self.__socket, self.__fer.encrypt(self.__codec.dumps({"type": "action", "action": "end"})))
+            self.__socket.close()
@@ -0,0 +1,188 @@
+#! /usr/bin/python3
+"""
+load.py
+End-to-end load test: starts a server on localhost and drives simulated clients through the real
+handshake and protocol, reports throughput, login rate and delivery latency
+
+usage: python benchmarks/load.py [--clients 100] [--senders 10] [--rate 5] [--size 200] [--duration 10]
+                                 [--engine thread|asyncio|selector] [--protocol 2.0.0|1.0.0]
+                                 [--output results.json] [--baseline old.json] [--tolerance 0.1]
+
+Only --probes clients decrypt what they receive (to measure the latency), the others just count the frames,
+so the benchmark process doesn't become the bottleneck.
+With --baseline the results are compared to an earlier --output file, the exit code is 1 if
+throughput or p99 latency got worse by more than --tolerance.
+
+Author:
+Nilusink
+"""
+from common import BenchClient, load_secret, start_server, percentile
+
+from core.protocol import CODECS, blob_from_token
+
+from typing import Dict, Any
+import platform
+import argparse
+import struct
+import json
+import time
+import sys
+import os
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    secret = load_secret()
+    codec = CODECS[args.protocol]
+    # the rate limits would throttle the simulated senders
+    server = start_server(args.port, secret, args.engine, USER_MESSAGE_RATE=0, USER_REQUEST_RATE=0)
+
+    sent: Dict[int, int] = {}
+    latencies: list[float] = []
+
+    def on_message(message: Dict[str, Any], received: int) -> None:
+        blob = message["message"]
+        if isinstance(blob, str):
+            blob = blob_from_token(blob)
+
+        (number,) = struct.unpack_from(">Q", blob)
+        if number in sent:
+            latencies.append((received - sent[number]) / 1000)
+
+    try:
+        # logins
+        start = time.perf_counter()
+        clients = [
+            BenchClient(args.port, secret, f"load{i}", on_message if i < args.probes else None, codec=codec)
+            for i in range(args.clients)
+        ]
+        login_duration = time.perf_counter() - start
+        time.sleep(.5)
+        for client in clients:
+            client.received = 0
+
+        # send with a constant total rate, round-robin over the senders
+        senders = clients[:args.senders]
+        padding = os.urandom(max(args.size - 8, 0))
+        interval = 1 / (args.rate * len(senders))
+        number = 0
+        start = time.perf_counter()
+        next_send = start
+        while (now := time.perf_counter()) - start < args.duration:
+            if now < next_send:
+                time.sleep(next_send - now)
+                continue
+
+            sent[number] = time.perf_counter_ns()
+            senders[number % len(senders)].send_message(struct.pack(">Q", number) + padding)
+            number += 1
+            next_send += interval
+
+        send_duration = time.perf_counter() - start
+
+        # wait for the last broadcasts
+        expected = number * min(args.probes, args.clients)
+        deadline = time.monotonic() + args.drain
+        while len(latencies) < expected and time.monotonic() < deadline:
+            time.sleep(.01)
+
+        duration = time.perf_counter() - start
+        frames = sum(client.received for client in clients)
+        for client in clients:
+            client.end()
+
+    finally:
+        server.terminate()
+        server.join()
+
+    return {
+        "config": {
+            "clients": args.clients,
+            "senders": args.senders,
+            "rate": args.rate,
+            "size": args.size,
+            "duration": args.duration,
+            "engine": args.engine,
+            "protocol": args.protocol,
+            "probes": args.probes,
+        },
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "logins_per_second": round(args.clients / login_duration, 1),
+        "messages_sent": number,
+        "messages_per_second": round(number / send_duration, 1),
+        "fanout_frames_per_second": round(frames / duration, 1),
+        "delivered_ratio": round(frames / (number * args.clients), 4) if number else 0.0,
+        "latency_us": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "p999": round(percentile(latencies, 99.9), 1),
+            "samples": len(latencies),
+        },
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """
+    print the differences to the baseline
+
+    :return: False if something got worse by more than tolerance
+    """
+    checks = [
+        # name, new, old, bigger is better
+        ("messages/s", result["messages_per_second"], baseline["messages_per_second"], True),
+        ("fan-out frames/s", result["fanout_frames_per_second"], baseline["fanout_frames_per_second"], True),
+        ("logins/s", result["logins_per_second"], baseline["logins_per_second"], True),
+        ("p50 latency", result["latency_us"]["p50"], baseline["latency_us"]["p50"], False),
+        ("p99 latency", result["latency_us"]["p99"], baseline["latency_us"]["p99"], False),
+    ]
+    ok = True
+    for name, new, old, bigger_better in checks:
+        change = (new - old) / old if old else 0.0
+        worse = -change if bigger_better else change
+        regression = worse > tolerance and name in ("messages/s", "fan-out frames/s", "p99 latency")
+        ok &= not regression
+        print(f"  {name:<18} {old:>12} -> {new:<12} ({change:+.1%}){'  REGRESSION' if regression else ''}")
+
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100, help="number of simulated clients")
+    parser.add_argument("--senders", type=int, default=10, help="how many of the clients send messages")
+    parser.add_argument("--rate", type=float, default=5, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=200, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send messages")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for the last messages")
+    parser.add_argument("--probes", type=int, default=4, help="clients that measure the latency")
+    parser.add_argument("--engine", default="thread", choices=("thread", "asyncio", "selector"))
+    parser.add_argument("--protocol", default="2.0.0", choices=tuple(CODECS))
+    parser.add_argument("--port", type=int, default=33500)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    result = run(args)
+    latency = result["latency_us"]
+    print(
+        f"logins: {result['logins_per_second']}/s, messages: {result['messages_per_second']}/s, "
+        f"fan-out: {result['fanout_frames_per_second']} frames/s ({result['delivered_ratio']:.1%} delivered)\n"
+        f"latency: p50 {latency['p50']:.0f} us, p99 {latency['p99']:.0f} us, p999 {latency['p999']:.0f} us "
+        f"({latency['samples']} samples)"
+    )
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline:
+            print(f"compared to {args.baseline}:")
+            if not compare(result, json.load(baseline), args.tolerance):
+                return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
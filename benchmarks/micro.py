@@ -0,0 +1,182 @@
+#! /usr/bin/python3
+"""
+micro.py
+Micro-benchmarks of the stages every message passes on the server: encoding, encryption,
+framing, history bookkeeping and key generation
+
+usage: python benchmarks/micro.py [--filter fernet] [--repeat 5] [--output results.json]
+
+Every benchmark reports the time per operation (best and median of --repeat runs) and the peak
+memory allocated by one operation (tracemalloc).
+
+Author:
+Nilusink
+"""
+from common import session_key  # sets up the import path
+
+from core.protocol import JsonCodec, BinaryCodec, blob_from_token
+from core.compression import compression
+from core.history import MessageHistory
+from core.server import getsize
+from core import key_func, send_long, FrameReader, KeyPool
+
+from cryptography.fernet import Fernet
+from typing import Callable, Dict, Any
+import statistics
+import tracemalloc
+import argparse
+import platform
+import socket
+import json
+import time
+import sys
+import os
+
+
+FERNET = Fernet(Fernet.generate_key())
+
+
+def sample_message(size: int) -> Dict[str, Any]:
+    """
+    a broadcast as the server sends it, with an end-to-end encrypted text of about size bytes
+    """
+    return {
+        "type": "message",
+        "message": blob_from_token(FERNET.encrypt(os.urandom(size))),
+        "time": "12:34:56",
+        "user": "benchmark",
+        "id": 1_700_000_000_000_000,
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int, min_time: float = .2) -> Dict[str, float]:
+    """
+    time func, the number of calls per run is chosen so a run takes at least min_time seconds
+
+    :return: best and median ns/op and the peak bytes allocated by one call
+    """
+    func()
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            func()
+
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+
+    runs = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            func()
+
+        runs.append((time.perf_counter_ns() - start) / loops)
+
+    # allocations of a single call
+    allocated = []
+    tracemalloc.start()
+    for _ in range(5):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+
+    tracemalloc.stop()
+    return {
+        "ns_per_op": round(min(runs), 1),
+        "median_ns_per_op": round(statistics.median(runs), 1),
+        "bytes_per_op": statistics.median(allocated),
+        "loops": loops,
+    }
+
+
+def benchmarks() -> Dict[str, Callable[[], Any]]:
+    """
+    name: function to benchmark (setup is done here, outside the measurement)
+    """
+    result: Dict[str, Callable[[], Any]] = {}
+
+    for size in (100, 4000):
+        message = sample_message(size)
+        json_frame = JsonCodec.dumps(message)
+        binary_frame = BinaryCodec.dumps(message)
+        json_token = FERNET.encrypt(json_frame)
+        binary_token = FERNET.encrypt(binary_frame)
+
+        result[f"encode/json-utf32/{size}B"] = lambda m=message: JsonCodec.dumps(m)
+        result[f"decode/json-utf32/{size}B"] = lambda f=json_frame: JsonCodec.loads(f)
+        result[f"encode/binary/{size}B"] = lambda m=message: BinaryCodec.dumps(m)
+        result[f"decode/binary/{size}B"] = lambda f=binary_frame: BinaryCodec.loads(f)
+
+        # User.encrypt / User.decrypt: codec + Fernet
+        result[f"fernet/encrypt-json/{size}B"] = lambda f=json_frame: FERNET.encrypt(f)
+        result[f"fernet/decrypt-json/{size}B"] = lambda t=json_token: FERNET.decrypt(t)
+        result[f"fernet/encrypt-binary/{size}B"] = lambda f=binary_frame: FERNET.encrypt(f)
+        result[f"fernet/decrypt-binary/{size}B"] = lambda t=binary_token: FERNET.decrypt(t)
+
+    page = JsonCodec.dumps([sample_message(200) for _ in range(100)])
+    result["compress/zlib-6/history-page"] = lambda: compression("zlib", 6, 0).pack(page)
+
+    # framing over a local socket pair, send and receive in the same thread
+    sender, receiver = socket.socketpair()
+    reader = FrameReader(receiver)
+    for size in (100, 4096, 65536):
+        data = os.urandom(size)
+
+        def round_trip(d=data) -> bytes:
+            send_long(sender, d)
+            return reader.receive()
+
+        result[f"framing/send+receive/{size}B"] = round_trip
+
+    # getsize(MESSAGES) was run for every new message, the history now tracks its size on append
+    for count in (100, 1000, 10000):
+        entries = [dict(sample_message(200), id=i) for i in range(count)]
+        history = MessageHistory(sys.maxsize)
+        for entry in entries:
+            history.append(dict(entry))
+
+        # steady state: every append evicts the oldest entry
+        history.max_size = history.size
+
+        result[f"history/getsize/{count}"] = lambda e=entries: getsize(e)
+        result[f"history/append/{count}"] = lambda h=history, m=entries[0]: h.append(dict(m))
+
+    # session keys
+    pool = KeyPool()
+    result["keys/key_func"] = key_func
+    result["keys/session_key"] = session_key
+    result["keys/pool.get"] = pool.get
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results: Dict[str, Dict[str, float]] = {}
+    print(f"{'benchmark':<36} {'ns/op':>14} {'median':>14} {'bytes/op':>10}")
+    for name, func in benchmarks().items():
+        if args.filter not in name:
+            continue
+
+        results[name] = result = measure(func, args.repeat)
+        print(f"{name:<36} {result['ns_per_op']:>14,.0f} {result['median_ns_per_op']:>14,.0f} {result['bytes_per_op']:>10,}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "machine": {"python": platform.python_version(), "platform": platform.platform()},
+                "results": results
+            }, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
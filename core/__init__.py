@@ -12,6 +12,10 @@ import random
 import os
 
 from traceback import print_exc
+from contextlib import suppress
+from collections import deque
+from typing import Callable, Deque
+import threading
 import socket
 import struct
 import time
@@ -38,46 +42,271 @@ def key_func(length=10) -> bytes:
     return base64.urlsafe_b64encode(kdf.derive(password))  # Can only use kdf once
 
 
-def receive_long(receive_from: socket.socket) -> bytes:
+class KeyPool:
+    def __init__(self, size: int = 256) -> None:
+        """
+        precomputed session keys, refilled in batches from the system CSPRNG
+
+        :param size: number of keys generated per batch
+        """
+        self.size = size
+        self.__keys: Deque[bytes] = deque()
+        self.__lock = threading.Lock()
+
+    def fill(self) -> None:
+        """
+        generate a batch of keys with a single call to the CSPRNG
+        """
+        data = os.urandom(32 * self.size)
+        keys = [base64.urlsafe_b64encode(data[i:i + 32]) for i in range(0, len(data), 32)]
+        with self.__lock:
+            self.__keys.extend(keys)
+
+    def get(self) -> bytes:
+        """
+        take a key from the pool
+        """
+        while True:
+            with self.__lock:
+                if self.__keys:
+                    return self.__keys.popleft()
+
+            self.fill()
+
+
+class RateMeter:
+    def __init__(self, window: float = 10) -> None:
+        """
+        measure how often something happens
+
+        :param window: the rate is averaged over this many seconds
+        """
+        self.window = window
+        self.total: int = 0
+        self.__events: Deque[float] = deque()
+        self.__lock = threading.Lock()
+
+    def __prune(self, now: float) -> None:
+        while self.__events and self.__events[0] < now - self.window:
+            self.__events.popleft()
+
+    def tick(self) -> None:
+        """
+        count one event
+        """
+        now = time.monotonic()
+        with self.__lock:
+            self.total += 1
+            self.__events.append(now)
+            self.__prune(now)
+
+    @property
+    def rate(self) -> float:
+        """
+        events per second during the last window
+        """
+        with self.__lock:
+            self.__prune(time.monotonic())
+            return len(self.__events) / self.window
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        """
+        rate limit: on average rate events per second, bursts of up to burst events
+
+        :param rate: tokens added per second (0 for no limit)
+        :param burst: maximum number of tokens
+        """
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.__tokens + (now - self.__last) * self.rate, self.burst)
+        self.__last = now
+
+    def wait(self) -> float:
+        """
+        check for a token without taking it
+
+        :return: 0 if there is one, the seconds until there is one otherwise
+        """
+        if not self.rate:
+            return 0.0
+
+        with self.__lock:
+            self.__refill()
+            return 0.0 if self.__tokens >= 1 else (1 - self.__tokens) / self.rate
+
+    def take(self) -> float:
+        """
+        take one token
+
+        :return: 0 if there was one, the seconds until there is one otherwise
+        """
+        if not self.rate:
+            return 0.0
+
+        with self.__lock:
+            self.__refill()
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0.0
+
+            return (1 - self.__tokens) / self.rate
+
+
+MAX_FRAME_SIZE: int = 64 * 1024 * 1024  # in bytes, biggest frame accepted by default
+FRAME_BUFFER_RETAIN: int = 64 * 1024  # in bytes, bigger receive buffers are freed after use
+IOV_MAX: int = 1024  # maximum number of buffers per sendmsg call
+
+
+class FrameReader:
+    """
+    receives frames sent with send_long into a reused, preallocated buffer
     """
-    receive a long message (split in patches, send with send_long)
+    def __init__(self, receive_from: socket.socket, max_frame_size: int = MAX_FRAME_SIZE) -> None:
+        """
+        :param receive_from: the socket object to use for receiving
+        :param max_frame_size: frames announcing a bigger length abort the connection
+        """
+        self.__socket = receive_from
+        self.max_frame_size = max_frame_size
+
+        self.__header = bytearray(8)
+        self.__buffer = bytearray(1024)
+
+        # state of the frame currently received, kept if the socket times out
+        self.__length: int | None = None
+        self.__received = 0
+
+        # if set, started is the perf_counter_ns() when the header of the last frame was complete
+        self.timestamps = False
+        self.started: int = 0
+
+    def __recv_into(self, view: memoryview) -> int:
+        """
+        receive as many bytes as available into view
+        """
+        received = self.__socket.recv_into(view)
+        if not received:
+            raise ConnectionAbortedError("Failed receiving data - connection closed")
+
+        return received
+
+    def receive_view(self) -> memoryview:
+        """
+        receive one frame. A socket timeout can interrupt the call, the next call continues the same frame
+
+        :return: a view on the internal buffer, only valid until the next call
+        """
+        while self.__length is None:
+            self.__received += self.__recv_into(memoryview(self.__header)[self.__received:])
+
+            if self.__received == 8:
+                (length,) = struct.unpack('>Q', self.__header)
+                if length > self.max_frame_size:
+                    raise FrameTooLarge(f"Frame of {length} bytes exceeds the limit of {self.max_frame_size} bytes")
+
+                # grow for big frames, don't keep huge buffers around after them
+                if length > len(self.__buffer) or len(self.__buffer) > max(length, FRAME_BUFFER_RETAIN):
+                    self.__buffer = bytearray(max(length, 1024))
+
+                self.__length = length
+                self.__received = 0
+                if self.timestamps:
+                    self.started = time.perf_counter_ns()
+
+        view = memoryview(self.__buffer)[:self.__length]
+        while self.__received < self.__length:
+            self.__received += self.__recv_into(view[self.__received:])
+
+        self.__length = None
+        self.__received = 0
+        return view
+
+    def receive(self) -> bytes:
+        """
+        receive one frame (see FrameReader.receive_view)
+        """
+        return self.receive_view().tobytes()
+
+
+def receive_long(receive_from: socket.socket, max_frame_size: int = MAX_FRAME_SIZE) -> bytes:
+    """
+    receive a long message (send with send_long)
+    for receiving multiple frames from the same socket, use a FrameReader
+
     :param receive_from: the socket object to use for receiving
+    :param max_frame_size: the biggest accepted frame
     """
-    bs = receive_from.recv(8)  # receive message length
-    (length,) = struct.unpack('>Q', bs)
+    return FrameReader(receive_from, max_frame_size).receive()
 
-    data = b''
-    no_rec = 0
-    to_read = 0
-    while len(data) < length:  # receive message in patches so size doesn't matter
-        o_to_read = to_read
-        to_read = length - len(data)
-        data += receive_from.recv(
-            4096 if to_read > 4096 else to_read
-        )
 
-        if to_read == o_to_read:  # check if new packages were received
-            no_rec += 1
-        else:
-            no_rec = 0
+def set_nodelay(sock: socket.socket) -> None:
+    """
+    disable Nagle's algorithm, frames are sent in one write anyway (see send_frames)
+    """
+    with suppress(OSError):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        if no_rec >= 100:  # if for 100 loops no packages were received, raise connection loss
-            raise ConnectionAbortedError("Failed receiving data - connection loss")
 
-    return data
+def send_frames(send_to: socket.socket, frames, retry: Callable[[], bool] | None = None) -> None:
+    """
+    send multiple frames (each with its length header) with as few syscalls as possible,
+    uses vectored I/O (sendmsg) if available so nothing has to be copied
+
+    :param send_to: the socket object to use for sending
+    :param frames: the data of the frames
+    :param retry: called if the socket timed out, sending continues if it returns True (otherwise raises the timeout)
+    """
+    buffers: list = []
+    for frame in frames:
+        buffers.append(struct.pack('>Q', len(frame)))
+        if frame:
+            buffers.append(memoryview(frame))
+
+    # no sendmsg (windows), join into one buffer instead
+    if not hasattr(send_to, "sendmsg"):
+        buffers = [memoryview(b"".join(buffers))]
+
+    first = 0
+    while first < len(buffers):
+        try:
+            if len(buffers) - first == 1:
+                sent = send_to.send(buffers[first])
+
+            else:
+                sent = send_to.sendmsg(buffers[first:first + IOV_MAX])
+
+        except socket.timeout:
+            if retry is not None and retry():
+                continue
+
+            raise
+
+        # skip what was sent, the first partially sent buffer is cut
+        while sent:
+            if sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+
+            else:
+                buffers[first] = memoryview(buffers[first])[sent:]
+                sent = 0
 
 
 def send_long(send_to: socket.socket, data: bytes) -> None:
     """
-    send a long message (split in patches, receive with receive_long)
+    send a long message (header and data in one write, receive with receive_long)
     :param send_to: the socket object to use for sending
     :param data: the data to send
     """
-    length = struct.pack('>Q', len(data))  # get message length
-
-    # send to client
-    send_to.sendall(length)
-    send_to.sendall(data)
+    send_frames(send_to, (data,))
 
 
 def print_traceback(func):
@@ -95,6 +324,10 @@ class AuthError(Exception):
     pass
 
 
+class FrameTooLarge(ConnectionAbortedError):
+    pass
+
+
 class Daytime:
     """
     class for calculating with HH:MM:SS
@@ -0,0 +1,344 @@
+"""
+async_server.py
+Event-loop based server engine, speaks the same protocol as server.py
+but handles every client as a coroutine instead of a thread
+
+Author:
+Nilusink
+"""
+from core.protocol import CODECS, JsonCodec, ProtocolError
+from core.server import RUNNING_CLIENTS, MAX_FRAME_SIZE, HANDSHAKE_QUEUE, HANDSHAKE_TIMEOUT, COALESCE_DELAY, COALESCE_BYTES
+from core.server import FRAMES_IN, BYTES_IN, FRAMES_OUT, BYTES_OUT, HANDSHAKE_FAILURES
+from core.server import Connection, Session, login_compression, read_login, login_rejection, count_login
+from core.server import replace_session
+from core.compression import Compression, NO_COMPRESSION
+from core.metrics import METRICS
+from core.tracing import TRACER
+from core import FrameTooLarge, RateMeter
+
+from cryptography.fernet import Fernet, InvalidToken
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from contextlib import suppress
+import asyncio
+import struct
+import time
+
+
+class AsyncUser(Session):
+    def __init__(
+            self,
+            writer: asyncio.StreamWriter,
+            default_encryption: Callable,
+            username: str,
+            codec=JsonCodec,
+            room_key: bool = False,
+            compression: Compression = NO_COMPRESSION,
+            key: bytes | None = None
+    ) -> None:
+        """
+        create a new client session (the reading is done by AsyncUser.receive)
+
+        :param writer: The stream writer of the Client
+        :param default_encryption: function used to encrypt the login response
+        :param username: the name of the user
+        :param codec: the encoding matching the clients protocol version
+        :param room_key: if the client accepted broadcasts encrypted with the room key
+        :param compression: the compression negotiated with the client
+        :param key: the session key of a resumed session, None for a new one
+        """
+        # the event loop can't block, so the "block" policy disconnects as soon as the queue is full
+        super().__init__(username, codec, room_key, compression, key, queue_timeout=0)
+        self.__writer = writer
+        self.__queued = asyncio.Event()
+
+        # frames collected for one write (see COALESCE_DELAY)
+        self.__pending: list[bytes] = []
+        self.__pending_size: int = 0
+        self.__flush_handle: asyncio.TimerHandle | None = None
+
+        response = self.register(default_encryption)
+        self.send_handshake(writer, response, codec)
+        if not self.running:
+            writer.close()
+            return
+
+        self.__write_task = asyncio.get_running_loop().create_task(self.__write())
+
+        print(f"Login: {username}")
+
+    @staticmethod
+    def send_handshake(writer: asyncio.StreamWriter, data: bytes, codec) -> None:
+        """
+        send the (encrypted) login response the same way the request was sent (see server.send_handshake)
+        """
+        if codec.framed_handshake:
+            data = struct.pack('>Q', len(data)) + data
+
+        writer.write(data)
+
+    async def receive(self, reader: asyncio.StreamReader) -> None:
+        """
+        receive and process requests until the client disconnects
+
+        :param reader: The stream reader of the Client
+        """
+        try:
+            while self.running:
+                (length,) = struct.unpack('>Q', await reader.readexactly(8))
+                if length > MAX_FRAME_SIZE:
+                    raise FrameTooLarge(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes")
+
+                trace = TRACER.sample(0, id(self), self.username) if TRACER.rate else None
+                bytes_mes = await reader.readexactly(length)
+                FRAMES_IN.inc()
+                BYTES_IN.inc(length)
+                if trace is not None:
+                    trace.mark("receive")
+
+                if not self.handle(bytes_mes, trace):
+                    return
+
+        except (asyncio.IncompleteReadError, ConnectionError, InvalidToken, ProtocolError):
+            pass
+
+        except asyncio.CancelledError:
+            # server shutting down
+            pass
+
+        finally:
+            self.end()
+
+    def __writable(self) -> bool:
+        """
+        if the transport buffer has room for more frames
+        """
+        transport = self.__writer.transport
+        return transport.get_write_buffer_size() < transport.get_write_buffer_limits()[1]
+
+    async def __write(self) -> None:
+        """
+        send the queued frames once the transport buffer has room again
+        """
+        try:
+            while self.running:
+                await self.__queued.wait()
+                self.__queued.clear()
+
+                while self.running and self.queue.depth:
+                    await self.__writer.drain()
+                    while self.__writable() and (data := self.queue.pop()) is not None:
+                        self.__writer.writelines((struct.pack('>Q', len(data)), data))
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self.end()
+
+    def send_token(self, data: bytes) -> None:
+        """
+        send an already encrypted frame
+
+        :param data: the encrypted frame
+        """
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(data))
+        if not COALESCE_DELAY:
+            self.__send_frames((data,))
+            return
+
+        self.__pending.append(data)
+        self.__pending_size += len(data)
+        if self.__pending_size >= COALESCE_BYTES:
+            self.__flush()
+
+        elif self.__flush_handle is None:
+            self.__flush_handle = asyncio.get_running_loop().call_later(COALESCE_DELAY, self.__flush)
+
+    def __flush(self) -> None:
+        """
+        send the frames collected for coalescing
+        """
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        frames, self.__pending, self.__pending_size = self.__pending, [], 0
+        if self.running:
+            self.__send_frames(frames)
+
+    def __send_frames(self, frames) -> None:
+        """
+        write the frames right away if the transport buffer has room, queue them otherwise
+        """
+        if self.__writer.transport.is_closing():
+            # connection lost, the receiving side didn't notice yet
+            self.end()
+            return
+
+        if not self.queue.depth and self.__writable():
+            self.__writer.writelines([part for data in frames for part in (struct.pack('>Q', len(data)), data)])
+            return
+
+        for data in frames:
+            if not self.queue.put(data):
+                # the client is too slow, don't wait for the buffered data to be sent
+                self.__writer.transport.abort()
+                self.end()
+                return
+
+        self.__queued.set()
+
+    def end(self, wait: bool = True) -> None:
+        """
+        :param wait: only for compatibility with User.end
+        """
+        if not self.logout():
+            return
+
+        with suppress(Exception):
+            if self.__flush_handle is not None:
+                self.__flush_handle.cancel()
+
+            self.__queued.set()
+            self.__writer.close()
+
+
+class AsyncConnection:
+    protocol_version = Connection.protocol_version
+    accepted_versions = Connection.accepted_versions
+
+    def __init__(self, port: int, server_secret: bytes, reuse_port: bool = False) -> None:
+        """
+        initialize the server (the socket is created once the event loop runs)
+
+        :param port: the port to run on
+        :param server_secret: Your custom secret key
+        :param reuse_port: let multiple processes accept on the same port (SO_REUSEPORT)
+        """
+        # validation of the secret and creation of the Fernet object
+        try:
+            self.__fer = Fernet(server_secret)
+
+        except InvalidToken:
+            raise ValueError("Client secret not valid")
+
+        # store reused variables
+        self.__port = port
+        self.__reuse_port = reuse_port
+        self.__secret = server_secret
+        self.running = True
+        self.__pool = None
+        self.__loop: asyncio.AbstractEventLoop | None = None
+        self.__server: asyncio.AbstractServer | None = None
+        self.__login_slots = asyncio.Semaphore(HANDSHAKE_QUEUE)
+        self.logins = RateMeter()
+        METRICS.gauge("logins_per_second", lambda: round(self.logins.rate, 2))
+
+    @property
+    def secret(self) -> bytes:
+        return self.__secret
+
+    def call_soon_threadsafe(self, func: Callable, *args) -> None:
+        """
+        run func in the event loop (the users may only be used from there), directly if it isn't running yet
+        """
+        if self.__loop is None:
+            func(*args)
+            return
+
+        self.__loop.call_soon_threadsafe(func, *args)
+
+    @staticmethod
+    async def __receive_handshake(reader: asyncio.StreamReader) -> bytes:
+        """
+        receive the (encrypted) login request of a client (see server.receive_handshake)
+        """
+        first = await reader.readexactly(1)
+        if first == b"\x00":
+            (length,) = struct.unpack('>Q', first + await reader.readexactly(7))
+            if length > 2048:
+                raise FrameTooLarge("Handshake too long")
+
+            return await reader.readexactly(length)
+
+        return first + await reader.read(2047)
+
+    async def __handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        login a new client and keep receiving its requests
+        """
+        start = time.perf_counter_ns()
+        try:
+            # at most HANDSHAKE_QUEUE handshakes at once, the others wait (like the accepting thread of Connection)
+            async with self.__login_slots:
+                handshake = await asyncio.wait_for(self.__receive_handshake(reader), HANDSHAKE_TIMEOUT)
+
+            codec, init_mes, key = read_login(self.__fer, handshake)
+            reason = Connection.login_error(init_mes, key is not None)
+
+        except (InvalidToken, ValueError, KeyError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            HANDSHAKE_FAILURES.inc()
+            writer.close()
+            return
+
+        if reason is not None:
+            AsyncUser.send_handshake(writer, login_rejection(self.__fer.encrypt, codec, reason), codec)
+            writer.close()
+            return
+
+        if key is not None:
+            replace_session(init_mes["username"])
+
+        user = AsyncUser(
+            writer,
+            self.__fer.encrypt,
+            init_mes["username"],
+            CODECS[init_mes["version"]],
+            init_mes.get("room_key", False),
+            login_compression(init_mes),
+            key
+        )
+
+        # the name was taken by another server process
+        if not user.running:
+            return
+
+        self.logins.tick()
+        count_login(start, key is not None)
+        await user.receive(reader)
+
+    async def serve(self) -> None:
+        """
+        accept clients until AsyncConnection.end is called
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.__server = await asyncio.start_server(
+            self.__handle_client, "0.0.0.0", self.__port, reuse_address=True, reuse_port=self.__reuse_port or None
+        )
+
+        with suppress(asyncio.CancelledError):
+            async with self.__server:
+                await self.__server.serve_forever()
+
+    def receive_clients(self, thread: bool = False) -> None:
+        if thread:
+            if not self.__pool:
+                self.__pool = ThreadPoolExecutor(max_workers=1)
+
+            self.__pool.submit(self.receive_clients, thread=False)
+            return
+
+        asyncio.run(self.serve())
+
+    def end(self) -> None:
+        self.running = False
+        if self.__loop is not None and not self.__loop.is_closed():
+            # shutdown every running client and stop accepting, from within the event loop
+            with suppress(RuntimeError):
+                self.__loop.call_soon_threadsafe(RUNNING_CLIENTS.end)
+                self.__loop.call_soon_threadsafe(self.__server.close)
+
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
@@ -1,17 +1,25 @@
 """
 client.py
-Helper for GUI application, handles server communication
+Helper for GUI application, handles server communication.
+Connection uses a thread per connection, AsyncConnection asyncio (for bots with a lot of connections)
 
 Author:
 Nilusink
 """
-from core import send_long, receive_long, AuthError, Daytime, print_traceback, InvalidSecret
-
-from cryptography.fernet import Fernet, InvalidToken
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Generator
+from core.compression import Compression, NO_COMPRESSION, compression
+from core.protocol import BinaryCodec, blob_from_token, token_from_blob
+from core import send_long, set_nodelay, FrameReader, FrameTooLarge, MAX_FRAME_SIZE
+from core import AuthError, Daytime, print_traceback, InvalidSecret
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Generator
+from collections import deque
 from contextlib import suppress
 from traceback import print_exc
+from abc import ABC, abstractmethod
+import threading
+import asyncio
 import socket
 import struct
 import json
@@ -22,20 +30,144 @@ HELLO_MES: str = "Joined!"
 BYE_MES: str = "Left!"
 
 
-class Connection:
-    protocol_version = "1.0.0"
-    __messages: list = []
-    running = True
+def decrypt_texts(clients_secret: bytes | str, tokens: list[bytes]) -> list[str | dict | None]:
+    """
+    decrypt message texts (for the worker pool, a ProcessPoolExecutor works too)
+
+    :param clients_secret: the secret the message texts are encrypted with
+    :param tokens: the Fernet tokens
+    :return: the texts, None for the ones that couldn't be decrypted
+    """
+    fer = Fernet(clients_secret)
+    texts: list[str | dict | None] = []
+    for token in tokens:
+        try:
+            texts.append(json.loads(fer.decrypt(token).decode("utf-32")))
+
+        except (InvalidToken, ValueError):
+            texts.append(None)
+
+    return texts
+
+
+class Message(dict):
+    """
+    a received message, its text (message["message"]) is only decrypted when it is accessed the first time.
+    Until then, dict methods that don't use __getitem__ (items, values, copying) see None as text
+    """
+    __slots__ = ("__token", "__decrypt")
 
-    def __init__(self, ip: str, port: int, username: str, server_secret: bytes | str, clients_secret: bytes | str) -> None:
+    def __init__(self, fields: dict, token: bytes, decrypt: Callable[[bytes], str | dict]) -> None:
         """
-        Initialize the connection to a server
+        :param fields: the message as received (user, time, id, ...)
+        :param token: the encrypted text
+        :param decrypt: decrypts the token
+        """
+        super().__init__(fields)
+        super().__setitem__("message", None)
+        self.__token: bytes | None = token
+        self.__decrypt = decrypt
 
-        :param ip: The ip of the Server
-        :param port: The port the Server runs on
+    @property
+    def decrypted(self) -> bool:
+        return self.__token is None
+
+    @property
+    def token(self) -> bytes | None:
+        """
+        the encrypted text, None once it is decrypted
+        """
+        return self.__token
+
+    def decrypt(self) -> str | dict:
+        """
+        the text, decrypted now if that didn't happen yet
+
+        :raises InvalidToken: if the text isn't encrypted with the clients secret
+        """
+        token = self.__token
+        if token is not None:
+            self.set_text(self.__decrypt(token))
+
+        return super().__getitem__("message")
+
+    def set_text(self, text: str | dict) -> None:
+        """
+        set the decrypted text (used by the worker pool)
+        """
+        super().__setitem__("message", text)
+        self.__token = None
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "message":
+            return self.decrypt()
+
+        return super().__getitem__(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "message":
+            return self.decrypt()
+
+        return super().get(key, default)
+
+
+class _Session(ABC):
+    """
+    settings, handshake and encryption shared by Connection and AsyncConnection
+    """
+    protocol_version = "2.0.0"
+    codec = BinaryCodec
+    history_page_size: int = 100
+    accept_room_key: bool = True
+
+    # offered to the server in the handshake, preferred first (empty to never compress)
+    compression_algorithms: tuple = ("zlib",)
+    compression_level: int = 6  # the server may choose a lower one
+
+    # received messages not yet taken by the application, the oldest are dropped if full
+    inbox_size: int = 10_000
+
+    # the newest history page is delivered right away, older pages are loaded in the background (up to
+    # history_limit messages, 0 for all) and delivered as they arrive, so sort the messages by id.
+    # ordered_history: only load the newest page and deliver it (and the messages received until it
+    # arrived) oldest first, for applications that can only append
+    history_limit: int = 1000
+    ordered_history: bool = False
+
+    # message texts are decrypted when accessed, history pages are additionally decrypted in the background
+    # by a pool of decrypt_workers threads (shared by all connections) in chunks of decrypt_chunk messages,
+    # newest first (0 workers: only on access). Set decrypt_pool to use another executor (e.g. a ProcessPoolExecutor)
+    decrypt_workers: int = 2
+    decrypt_chunk: int = 50
+    decrypt_pool: Executor | None = None
+    __shared_pool: ThreadPoolExecutor | None = None
+    __pool_lock = threading.Lock()
+    running = True
+
+    def __init__(
+            self,
+            username: str,
+            server_secret: bytes | str,
+            clients_secret: bytes | str,
+            last_id: int = -1,
+            ticket: str | None = None
+    ) -> None:
+        """
         :param username: username, different for every client (identification for other clients)
         :param server_secret: Your custom secret key
+        :param clients_secret: the secret the message texts are encrypted with
+        :param last_id: id of the newest message already received (when reconnecting), older ones aren't loaded again
+        :param ticket: session ticket of the previous connection (when reconnecting), resumes its session
         """
+        self.username = username
+
+        # newest message id received, pass it when reconnecting
+        self.last_id = last_id
+
+        # session ticket from the server, pass it when reconnecting (resumed: the server accepted the ticket)
+        self.ticket = ticket
+        self.resumed = False
+
         # validation of the secret and creation of Fernet objects
         try:
             self.fer = Fernet(server_secret)
@@ -49,27 +181,54 @@ class Connection:
         except (InvalidToken, ValueError):
             raise InvalidSecret("Clients secret not valid")
 
-        # create the socket object
-        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.__server.connect((ip, port))
+        self.__server_secret = server_secret
+        self.__clients_secret = clients_secret
+        self.__decrypting: set[Future] = set()
 
-        except socket.gaierror:
-            raise ConnectionError("Invalid ip")
+        self.__fer: Fernet | MultiFernet | None = None
+        self.__compression = NO_COMPRESSION
 
-        except ConnectionRefusedError:
-            raise ConnectionRefusedError("Server not running on targeted ip")
+        # server statistics, set once requested with request_stats (only for admins)
+        self.stats: dict | None = None
+
+        # the server drops requests sent too fast, the last throttle response and how many there were
+        self.throttled: dict | None = None
+        self.throttle_count: int = 0
+        self.__seen_ids: set[int] = set()
+        self.__history_since = last_id
+        self.__history_before: int | None = None
+        self.__history_loaded: int = 0
 
-        # create the initial message and send it to the server
-        mes = {
-                "username": username,
-                "version": self.protocol_version
+        # messages held back until the newest history page arrived (see ordered_history)
+        self.__held: list[Message] | None = None
+
+    def login_request(self) -> bytes:
+        """
+        the (encrypted) handshake sent to the server
+        """
+        request = {
+            "username": self.username,
+            "version": self.protocol_version,
+            "room_key": self.accept_room_key,
+            "heartbeat": True,
+            "compression": {
+                "algorithms": list(self.compression_algorithms),
+                "level": self.compression_level
+            }
         }
+        if self.ticket is not None:
+            request["ticket"] = self.ticket
+
+        return self.fer.encrypt(self.codec.dumps(request))
 
-        self.__server.send(self.fer.encrypt(json.dumps(mes).encode("utf-32")))
+    def login(self, response: bytes) -> None:
+        """
+        check the (encrypted) login response of the server and set up the session
 
-        # receive validation message from server
-        val = json.loads(self.fer.decrypt(self.__server.recv(2048)).decode("utf-32"))
+        :raises NameError: if the username is already online
+        :raises AuthError: if the server refused the login
+        """
+        val = self.codec.loads(self.fer.decrypt(response))
         if not val["success"]:
             match val["reason"]:
                 case "UserOnline":
@@ -78,27 +237,90 @@ class Connection:
                 case _:
                     raise AuthError(f"Error accessing server: {val['reason']}")
 
-        # create Fernet object with custom key
+        # create Fernet object with custom key, broadcasts may be encrypted with the room key
         self.__fer = Fernet(val["key"].encode())
+        if "room_key" in val:
+            self.__fer = MultiFernet([self.__fer, Fernet(val["room_key"].encode())])
 
-        # create thread
-        self.__pool = ThreadPoolExecutor(max_workers=1)
-        self.__pool.submit(self.__receive)
+        # compression chosen by the server (older servers don't compress)
+        if "compression" in val:
+            self.__compression = compression(**val["compression"])
+
+        # an expired ticket is ignored by the server (new session)
+        self.ticket = val.get("ticket")
+        self.resumed = val.get("resumed", False)
+
+    def _resume_arguments(self) -> tuple:
+        """
+        the arguments for a new session resuming this one (username, secrets, last_id, ticket)
+        """
+        # held messages weren't delivered yet, load them again
+        last_id = self.__history_since if self.__held is not None else self.last_id
+        return self.username, self.__server_secret, self.__clients_secret, last_id, self.ticket
 
-        send_long(self.__server, self.encrypt({
+    @abstractmethod
+    def _send(self, data: bytes) -> None:
+        """
+        send an encrypted frame to the server
+        """
+
+    @abstractmethod
+    def _call_later(self, delay: float, func, *args) -> None:
+        """
+        call func(*args) after delay seconds
+        """
+
+    def request_history(self, since: int = -1, before: int | None = None) -> None:
+        """
+        request one page of the messages newer than since (the newest page first),
+        the older pages are requested automatically (see history_limit)
+
+        :param since: id of the newest message the client already has
+        :param before: only request messages older than this id
+        """
+        self.__history_since = since
+        self.__history_before = before
+        if before is None:
+            self.__history_loaded = 0
+            if self.ordered_history and self.__held is None:
+                self.__held = []
+
+        limit = self.history_page_size
+        if self.history_limit:
+            limit = min(limit, self.history_limit - self.__history_loaded)
+
+        self._send(self.encrypt({
             "type": "action",
-            "action": "get_all"
+            "action": "get_since",
+            "since": since,
+            "before": before,
+            "limit": limit
         }))
-        self.send_message(HELLO_MES)
 
-    @property
-    def new_messages(self) -> Generator:
+    def request_stats(self) -> None:
         """
-        yield all new messages
+        request the server statistics, Connection.stats is set once they arrive
         """
-        for element in self.__messages.copy():
-            self.__messages.remove(element)
-            yield element
+        self._send(self.encrypt({
+            "type": "action",
+            "action": "stats"
+        }))
+
+    def _message_request(self, message: str) -> bytes:
+        """
+        the encrypted frame sending message
+        """
+        return self.encrypt({
+            "type": "message",
+            "message": blob_from_token(self.encrypt_client(message)),
+            "time": str(Daytime.now())
+        })
+
+    def _end_request(self) -> bytes:
+        return self.encrypt({
+            "type": "action",
+            "action": "end"
+        })
 
     def encrypt(self, message: str | dict) -> bytes:
         """
@@ -107,7 +329,7 @@ class Connection:
         :param message: the message to encrypt
         :return: the encrypted message
         """
-        return self.__fer.encrypt(json.dumps(message).encode("utf-32"))
+        return self.__fer.encrypt(self.__compression.pack(self.codec.dumps(message)))
 
     def decrypt(self, message: bytes) -> Any:
         """
@@ -116,7 +338,7 @@ class Connection:
         :param message: the message to encrypt
         :return: the encrypted message
         """
-        return json.loads(self.__fer.decrypt(message).decode("utf-32"))
+        return self.codec.loads(Compression.unpack(self.__fer.decrypt(message), MAX_FRAME_SIZE))
 
     def encrypt_client(self, message: str | dict) -> bytes:
         """
@@ -136,35 +358,334 @@ class Connection:
         """
         return json.loads(self.__clients_fer.decrypt(message).decode("utf-32"))
 
+    @staticmethod
+    def __token(message: bytes | str) -> bytes:
+        """
+        the Fernet token of an encrypted message text (raw bytes or, for version 1, a token string)
+        """
+        if isinstance(message, str):
+            return message.encode()
+
+        return token_from_blob(message)
+
+    def __pool(self) -> Executor | None:
+        """
+        the executor for decrypting history, the shared pool is created on first use
+        """
+        if self.decrypt_pool is not None:
+            return self.decrypt_pool
+
+        if not self.decrypt_workers:
+            return None
+
+        with _Session.__pool_lock:
+            if _Session.__shared_pool is None:
+                _Session.__shared_pool = ThreadPoolExecutor(self.decrypt_workers, thread_name_prefix="decrypt")
+
+        return _Session.__shared_pool
+
+    def __decrypt_history(self, messages: list[Message]) -> None:
+        """
+        decrypt history messages in the background, newest first (in chunks)
+        """
+        pool = self.__pool()
+        if pool is None:
+            return
+
+        pending = [message for message in reversed(messages) if not message.decrypted]
+        for start in range(0, len(pending), self.decrypt_chunk):
+            chunk = pending[start:start + self.decrypt_chunk]
+            try:
+                future = pool.submit(decrypt_texts, self.__clients_secret, [message.token for message in chunk])
+
+            except RuntimeError:
+                # pool shut down, the rest is decrypted on access
+                return
+
+            self.__decrypting.add(future)
+            future.add_done_callback(lambda done, c=chunk: self.__set_texts(c, done))
+
+    def __set_texts(self, messages: list[Message], future: Future) -> None:
+        self.__decrypting.discard(future)
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        for message, text in zip(messages, future.result()):
+            # texts that failed keep raising when accessed
+            if text is not None and not message.decrypted:
+                message.set_text(text)
+
+    def _cancel_decryption(self) -> None:
+        """
+        don't decrypt the rest of the history in the background (when the connection ends)
+        """
+        for future in tuple(self.__decrypting):
+            future.cancel()
+
+    def __load_older(self) -> bool:
+        """
+        if the next older history page should be requested
+        """
+        return not self.ordered_history and (not self.history_limit or self.__history_loaded < self.history_limit)
+
+    def __is_new(self, message: dict) -> bool:
+        """
+        if a message wasn't received before (by id)
+        """
+        if "id" not in message:
+            return True
+
+        if message["id"] in self.__seen_ids:
+            return False
+
+        self.__seen_ids.add(message["id"])
+        self.last_id = max(self.last_id, message["id"])
+        return True
+
+    def _handle(self, frame: bytes) -> list[dict]:
+        """
+        process a frame received from the server, requests the next history page if needed
+
+        :return: the new messages in it (the texts are decrypted on access, see Message)
+        """
+        message = self.decrypt(frame)
+        received: list[dict] = []
+        history = False
+        match message["type"]:
+            case "request_result":
+                match message["request_type"]:
+                    case "get_all":
+                        received = message["request_result"]
+                        history = True
+
+                    case "get_since":
+                        received = message["request_result"]
+                        history = True
+                        self.__history_loaded += len(received)
+
+                        # continue with the next older page
+                        if message["more"] and received and self.__load_older():
+                            self.request_history(since=self.__history_since, before=received[0]["id"])
+
+                    case "stats":
+                        self.stats = message["request_result"]
+
+            case "message":
+                received = [message]
+
+            case "throttled":
+                # the request was dropped, retry after message["retry_after"] seconds
+                self.throttled = message
+                self.throttle_count += 1
+
+                # don't lose the rest of the history
+                if message["request_type"] == "get_since":
+                    self._call_later(
+                        message["retry_after"],
+                        self.request_history,
+                        self.__history_since,
+                        self.__history_before
+                    )
+
+            case "ping":
+                # heartbeat, the server disconnects clients that don't answer
+                self._send(self.encrypt({
+                    "type": "action",
+                    "action": "pong"
+                }))
+
+        new: list[Message] = []
+        for mes in received:
+            try:
+                token = self.__token(mes["message"])
+
+            except (KeyError, TypeError, ValueError):
+                # malformed entry (sent by a broken client to an older server), skipped
+                continue
+
+            if self.__is_new(mes):
+                new.append(Message(mes, token, self.decrypt_client))
+
+        if history:
+            self.__decrypt_history(new)
+
+        if self.__held is not None:
+            self.__held += new
+            if not history:
+                return []
+
+            new = sorted(self.__held, key=lambda held: held.get("id", -1))
+            self.__held = None
+
+        return new
+
+
+class Connection(_Session):
+    def __init__(
+            self,
+            ip: str,
+            port: int,
+            username: str,
+            server_secret: bytes | str,
+            clients_secret: bytes | str,
+            last_id: int = -1,
+            ticket: str | None = None
+    ) -> None:
+        """
+        Initialize the connection to a server
+
+        :param ip: The ip of the Server
+        :param port: The port the Server runs on
+        :param username: username, different for every client (identification for other clients)
+        :param server_secret: Your custom secret key
+        :param last_id: id of the newest message already received (when reconnecting), older ones aren't loaded again
+        :param ticket: session ticket of the previous connection (when reconnecting), see Connection.reconnect
+        """
+        super().__init__(username, server_secret, clients_secret, last_id, ticket)
+        self.__address = ip, port
+
+        # create the socket object
+        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.__server.connect((ip, port))
+
+        except socket.gaierror:
+            raise ConnectionError("Invalid ip")
+
+        except ConnectionRefusedError:
+            raise ConnectionRefusedError("Server not running on targeted ip")
+
+        set_nodelay(self.__server)
+
+        # send the initial message and validate the answer
+        self.__reader = FrameReader(self.__server)
+        if self.codec.framed_handshake:
+            send_long(self.__server, self.login_request())
+            self.login(self.__reader.receive())
+
+        else:
+            self.__server.send(self.login_request())
+            self.login(self.__server.recv(2048))
+
+        # received messages, deduplicated by id
+        self.__messages: Deque[dict] = deque(maxlen=self.inbox_size)
+        self.__messages_available = threading.Condition()
+        self.__callbacks: list[Callable[[dict], None]] = []
+
+        # create thread
+        self.__send_lock = threading.Lock()
+        self.__pool = ThreadPoolExecutor(max_workers=1)
+        self.__pool.submit(self.__receive)
+
+        # only the missed messages are loaded, a resumed session doesn't join again
+        self.request_history(since=last_id)
+        if not self.resumed:
+            self.send_message(HELLO_MES)
+
+    def _send(self, data: bytes) -> None:
+        """
+        send a frame to the server (the receiving thread sends page requests too)
+        """
+        with self.__send_lock:
+            send_long(self.__server, data)
+
+    def _call_later(self, delay: float, func, *args) -> None:
+        def run() -> None:
+            if self.running:
+                with suppress(OSError):
+                    func(*args)
+
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        timer.start()
+
+    @property
+    def new_messages(self) -> Generator:
+        """
+        yield all new messages (doesn't wait for more)
+        """
+        while self.__messages:
+            with self.__messages_available:
+                if not self.__messages:
+                    return
+
+                message = self.__messages.popleft()
+
+            yield message
+
+    def get_message(self, timeout: float | None = None) -> dict | None:
+        """
+        wait for the next new message
+
+        :param timeout: in seconds, None to wait until there is one
+        :return: the message, None if the timeout passed or the connection ended
+        """
+        with self.__messages_available:
+            self.__messages_available.wait_for(lambda: self.__messages or not self.running, timeout)
+            return self.__messages.popleft() if self.__messages else None
+
+    def messages(self, timeout: float | None = None) -> Generator:
+        """
+        yield new messages as they arrive
+
+        :param timeout: in seconds, stop if there is no new message for this long (None to never stop)
+        """
+        while (message := self.get_message(timeout)) is not None:
+            yield message
+
+    def add_callback(self, callback: Callable[[dict], None]) -> None:
+        """
+        call callback with every new message (from the receiving thread, so don't block in it)
+        """
+        self.__callbacks.append(callback)
+
+    def remove_callback(self, callback: Callable[[dict], None]) -> None:
+        with suppress(ValueError):
+            self.__callbacks.remove(callback)
+
+    def __deliver(self, message: dict) -> None:
+        """
+        pass a new message to the queue and the callbacks
+        """
+        with self.__messages_available:
+            self.__messages.append(message)
+            self.__messages_available.notify_all()
+
+        for callback in tuple(self.__callbacks):
+            try:
+                callback(message)
+
+            except Exception:
+                print_exc()
+
+    def __stop(self) -> None:
+        """
+        mark the connection as ended, wakes up everyone waiting for messages
+        """
+        self.running = False
+        with self.__messages_available:
+            self.__messages_available.notify_all()
+
     @print_traceback
     def __receive(self) -> None:
         """
         receive and process incoming messages from the server
         """
-        self.__server.settimeout(.5)
         while self.running:
             try:
-                byte_mes = receive_long(self.__server)
+                byte_mes = self.__reader.receive()
 
-            except (ConnectionResetError, struct.error, socket.timeout, OSError):
-                continue
+            except OSError:
+                # connection closed by the server / Connection.end or invalid frame
+                self.__stop()
+                return
 
             except Exception:
                 print_exc()
                 raise
 
-            message = self.decrypt(byte_mes)
-            match message["type"]:
-                case "request_result":
-                    match message["request_type"]:
-                        case "get_all":
-                            for mes in message["request_result"]:
-                                mes["message"] = self.decrypt_client(mes["message"].encode())
-                                self.__messages.append(mes)
-
-                case "message":
-                    message["message"] = self.decrypt_client(message['message'].encode())
-                    self.__messages.append(message)
+            for message in self._handle(byte_mes):
+                self.__deliver(message)
 
     def send_message(self, message: str) -> None:
         """
@@ -172,12 +693,7 @@ class Connection:
 
         :param message: the message to send
         """
-        mes = {
-            "type": "message",
-            "message": self.encrypt_client(message).decode(),
-            "time": str(Daytime.now())
-        }
-        send_long(self.__server, self.encrypt(mes))
+        self._send(self._message_request(message))
 
     def end(self) -> None:
         """
@@ -185,15 +701,273 @@ class Connection:
         """
         with suppress(Exception):
             self.send_message(BYE_MES)
-            self.__server.send(self.encrypt({
-                "type": "action",
-                "action": "end"
-            }))
+            self._send(self._end_request())
+
+        self.__close()
+
+    def __close(self) -> None:
+        """
+        close the socket and end all threads (without logging out)
+        """
+        with suppress(Exception):
+            # wakes up the receiving thread
+            self.__server.shutdown(socket.SHUT_RDWR)
             self.__server.close()
 
             # threads
-            self.running = False
+            self.__stop()
+            self._cancel_decryption()
             self.__pool.shutdown(wait=True)
 
+    def reconnect(self) -> "Connection":
+        """
+        connect again after the connection dropped. Within the ticket lifetime the session is resumed:
+        no join / leave message, only the missed messages are loaded. The callbacks and the messages
+        not taken yet are kept
+
+        :return: the new connection
+        """
+        self.__close()
+        connection = Connection(*self.__address, *self._resume_arguments())
+        for callback in self.__callbacks:
+            connection.add_callback(callback)
+
+        # the messages not taken yet come before the ones the new connection received
+        with connection.__messages_available:
+            pending = list(self.__messages) + list(connection.__messages)
+            connection.__messages.clear()
+            connection.__messages.extend(pending)
+            connection.__messages_available.notify_all()
+
+        self.__messages.clear()
+        return connection
+
     def __del__(self) -> None:
         self.end()
+
+
+class AsyncConnection(_Session):
+    def __init__(
+            self,
+            username: str,
+            server_secret: bytes | str,
+            clients_secret: bytes | str,
+            last_id: int = -1,
+            ticket: str | None = None
+    ) -> None:
+        """
+        connection to a server using asyncio streams, connect with AsyncConnection.connect.
+        A single event loop can run thousands of them:
+
+            async with await AsyncConnection(username, server_secret, clients_secret).connect(ip, port) as c:
+                await c.send_message("hi")
+                async for message in c:
+                    ...
+
+        :param username: username, different for every client (identification for other clients)
+        :param server_secret: Your custom secret key
+        :param clients_secret: the secret the message texts are encrypted with
+        :param last_id: id of the newest message already received (when reconnecting), older ones aren't loaded again
+        :param ticket: session ticket of the previous connection (when reconnecting), see AsyncConnection.reconnect
+        """
+        super().__init__(username, server_secret, clients_secret, last_id, ticket)
+        self.running = False
+        self.__address: tuple | None = None
+
+        self.__reader: asyncio.StreamReader | None = None
+        self.__writer: asyncio.StreamWriter | None = None
+        self.__receive_task: asyncio.Task | None = None
+        self.__messages: asyncio.Queue | None = None
+
+    async def connect(self, ip: str, port: int) -> "AsyncConnection":
+        """
+        connect and log in
+
+        :param ip: The ip of the Server
+        :param port: The port the Server runs on
+        :return: the connection itself
+        """
+        self.__address = ip, port
+        try:
+            self.__reader, self.__writer = await asyncio.open_connection(ip, port)
+
+        except socket.gaierror:
+            raise ConnectionError("Invalid ip")
+
+        except ConnectionRefusedError:
+            raise ConnectionRefusedError("Server not running on targeted ip")
+
+        # send the initial message and validate the answer
+        if self.codec.framed_handshake:
+            self._send(self.login_request())
+            self.login(await self.__read_frame())
+
+        else:
+            self.__writer.write(self.login_request())
+            self.login(await self.__reader.read(2048))
+
+        self.running = True
+        self.__messages = asyncio.Queue(maxsize=self.inbox_size)
+        self.__receive_task = asyncio.get_running_loop().create_task(self.__receive())
+
+        # only the missed messages are loaded, a resumed session doesn't join again
+        self.request_history(since=self.last_id)
+        if not self.resumed:
+            await self.send_message(HELLO_MES)
+
+        return self
+
+    async def __read_frame(self) -> bytes:
+        (length,) = struct.unpack('>Q', await self.__reader.readexactly(8))
+        if length > MAX_FRAME_SIZE:
+            raise FrameTooLarge(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes")
+
+        return await self.__reader.readexactly(length)
+
+    def _send(self, data: bytes) -> None:
+        """
+        queue a frame in the stream (sent by the event loop)
+        """
+        self.__writer.writelines((struct.pack('>Q', len(data)), data))
+
+    def _call_later(self, delay: float, func, *args) -> None:
+        def run() -> None:
+            if self.running:
+                func(*args)
+
+        asyncio.get_running_loop().call_later(delay, run)
+
+    async def __receive(self) -> None:
+        """
+        receive and process incoming messages from the server
+        """
+        try:
+            while self.running:
+                for message in self._handle(await self.__read_frame()):
+                    # drop the oldest message if nobody takes them
+                    if self.__messages.full():
+                        self.__messages.get_nowait()
+
+                    self.__messages.put_nowait(message)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # connection closed by the server or invalid frame
+            pass
+
+        finally:
+            self.running = False
+            if self.__messages.full():
+                self.__messages.get_nowait()
+
+            # wakes up everyone waiting for messages
+            self.__messages.put_nowait(None)
+
+    async def get_message(self, timeout: float | None = None) -> dict | None:
+        """
+        wait for the next new message
+
+        :param timeout: in seconds, None to wait until there is one
+        :return: the message, None if the timeout passed or the connection ended
+        """
+        try:
+            message = await asyncio.wait_for(self.__messages.get(), timeout)
+
+        except asyncio.TimeoutError:
+            return None
+
+        if message is None:
+            # keep the end marker for the others
+            self.__messages.put_nowait(None)
+
+        return message
+
+    def __aiter__(self) -> "AsyncConnection":
+        return self
+
+    async def __anext__(self) -> dict:
+        message = await self.get_message()
+        if message is None:
+            raise StopAsyncIteration
+
+        return message
+
+    async def send_message(self, message: str) -> None:
+        """
+        send a message to the server
+
+        :param message: the message to send
+        """
+        self._send(self._message_request(message))
+        await self.__writer.drain()
+
+    async def end(self) -> None:
+        """
+        cuts the connection to the server
+        """
+        if self.__writer is None or self.__writer.is_closing():
+            return
+
+        with suppress(Exception):
+            await self.send_message(BYE_MES)
+            self._send(self._end_request())
+            await self.__writer.drain()
+
+        await self.__close()
+
+    async def __close(self) -> None:
+        """
+        close the stream and stop receiving (without logging out)
+        """
+        self.running = False
+        self.__writer.close()
+        with suppress(Exception):
+            await self.__writer.wait_closed()
+
+        if self.__receive_task is not None:
+            self.__receive_task.cancel()
+            # the task may have ended with the error that dropped the connection
+            with suppress(asyncio.CancelledError, ConnectionError, OSError):
+                await self.__receive_task
+
+        self._cancel_decryption()
+
+    async def reconnect(self) -> "AsyncConnection":
+        """
+        connect again after the connection dropped. Within the ticket lifetime the session is resumed:
+        no join / leave message, only the missed messages are loaded. The messages not taken yet are kept
+
+        :return: the new connection
+        """
+        if self.__writer is not None and not self.__writer.is_closing():
+            await self.__close()
+
+        connection = await AsyncConnection(*self._resume_arguments()).connect(*self.__address)
+
+        # the messages not taken yet come before the ones the new connection received
+        pending = self.__take_all() + connection.__take_all()
+        if not connection.running:
+            # keep the end marker
+            pending = pending[-(connection.inbox_size - 1):] + [None]
+
+        for message in pending[-connection.inbox_size:]:
+            connection.__messages.put_nowait(message)
+
+        return connection
+
+    def __take_all(self) -> list[dict]:
+        """
+        empty the queue of received messages (without the end marker)
+        """
+        messages = []
+        while self.__messages is not None and not self.__messages.empty():
+            message = self.__messages.get_nowait()
+            if message is not None:
+                messages.append(message)
+
+        return messages
+
+    async def __aenter__(self) -> "AsyncConnection":
+        return self
+
+    async def __aexit__(self, *_exc) -> None:
+        await self.end()
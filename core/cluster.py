@@ -0,0 +1,366 @@
+"""
+cluster.py
+Run the server in multiple processes (one per CPU core) accepting on the same port
+
+The processes ("shards") are connected to the main process through a Unix socket (the bus):
+    - every shard asks the bus before logging in a user, so a username can only be online once
+    - new messages are sent to the bus, which numbers them and sends them to every shard
+      in the same order, so every shard has the same history
+    - the main process collects the statistics of every shard over the bus (see Cluster.stats)
+
+Author:
+Nilusink
+"""
+from core.protocol import BinaryCodec, ProtocolError
+from core.metrics import METRICS
+from core import send_long, FrameReader, print_traceback
+
+from typing import Callable, Dict, Any, List
+from contextlib import suppress
+import multiprocessing
+import threading
+import tempfile
+import signal
+import socket
+import time
+import sys
+import os
+
+
+class BusHub:
+    def __init__(self, path: str) -> None:
+        """
+        the bus, runs in the main process
+
+        :param path: path of the Unix socket
+        """
+        self.path = path
+
+        self.__claims: Dict[str, socket.socket] = {}
+        self.__subscribers: List[socket.socket] = []
+        self.__lock = threading.Lock()
+        self.__next_id: int = time.time_ns() // 1000
+
+        # statistics of the shards, collected by BusHub.stats
+        self.__stats: Dict[str, Any] = {}
+        self.__stats_request: int = 0
+        self.__stats_lock = threading.Lock()
+        self.__stats_ready = threading.Condition()
+
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(path)
+        self.__server.listen()
+        self.running = True
+
+    def serve(self) -> None:
+        """
+        accept shard connections until BusHub.end is called
+        """
+        while self.running:
+            try:
+                connection, _ = self.__server.accept()
+
+            except OSError:
+                return
+
+            threading.Thread(target=self.__handle, args=(connection,), daemon=True).start()
+
+    @print_traceback
+    def __handle(self, connection: socket.socket) -> None:
+        reader = FrameReader(connection, 1_000_000)
+        try:
+            while self.running:
+                frame = reader.receive()
+                try:
+                    self.__process(connection, BinaryCodec.loads(frame))
+
+                except (ProtocolError, KeyError, TypeError) as error:
+                    # an invalid request is dropped, the other users of the shard stay connected
+                    print(f"Invalid bus request: {error!r}")
+
+        except (ConnectionError, OSError):
+            pass
+
+        finally:
+            # a shard died, its users aren't online anymore
+            with self.__lock:
+                for username in [name for name, owner in self.__claims.items() if owner is connection]:
+                    del self.__claims[username]
+
+                if connection in self.__subscribers:
+                    self.__subscribers.remove(connection)
+
+            connection.close()
+
+    def __process(self, connection: socket.socket, request: Dict[str, Any]) -> None:
+        """
+        process one request of a shard
+        """
+        match request["op"]:
+            case "subscribe":
+                with self.__lock:
+                    self.__subscribers.append(connection)
+
+            case "claim":
+                with self.__lock:
+                    success = request["username"] not in self.__claims
+                    if success:
+                        self.__claims[request["username"]] = connection
+
+                send_long(connection, BinaryCodec.dumps({"success": success}))
+
+            case "release":
+                with self.__lock:
+                    if self.__claims.get(request["username"]) is connection:
+                        del self.__claims[request["username"]]
+
+            case "online":
+                send_long(connection, BinaryCodec.dumps({"online": request["username"] in self.__claims}))
+
+            case "message":
+                self.__publish(request["entry"])
+
+            case "stats":
+                with self.__stats_ready:
+                    if request["request"] == self.__stats_request:
+                        self.__stats[str(request["pid"])] = request["stats"]
+                        self.__stats_ready.notify_all()
+
+    def __publish(self, entry: Dict[str, Any]) -> None:
+        """
+        number a message and send it to every shard (under the lock, so every shard gets the same order)
+        """
+        with self.__lock:
+            # raises before the id is used if the entry can't be encoded
+            frame = BinaryCodec.dumps({"op": "message", "entry": entry, "id": self.__next_id})
+            self.__next_id += 1
+            self.__send_all(frame)
+
+    def __send_all(self, frame: bytes) -> None:
+        """
+        send a frame to every shard (call with the lock held)
+        """
+        for subscriber in self.__subscribers:
+            with suppress(OSError):
+                send_long(subscriber, frame)
+
+    def stats(self, timeout: float = 1.0) -> Dict[str, Any]:
+        """
+        collect the statistics of every shard
+
+        :param timeout: in seconds, how long to wait for the shards to answer
+        :return: the statistics (METRICS.snapshot()) of every shard that answered, by process id
+        """
+        with self.__stats_lock:
+            with self.__stats_ready:
+                self.__stats_request += 1
+                self.__stats = {}
+
+            with self.__lock:
+                shards = len(self.__subscribers)
+                self.__send_all(BinaryCodec.dumps({"op": "stats", "request": self.__stats_request}))
+
+            with self.__stats_ready:
+                self.__stats_ready.wait_for(lambda: len(self.__stats) >= shards, timeout)
+                return dict(self.__stats)
+
+    def end(self) -> None:
+        self.running = False
+        with suppress(OSError):
+            self.__server.close()
+
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+class ShardBus:
+    def __init__(self, path: str, deliver: Callable[[Dict[str, Any], int], None]) -> None:
+        """
+        connection of a shard to the bus
+
+        :param path: path of the Unix socket
+        :param deliver: called (from the bus thread) with every message and its id
+        """
+        self.__deliver = deliver
+
+        # requests that need an answer, one at a time
+        self.__rpc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__rpc.connect(path)
+        self.__rpc_reader = FrameReader(self.__rpc, 1024)
+        self.__rpc_lock = threading.Lock()
+
+        # messages from the bus
+        self.__events = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__events.connect(path)
+        send_long(self.__events, BinaryCodec.dumps({"op": "subscribe"}))
+        threading.Thread(target=self.__receive, daemon=True).start()
+
+    @print_traceback
+    def __receive(self) -> None:
+        reader = FrameReader(self.__events, sys.maxsize)
+        with suppress(ConnectionError, OSError):
+            while True:
+                event = BinaryCodec.loads(reader.receive())
+                match event["op"]:
+                    case "message":
+                        self.__deliver(event["entry"], event["id"])
+
+                    case "stats":
+                        # answered on the same connection (only written by this thread)
+                        send_long(self.__events, BinaryCodec.dumps({
+                            "op": "stats",
+                            "request": event["request"],
+                            "pid": os.getpid(),
+                            "stats": METRICS.snapshot()
+                        }))
+
+    def __request(self, request: Dict[str, Any], reply: bool = True) -> Dict[str, Any] | None:
+        with self.__rpc_lock:
+            send_long(self.__rpc, BinaryCodec.dumps(request))
+            if reply:
+                return BinaryCodec.loads(self.__rpc_reader.receive())
+
+        return None
+
+    def claim(self, username: str) -> bool:
+        """
+        mark username as online in all shards
+
+        :return: False if the user is already online (in any shard)
+        """
+        return self.__request({"op": "claim", "username": username})["success"]
+
+    def release(self, username: str) -> None:
+        # if the bus is gone, it already released every user of this shard
+        with suppress(OSError):
+            self.__request({"op": "release", "username": username}, reply=False)
+
+    def is_online(self, username: str) -> bool:
+        return self.__request({"op": "online", "username": username})["online"]
+
+    def publish(self, entry: Dict[str, Any]) -> None:
+        """
+        send a new message to every shard (including this one)
+
+        :param entry: the history entry (message, time, user)
+        :raises ProtocolError: if the entry can't be encoded (nothing is sent to the bus)
+        """
+        self.__request({"op": "message", "entry": entry}, reply=False)
+
+    def close(self) -> None:
+        for connection in (self.__rpc, self.__events):
+            with suppress(OSError):
+                connection.shutdown(socket.SHUT_RDWR)
+
+            connection.close()
+
+
+def _run_shard(bus_path: str, engine_class: type, port: int, server_secret: bytes, room_key: bool) -> None:
+    """
+    entry point of a shard process
+    """
+    from core.server import RUNNING_CLIENTS, deliver_message
+
+    serv = engine_class(port=port, server_secret=server_secret, reuse_port=True)
+
+    # the asyncio engine may only touch its users from within the event loop
+    if hasattr(serv, "call_soon_threadsafe"):
+        def deliver(entry: Dict[str, Any], message_id: int) -> None:
+            serv.call_soon_threadsafe(deliver_message, entry, message_id)
+
+    else:
+        deliver = deliver_message
+
+    RUNNING_CLIENTS.bus = ShardBus(bus_path, deliver)
+    if room_key:
+        RUNNING_CLIENTS.enable_room_key()
+
+    def term_func(*_sign) -> None:
+        # receive_clients returns once the server stopped
+        serv.end()
+
+    signal.signal(signal.SIGTERM, term_func)
+    signal.signal(signal.SIGINT, term_func)
+
+    print(f"Shard {os.getpid()} running")
+    serv.receive_clients()
+    RUNNING_CLIENTS.bus.close()
+
+
+class Cluster:
+    def __init__(
+            self,
+            port: int,
+            server_secret: bytes,
+            engine_class: type,
+            workers: int | None = None,
+            room_key: bool = False
+    ) -> None:
+        """
+        run engine_class in multiple processes, all accepting on port (SO_REUSEPORT)
+
+        :param port: the port to run on
+        :param server_secret: Your custom secret key
+        :param engine_class: the server engine (Connection or AsyncConnection)
+        :param workers: number of processes, defaults to the number of CPU cores
+        :param room_key: enable the room key in every shard (each shard has its own)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.running = True
+
+        self.__hub = BusHub(os.path.join(tempfile.gettempdir(), f"securemess-{os.getpid()}.sock"))
+        self.__hub_thread = threading.Thread(target=self.__hub.serve, daemon=True)
+
+        # forked (not spawned) so the shards don't run the main script again
+        context = multiprocessing.get_context("fork")
+        self.__processes = [
+            context.Process(
+                target=_run_shard,
+                args=(self.__hub.path, engine_class, port, server_secret, room_key),
+                daemon=True
+            )
+            for _ in range(self.workers)
+        ]
+
+    def receive_clients(self, thread: bool = False) -> None:
+        """
+        start the bus and the shards
+
+        :param thread: return right away instead of waiting for the shards to exit (see Cluster.join)
+        """
+        # fork before starting any threads
+        for process in self.__processes:
+            process.start()
+
+        self.__hub_thread.start()
+
+        if not thread:
+            self.join()
+
+    def join(self) -> None:
+        """
+        wait for the shards to exit
+        """
+        for process in self.__processes:
+            process.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        the statistics of every shard (the main process has no users), for StatsServer
+        """
+        return {"shards": self.__hub.stats()}
+
+    def end(self) -> None:
+        self.running = False
+        for process in self.__processes:
+            if process.is_alive():
+                process.terminate()
+
+        for process in self.__processes:
+            if process.pid is not None:
+                process.join(timeout=5)
+
+        self.__hub.end()
@@ -0,0 +1,137 @@
+"""
+compression.py
+Optional compression of the (unencrypted) frame contents, negotiated in the handshake
+
+A compressed frame looks like this (compressed before encrypting):
+    magic (b"SZ"), algorithm (1 byte), compressed frame
+
+Uncompressed frames never start with b"SZ" (version 1 starts with the UTF-32 BOM, version 2 with b"SM"),
+so small frames are just sent as they are.
+
+Author:
+Nilusink
+"""
+from core.protocol import ProtocolError
+
+from functools import lru_cache
+from typing import Any, Dict
+import zlib
+import lzma
+import bz2
+
+
+MAGIC: bytes = b"SZ"
+
+# name: (id, compress(data, level), decompressor)
+ALGORITHMS = {
+    "zlib": (1, lambda data, level: zlib.compress(data, level), zlib.decompressobj),
+    "bz2": (2, lambda data, level: bz2.compress(data, level), bz2.BZ2Decompressor),
+    "lzma": (3, lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor),
+}
+_BY_ID = {algorithm_id: name for name, (algorithm_id, _, _) in ALGORITHMS.items()}
+
+DEFAULT_LEVEL: int = 6
+DEFAULT_THRESHOLD: int = 1024  # in bytes, smaller frames aren't compressed
+
+
+class Compression:
+    def __init__(self, algorithm: str | None = None, level: int = DEFAULT_LEVEL, threshold: int = DEFAULT_THRESHOLD) -> None:
+        """
+        compression settings of one connection, use compression() to share equal instances
+
+        :param algorithm: one of ALGORITHMS, None to not compress
+        :param level: compression level (1-9)
+        :param threshold: in bytes, smaller frames aren't compressed
+        """
+        if algorithm is not None and algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown compression algorithm: {algorithm}")
+
+        self.algorithm = algorithm
+        self.level = min(max(int(level), 1), 9)
+        self.threshold = max(int(threshold), 0)
+
+        self.__header = MAGIC + bytes((ALGORITHMS[algorithm][0],)) if algorithm is not None else b""
+
+    def settings(self) -> Dict[str, Any]:
+        """
+        the settings as sent in the handshake
+        """
+        return {"algorithm": self.algorithm, "level": self.level, "threshold": self.threshold}
+
+    def pack(self, data: bytes) -> bytes:
+        """
+        compress an encoded frame (if compression is enabled and the frame is big enough)
+        """
+        if self.algorithm is None or len(data) < self.threshold:
+            return data
+
+        compressed = ALGORITHMS[self.algorithm][1](data, self.level)
+        if len(compressed) + len(self.__header) >= len(data):
+            return data
+
+        return self.__header + compressed
+
+    @staticmethod
+    def unpack(data: bytes, max_size: int) -> bytes:
+        """
+        decompress a frame, uncompressed frames are returned as they are
+
+        :param data: the decrypted frame
+        :param max_size: the biggest allowed frame after decompressing
+        """
+        if data[:2] != MAGIC:
+            return data
+
+        try:
+            decompressor = ALGORITHMS[_BY_ID[data[2]]][2]()
+            result = decompressor.decompress(data[3:], max_size)
+
+        except (KeyError, IndexError):
+            raise ProtocolError("Unknown compression algorithm")
+
+        except (zlib.error, lzma.LZMAError, OSError, EOFError) as error:
+            raise ProtocolError(f"Invalid compressed frame: {error}")
+
+        # not at the end means the frame is either truncated or bigger than max_size
+        if not decompressor.eof:
+            raise ProtocolError(f"Compressed frame invalid or bigger than {max_size} bytes")
+
+        return result
+
+
+@lru_cache(maxsize=64)
+def compression(algorithm: str | None = None, level: int = DEFAULT_LEVEL, threshold: int = DEFAULT_THRESHOLD) -> Compression:
+    """
+    the (shared) Compression with these settings, frames for connections with equal settings are only compressed once
+    """
+    return Compression(algorithm, level, threshold)
+
+
+NO_COMPRESSION = compression()
+
+
+def negotiate(offer: Dict[str, Any] | None, max_levels: Dict[str, int], threshold: int = DEFAULT_THRESHOLD) -> Compression:
+    """
+    pick the compression for a connection from the clients offer in the handshake
+
+    the server decides how expensive compressing may get: the client may only ask for a lower level than
+    allowed and the threshold is always the servers, so clients only ever end up with a few shared settings
+
+    :param offer: {"algorithms": [...] (preferred first), "level": ...}
+    :param max_levels: {algorithm: highest level} of the algorithms the server allows
+    :param threshold: in bytes, smaller frames aren't compressed
+    """
+    if not isinstance(offer, dict):
+        return NO_COMPRESSION
+
+    try:
+        for algorithm in offer.get("algorithms", ()):
+            if algorithm in max_levels and algorithm in ALGORITHMS:
+                max_level = max_levels[algorithm]
+                return compression(algorithm, min(int(offer.get("level", max_level)), max_level), threshold)
+
+    except (TypeError, ValueError):
+        # invalid offer, just don't compress
+        pass
+
+    return NO_COMPRESSION
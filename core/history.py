@@ -0,0 +1,172 @@
+"""
+history.py
+Message history of the server
+
+Author:
+Nilusink
+"""
+from core.storage import SegmentLog
+from core.protocol import BinaryCodec
+
+from collections import deque
+from typing import Deque, Tuple
+import threading
+import time
+import sys
+
+
+def entry_size(message: dict) -> int:
+    """
+    approximate memory used by one history entry (the keys are shared by all entries and not counted)
+
+    :param message: the history entry
+    """
+    return sys.getsizeof(message) + sum(sys.getsizeof(value) for value in message.values())
+
+
+class MessageHistory:
+    def __init__(self, max_size: int) -> None:
+        """
+        thread safe message history, keeps the newest messages that fit in max_size bytes.
+        Every message gets a sequence number ("id"), used by clients as cursor
+
+        :param max_size: maximum size of all entries in bytes
+        """
+        self.max_size = max_size
+        self.evicted: int = 0
+
+        self.__messages: Deque[Tuple[dict, int]] = deque()
+        self.__size: int = 0
+        self.__lock = threading.Lock()
+        self.__log: SegmentLog | None = None
+
+        # without a log the history starts empty on every restart, starting
+        # at the current time keeps the ids increasing across restarts
+        self.__next_id: int = time.time_ns() // 1000
+
+    @property
+    def log(self) -> SegmentLog | None:
+        return self.__log
+
+    @property
+    def next_id(self) -> int:
+        """
+        the id the next message will get
+        """
+        return self.__next_id
+
+    def attach(self, log: SegmentLog) -> None:
+        """
+        store every new message in log and replace the messages in memory with the newest logged ones
+
+        :param log: the log to use
+        """
+        with self.__lock:
+            # a new log continues after the ids already handed out (they start at the current time)
+            if log.next_sequence == log.first_sequence and log.next_sequence < self.__next_id:
+                log.start_at(self.__next_id)
+
+            loaded: list[Tuple[dict, int]] = []
+            size = 0
+            for sequence in range(log.next_sequence - 1, log.first_sequence - 1, -1):
+                message = BinaryCodec.loads(log.read(sequence))
+                message_size = entry_size(message)
+                if size + message_size > self.max_size:
+                    break
+
+                loaded.append((message, message_size))
+                size += message_size
+
+            self.__messages = deque(reversed(loaded))
+            self.__size = size
+            self.__next_id = log.next_sequence
+            self.__log = log
+
+    @property
+    def size(self) -> int:
+        """
+        current size of all entries in bytes
+        """
+        return self.__size
+
+    def append(self, message: dict, message_id: int | None = None) -> int:
+        """
+        add a message, if the history gets too big the oldest messages are deleted
+
+        :param message: the message to add, its "id" is set
+        :param message_id: use this id instead of the next one (ids assigned by the cluster bus, not used with a log)
+        :return: the id of the message
+        """
+        with self.__lock:
+            if self.__log is not None:
+                # logged first, the log numbers the messages (if encoding or writing fails, no id is used up)
+                message_id = self.__log.append(BinaryCodec.dumps({**message, "id": self.__log.next_sequence}))
+
+            elif message_id is None:
+                message_id = self.__next_id
+
+            message["id"] = message_id
+            self.__next_id = message_id + 1
+            size = entry_size(message)
+            self.__messages.append((message, size))
+            self.__size += size
+
+            while self.__size > self.max_size and self.__messages:
+                _, old_size = self.__messages.popleft()
+                self.__size -= old_size
+                self.evicted += 1
+
+            return message["id"]
+
+    def snapshot(self) -> list[dict]:
+        """
+        all messages currently in the history, oldest first
+        """
+        with self.__lock:
+            return [message for message, _ in self.__messages]
+
+    def page(self, since: int = -1, before: int | None = None, limit: int = 100) -> Tuple[list[dict], bool]:
+        """
+        the newest messages with since < id < before, older messages are read from the log if needed
+
+        :param since: id of the last message the client already has
+        :param before: only messages older than this id (for requesting the next page)
+        :param limit: maximum number of messages returned
+        :return: the messages (oldest first) and if there are more (older) messages in the range
+        """
+        result: list[dict] = []
+        with self.__lock:
+            stop = self.__next_id if before is None else min(before, self.__next_id)
+            first_in_memory = self.__messages[0][0]["id"] if self.__messages else self.__next_id
+
+            # newest messages come from memory
+            for message, _ in reversed(self.__messages):
+                if len(result) >= limit or message["id"] <= since:
+                    break
+
+                if message["id"] < stop:
+                    result.append(message)
+
+            # older ones from the log
+            oldest = self.__log.first_sequence if self.__log is not None else first_in_memory
+            sequence = min(stop, first_in_memory) - 1
+            while len(result) < limit and sequence > since and sequence >= oldest:
+                result.append(BinaryCodec.loads(self.__log.read(sequence)))
+                sequence -= 1
+
+            if result:
+                more = result[-1]["id"] - 1 > max(since, oldest - 1)
+
+            else:
+                more = False
+
+        result.reverse()
+        return result, more
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__messages.clear()
+            self.__size = 0
+
+    def __len__(self) -> int:
+        return len(self.__messages)
@@ -0,0 +1,182 @@
+"""
+metrics.py
+Counters and histograms of the server, cheap enough to always be collected
+
+METRICS.snapshot() returns everything as a dictionary, it is served by StatsServer (HTTP, localhost only)
+and the "stats" admin action. StatsServer also serves the sampled frame traces and runs the profiler (tracing.py).
+
+Author:
+Nilusink
+"""
+from core.tracing import TRACER, profile
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import Callable, Dict, Any
+import threading
+import json
+import time
+
+
+# counters and histograms are updated without locks (they are on the hot path), with multiple threads
+# an update can rarely be lost when the GIL switches threads in the middle of it, good enough for statistics
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value: int = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    def __init__(self, unit: str = "us") -> None:
+        """
+        histogram with power of two buckets (bucket i counts values < 2**i)
+
+        :param unit: unit of the observed values (only used for the snapshot)
+        """
+        self.unit = unit
+        self.count: int = 0
+        self.sum: int = 0
+        self.max: int = 0
+        self.__buckets = [0] * 64
+
+    def observe(self, value: int) -> None:
+        """
+        :param value: a non-negative integer
+        """
+        self.__buckets[value.bit_length() if value < 2 ** 63 else 63] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> int:
+        """
+        upper bound of the bucket the percentile lies in
+        """
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.__buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** bucket, self.max)
+
+        return 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "unit": self.unit,
+            "count": self.count,
+            "mean": round(self.sum / self.count, 1) if self.count else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        """
+        registry of all counters, histograms and gauges (values computed when taking a snapshot)
+        """
+        self.started = time.time()
+        self.__counters: Dict[str, Counter] = {}
+        self.__histograms: Dict[str, Histogram] = {}
+        self.__gauges: Dict[str, Callable[[], Any]] = {}
+
+    def counter(self, name: str) -> Counter:
+        """
+        the counter called name, created if it doesn't exist
+        """
+        return self.__counters.setdefault(name, Counter())
+
+    def histogram(self, name: str, unit: str = "us") -> Histogram:
+        """
+        the histogram called name, created if it doesn't exist
+        """
+        return self.__histograms.setdefault(name, Histogram(unit))
+
+    def gauge(self, name: str, func: Callable[[], Any]) -> None:
+        """
+        report the result of func as name
+        """
+        self.__gauges[name] = func
+
+    def snapshot(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"uptime": round(time.time() - self.started, 1)}
+        result.update({name: counter.value for name, counter in self.__counters.items()})
+        result.update({name: histogram.snapshot() for name, histogram in self.__histograms.items()})
+        for name, func in self.__gauges.items():
+            try:
+                result[name] = func()
+
+            except Exception as error:
+                result[name] = f"error: {error}"
+
+        return result
+
+
+METRICS = Metrics()
+
+MAX_PROFILE_TIME: float = 300  # in seconds, longest profile that can be requested over HTTP
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        match url.path.rstrip("/"):
+            case "" | "/stats":
+                self.__reply(json.dumps(self.server.snapshot(), indent=2).encode(), "application/json")
+
+            case "/trace":
+                self.__reply(json.dumps(TRACER.chrome_trace()).encode(), "application/json")
+
+            case "/profile":
+                try:
+                    seconds = float(parse_qs(url.query).get("seconds", ["10"])[0])
+
+                except ValueError:
+                    self.send_error(400)
+                    return
+
+                self.__reply(profile(min(max(seconds, 0), MAX_PROFILE_TIME)).encode(), "text/plain")
+
+            case _:
+                self.send_error(404)
+
+    def __reply(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args) -> None:
+        # no line per request
+        pass
+
+
+class StatsServer:
+    def __init__(self, port: int, host: str = "127.0.0.1", snapshot: Callable[[], Dict[str, Any]] | None = None) -> None:
+        """
+        serve METRICS.snapshot() as JSON (GET /stats), the frame traces (GET /trace) and
+        profiles (GET /profile?seconds=10), only on localhost by default
+
+        :param port: the port to run on
+        :param host: the interface to bind to
+        :param snapshot: serve its result instead of METRICS.snapshot() (e.g. Cluster.stats)
+        """
+        self.__server = ThreadingHTTPServer((host, port), _StatsHandler)
+        self.__server.daemon_threads = True
+        self.__server.snapshot = snapshot or METRICS.snapshot
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    def end(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
@@ -0,0 +1,263 @@
+"""
+protocol.py
+Encodings used for the (unencrypted) frame contents
+
+Version 1.0.0: JSON, encoded as UTF-32
+Version 2.0.0: compact binary encoding, a frame looks like this:
+    header: magic (b"SM"), version (1 byte), flags (1 byte)
+    body:   one value, every value starts with a type tag (1 byte):
+        N: None, T: True, F: False
+        i: int64
+        f: float64
+        s: str (4 byte length + UTF-8)
+        b: bytes (4 byte length + raw bytes)
+        l: list (4 byte count + values)
+        d: dict (4 byte count + (2 byte key length + UTF-8 key + value) pairs)
+
+The end-to-end encrypted message text is carried as the raw bytes of its Fernet token
+(see blob_from_token), JSON sends them as the usual base64 token string.
+
+Author:
+Nilusink
+"""
+from typing import Any, Dict
+import base64
+import struct
+import json
+
+
+MAGIC: bytes = b"SM"
+
+_HEADER = struct.Struct(">2sBB")
+_INT = struct.Struct(">q")
+_FLOAT = struct.Struct(">d")
+_LENGTH = struct.Struct(">I")
+_KEY_LENGTH = struct.Struct(">H")
+
+# dictionary keys repeat in every message, cache their encoded form
+_KEY_CACHE: Dict[str, bytes] = {}
+_KEY_CACHE_SIZE: int = 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def blob_from_token(token: bytes | str) -> bytes:
+    """
+    convert a Fernet token to its raw (not base64 encoded) bytes
+    """
+    return base64.urlsafe_b64decode(token)
+
+
+def token_from_blob(blob: bytes) -> bytes:
+    """
+    convert raw bytes back to a Fernet token
+    """
+    return base64.urlsafe_b64encode(blob)
+
+
+def _json_default(value: Any) -> str:
+    """
+    JSON has no binary type, blobs are sent as token strings
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return token_from_blob(value).decode()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    """
+    protocol version 1.0.0
+    """
+    version = "1.0.0"
+    framed_handshake = False
+
+    @staticmethod
+    def dumps(message: Any) -> bytes:
+        return json.dumps(message, default=_json_default).encode("utf-32")
+
+    @staticmethod
+    def loads(data: bytes) -> Any:
+        try:
+            return json.loads(data.decode("utf-32"))
+
+        except (ValueError, RecursionError) as error:
+            raise ProtocolError(f"Malformed frame: {error}")
+
+
+def _encode_key(key: str) -> bytes:
+    try:
+        return _KEY_CACHE[key]
+
+    except KeyError:
+        raw = key.encode()
+        encoded = _KEY_LENGTH.pack(len(raw)) + raw
+        if len(_KEY_CACHE) < _KEY_CACHE_SIZE:
+            _KEY_CACHE[key] = encoded
+
+        return encoded
+
+
+def _encode(value: Any, parts: list) -> None:
+    """
+    append the encoded value to parts
+    """
+    if isinstance(value, str):
+        raw = value.encode()
+        parts.append(b"s" + _LENGTH.pack(len(raw)))
+        parts.append(raw)
+
+    elif isinstance(value, dict):
+        parts.append(b"d" + _LENGTH.pack(len(value)))
+        for key, item in value.items():
+            parts.append(_encode_key(key))
+            _encode(item, parts)
+
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(b"b" + _LENGTH.pack(len(value)))
+        parts.append(value)
+
+    elif value is None:
+        parts.append(b"N")
+
+    elif value is True:
+        parts.append(b"T")
+
+    elif value is False:
+        parts.append(b"F")
+
+    elif isinstance(value, int):
+        try:
+            parts.append(b"i" + _INT.pack(value))
+
+        except struct.error:
+            raise ProtocolError(f"Integer out of the int64 range: {value}")
+
+    elif isinstance(value, float):
+        parts.append(b"f" + _FLOAT.pack(value))
+
+    elif isinstance(value, (list, tuple)):
+        parts.append(b"l" + _LENGTH.pack(len(value)))
+        for item in value:
+            _encode(item, parts)
+
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} can't be encoded")
+
+
+def _decode(data: bytes, offset: int) -> tuple[Any, int]:
+    """
+    decode the value starting at offset
+
+    :return: the value and the offset after it
+    """
+    tag = data[offset]
+    offset += 1
+    match tag:
+        case 0x73:  # s
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += 4
+            return data[offset:offset + length].decode(), offset + length
+
+        case 0x64:  # d
+            (count,) = _LENGTH.unpack_from(data, offset)
+            offset += 4
+            result = {}
+            for _ in range(count):
+                (length,) = _KEY_LENGTH.unpack_from(data, offset)
+                offset += 2
+                key = data[offset:offset + length].decode()
+                offset += length
+
+                # most values are strings, decode them without the extra call
+                if data[offset] == 0x73:
+                    (length,) = _LENGTH.unpack_from(data, offset + 1)
+                    offset += 5
+                    result[key] = data[offset:offset + length].decode()
+                    offset += length
+
+                else:
+                    result[key], offset = _decode(data, offset)
+
+            return result, offset
+
+        case 0x62:  # b
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += 4
+            return data[offset:offset + length], offset + length
+
+        case 0x6c:  # l
+            (count,) = _LENGTH.unpack_from(data, offset)
+            offset += 4
+            result = []
+            for _ in range(count):
+                item, offset = _decode(data, offset)
+                result.append(item)
+
+            return result, offset
+
+        case 0x4e:  # N
+            return None, offset
+
+        case 0x54:  # T
+            return True, offset
+
+        case 0x46:  # F
+            return False, offset
+
+        case 0x69:  # i
+            return _INT.unpack_from(data, offset)[0], offset + 8
+
+        case 0x66:  # f
+            return _FLOAT.unpack_from(data, offset)[0], offset + 8
+
+        case _:
+            raise ProtocolError(f"Invalid type tag: {tag}")
+
+
+class BinaryCodec:
+    """
+    protocol version 2.0.0, the handshake is sent with send_long like every other frame
+    """
+    version = "2.0.0"
+    framed_handshake = True
+
+    @staticmethod
+    def dumps(message: Any, flags: int = 0) -> bytes:
+        parts = [_HEADER.pack(MAGIC, 2, flags)]
+        _encode(message, parts)
+        return b"".join(parts)
+
+    @staticmethod
+    def loads(data: bytes) -> Any:
+        data = bytes(data)
+        try:
+            magic, version, _flags = _HEADER.unpack_from(data)
+            if magic != MAGIC or version != 2:
+                raise ProtocolError("Not a version 2 frame")
+
+            value, offset = _decode(data, _HEADER.size)
+
+        # RecursionError: too deeply nested lists / dictionaries (a few bytes per level)
+        except (struct.error, IndexError, UnicodeDecodeError, RecursionError) as error:
+            raise ProtocolError(f"Malformed frame: {error}")
+
+        if offset != len(data):
+            raise ProtocolError("Trailing data after frame")
+
+        return value
+
+
+CODECS = {
+    JsonCodec.version: JsonCodec,
+    BinaryCodec.version: BinaryCodec,
+}
+
+
+def detect(data: bytes) -> type[JsonCodec] | type[BinaryCodec]:
+    """
+    find the codec a (handshake) frame was encoded with
+    """
+    return BinaryCodec if data[:2] == MAGIC else JsonCodec
@@ -0,0 +1,578 @@
+"""
+selector_server.py
+Server engine with readiness based I/O: one thread waits for all sockets at once (selectors, epoll on Linux)
+and passes the received requests to a pool of worker threads. Speaks the same protocol as server.py
+
+Idle clients cost nothing (no thread waking up to check them) and ending the server is immediate.
+Clients that announce heartbeats in the handshake are pinged when idle and disconnected if they stop answering.
+
+Author:
+Nilusink
+"""
+from core.protocol import CODECS, JsonCodec
+from core.server import MAX_FRAME_SIZE, HANDSHAKE_WORKERS, HANDSHAKE_QUEUE, COALESCE_DELAY, COALESCE_BYTES
+from core.server import SELECTOR_WORKERS, MAX_PENDING_REQUESTS, HEARTBEAT_INTERVAL, IDLE_TIMEOUT
+from core.server import RUNNING_CLIENTS, FRAMES_IN, BYTES_IN, FRAMES_OUT, BYTES_OUT
+from core.server import Connection, Session, login_client, login_compression, send_handshake
+from core.compression import Compression, NO_COMPRESSION
+from core.metrics import METRICS
+from core.tracing import TRACER, Trace
+from core import FrameReader, RateMeter, IOV_MAX, print_traceback
+
+from cryptography.fernet import Fernet, InvalidToken
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Any, Tuple
+from collections import deque
+from contextlib import suppress
+import itertools
+import selectors
+import heapq
+import threading
+import socket
+import struct
+import time
+
+
+READ_BATCH: int = 16  # frames read from one client before the other sockets get their turn
+
+
+class SelectorUser(Session):
+    def __init__(
+            self,
+            connection: "SelectorConnection",
+            client: socket.socket,
+            default_encryption: Callable,
+            username: str,
+            codec=JsonCodec,
+            room_key: bool = False,
+            compression: Compression = NO_COMPRESSION,
+            heartbeat: bool = False,
+            key: bytes | None = None
+    ) -> None:
+        """
+        create a new client session, its socket is watched by the I/O thread of connection
+
+        :param connection: the server
+        :param client: The socket instance of the Client
+        :param default_encryption: function used to encrypt the login response
+        :param username: the name of the user
+        :param codec: the encoding matching the clients protocol version
+        :param room_key: if the client accepted broadcasts encrypted with the room key
+        :param compression: the compression negotiated with the client
+        :param heartbeat: if the client answers pings (only those are disconnected when idle)
+        :param key: the session key of a resumed session, None for a new one
+        """
+        super().__init__(username, codec, room_key, compression, key)
+        self.__connection = connection
+        self.__client = client
+        self.__reader = FrameReader(client, MAX_FRAME_SIZE)
+        self.__reader.timestamps = TRACER.rate > 0
+        self.heartbeat = heartbeat
+        self.last_received = time.monotonic()
+
+        # requests waiting for a worker, processed in order by one worker at a time
+        self.__requests: Deque[Tuple[bytes, Trace | None]] = deque()
+        self.__processing = False
+        self.__lock = threading.Lock()
+
+        # nothing is written before the login response, the I/O thread flushes once it is sent.
+        # With COALESCE_DELAY the flush waits for more frames (see SelectorUser.send_token)
+        self.__write_scheduled = True
+        self.__write_delayed = False
+        self.__queued_bytes = 0
+
+        # only used by the I/O thread
+        self.fileno = client.fileno()
+        self.reading = True
+        self.waiting_writable = False
+        self.__unsent: memoryview | None = None
+
+        response = self.register(default_encryption)
+        if not self.running:
+            send_handshake(client, response, codec)
+            client.close()
+            return
+
+        try:
+            send_handshake(client, response, codec)
+
+        except OSError:
+            self.end()
+            raise
+
+        client.setblocking(False)
+        connection.call(connection.add_user, self)
+        connection.call(self.flush)
+
+        print(f"Login: {username}")
+
+    def read(self) -> None:
+        """
+        receive the available requests and pass them to the workers (I/O thread)
+        """
+        for _ in range(READ_BATCH):
+            try:
+                frame = self.__reader.receive()
+
+            except BlockingIOError:
+                # the rest of the frame didn't arrive yet
+                return
+
+            except OSError:
+                # connection lost / invalid frame
+                self.end()
+                return
+
+            FRAMES_IN.inc()
+            BYTES_IN.inc(len(frame))
+            self.last_received = time.monotonic()
+            trace = TRACER.sample(self.__reader.started, id(self), self.username) if TRACER.rate else None
+            if trace is not None:
+                trace.mark("receive")
+
+            with self.__lock:
+                self.__requests.append((frame, trace))
+                start = not self.__processing
+                self.__processing = True
+
+                # a client sending faster than it is served has to wait (the worker resumes reading)
+                if len(self.__requests) >= MAX_PENDING_REQUESTS:
+                    self.reading = False
+
+            if start:
+                self.__connection.submit(self.__process)
+
+            if not self.reading:
+                self.__connection.update_events(self)
+                return
+
+    @print_traceback
+    def __process(self) -> None:
+        """
+        process the received requests in order (worker thread)
+        """
+        # an invalid or failing request logs the client out, it must not stay marked as processing
+        done = False
+        try:
+            while True:
+                with self.__lock:
+                    if not self.__requests or not self.running:
+                        self.__processing = False
+                        resume = not self.reading
+                        done = True
+                        break
+
+                    frame, trace = self.__requests.popleft()
+
+                if trace is not None:
+                    trace.mark("queue")
+
+                if not self.handle(frame, trace):
+                    return
+
+        finally:
+            if not done:
+                with self.__lock:
+                    self.__processing = False
+
+                self.end()
+
+        if resume and self.running:
+            self.__connection.call(self.__connection.resume_reading, self)
+
+    def flush(self, writable: bool = False) -> None:
+        """
+        send as much of the queue as the socket takes without blocking (I/O thread)
+
+        :param writable: called because the socket became writable
+        """
+        with self.__lock:
+            self.__write_scheduled = False
+            self.__write_delayed = False
+            self.__queued_bytes = 0
+
+        # the rest is sent once the socket is writable again
+        if not self.running or (self.waiting_writable and not writable):
+            return
+
+        while True:
+            if self.__unsent is not None:
+                buffers = [self.__unsent]
+                size = len(self.__unsent)
+
+            else:
+                # all queued frames in one write (up to COALESCE_BYTES)
+                buffers = []
+                size = 0
+                while size < COALESCE_BYTES and len(buffers) < IOV_MAX - 1 and (data := self.queue.pop()) is not None:
+                    buffers += (struct.pack('>Q', len(data)), data)
+                    size += 8 + len(data)
+
+                if not buffers:
+                    break
+
+            try:
+                sent = self.__client.sendmsg(buffers)
+
+            except BlockingIOError:
+                sent = 0
+
+            except OSError:
+                self.end()
+                return
+
+            if sent < size:
+                self.__unsent = memoryview(b"".join(buffers))[sent:]
+                break
+
+            self.__unsent = None
+
+        waiting = self.__unsent is not None
+        if waiting != self.waiting_writable:
+            self.waiting_writable = waiting
+            self.__connection.update_events(self)
+
+    def ping(self) -> None:
+        """
+        send a heartbeat (only if nothing else is being sent)
+        """
+        if not self.queue.depth and self.__unsent is None:
+            self.send({"type": "ping"})
+
+    def send_token(self, token: bytes) -> None:
+        """
+        queue an already encrypted frame, sent by the I/O thread
+
+        :param token: the encrypted frame
+        """
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(token))
+        if not self.queue.put(token):
+            # the client is too slow
+            self.end()
+            return
+
+        with self.__lock:
+            self.__queued_bytes += len(token)
+            full = self.__queued_bytes >= COALESCE_BYTES
+
+            # a delayed flush is brought forward once COALESCE_BYTES are queued
+            if self.__write_scheduled and not (self.__write_delayed and full):
+                return
+
+            delay = COALESCE_DELAY > 0 and not full
+            self.__write_scheduled = True
+            self.__write_delayed = delay
+
+        if delay:
+            self.__connection.call_later(COALESCE_DELAY, self.flush)
+
+        else:
+            self.__connection.call(self.flush)
+
+    def close(self) -> None:
+        """
+        close the socket (I/O thread, after it stopped watching it)
+        """
+        with suppress(OSError):
+            self.__client.shutdown(socket.SHUT_RDWR)
+
+        self.__client.close()
+
+    def end(self, wait: bool = True) -> None:
+        """
+        :param wait: only for compatibility with User.end
+        """
+        if not self.logout():
+            return
+
+        with suppress(Exception):
+            self.__connection.call(self.__connection.remove_user, self)
+
+
+class SelectorConnection:
+    protocol_version = Connection.protocol_version
+    accepted_versions = Connection.accepted_versions
+
+    def __init__(self, port: int, server_secret: bytes, reuse_port: bool = False) -> None:
+        """
+        initialize the server, create socket
+
+        :param port: the port to run on
+        :param server_secret: Your custom secret key
+        :param reuse_port: let multiple processes accept on the same port (SO_REUSEPORT)
+        """
+        # validation of the secret and creation of the Fernet object
+        try:
+            self.__fer = Fernet(server_secret)
+
+        except InvalidToken:
+            raise ValueError("Client secret not valid")
+
+        # create the socket object
+        self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.__server.bind(("0.0.0.0", port))
+        self.__server.setblocking(False)
+        self.__server.listen()
+
+        # the I/O thread waits for the sockets, other threads wake it up to run calls (see SelectorConnection.call)
+        self.__selector = selectors.DefaultSelector()
+        self.__wake_receive, self.__wake_send = socket.socketpair()
+        self.__wake_receive.setblocking(False)
+        self.__selector.register(self.__server, selectors.EVENT_READ, "accept")
+        self.__selector.register(self.__wake_receive, selectors.EVENT_READ, "wake")
+        self.__calls: Deque[Tuple[Callable, tuple]] = deque()
+        self.__timers: list[Tuple[float, int, Callable, tuple]] = []  # heap, see SelectorConnection.call_later
+        self.__timer_ids = itertools.count()
+        self.__calls_lock = threading.Lock()
+        self.__woken = False
+        self.__io_thread: int | None = None
+        self.__users: set[SelectorUser] = set()
+
+        # store reused variables
+        self.__secret = server_secret
+        self.running = True
+        self.__pool = None
+        self.__workers = ThreadPoolExecutor(max_workers=SELECTOR_WORKERS)
+        self.__login_pool = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS)
+        self.__login_slots = threading.BoundedSemaphore(HANDSHAKE_QUEUE)
+        self.__login_lock = threading.Lock()
+        self.__accepting = True
+        self.logins = RateMeter()
+        METRICS.gauge("logins_per_second", lambda: round(self.logins.rate, 2))
+
+    @property
+    def secret(self) -> bytes:
+        return self.__secret
+
+    def call(self, func: Callable, *args) -> None:
+        """
+        run func in the I/O thread (directly if called from it or if it isn't running)
+        """
+        if self.__io_thread is None or self.__io_thread == threading.get_ident():
+            func(*args)
+            return
+
+        with self.__calls_lock:
+            self.__calls.append((func, args))
+            if self.__woken:
+                return
+
+            self.__woken = True
+
+        with suppress(OSError):
+            self.__wake_send.send(b"\x00")
+
+    def call_later(self, delay: float, func: Callable, *args) -> None:
+        """
+        run func in the I/O thread after delay seconds
+        """
+        timer = time.monotonic() + delay, next(self.__timer_ids), func, args
+        with self.__calls_lock:
+            heapq.heappush(self.__timers, timer)
+
+            # the I/O thread only has to wake up if it waits for a later timer
+            if self.__timers[0] is not timer or self.__woken or self.__io_thread in (None, threading.get_ident()):
+                return
+
+            self.__woken = True
+
+        with suppress(OSError):
+            self.__wake_send.send(b"\x00")
+
+    def submit(self, func: Callable) -> None:
+        """
+        run func in the worker pool
+        """
+        with suppress(RuntimeError):
+            self.__workers.submit(func)
+
+    def add_user(self, user: SelectorUser) -> None:
+        if user.running:
+            self.__users.add(user)
+            self.update_events(user)
+
+    def remove_user(self, user: SelectorUser) -> None:
+        self.__users.discard(user)
+        with suppress(KeyError, ValueError):
+            self.__selector.unregister(user.fileno)
+
+        user.close()
+
+    def resume_reading(self, user: SelectorUser) -> None:
+        user.reading = True
+        self.update_events(user)
+
+    def update_events(self, user: SelectorUser) -> None:
+        """
+        watch the socket of user for what it is waiting for (I/O thread)
+        """
+        if user not in self.__users:
+            return
+
+        events = (selectors.EVENT_READ if user.reading else 0) | (selectors.EVENT_WRITE if user.waiting_writable else 0)
+        if not events:
+            with suppress(KeyError):
+                self.__selector.unregister(user.fileno)
+
+            return
+
+        try:
+            self.__selector.modify(user.fileno, events, user)
+
+        except KeyError:
+            self.__selector.register(user.fileno, events, user)
+
+    def receive_clients(self, thread: bool = False) -> None:
+        if thread:
+            if not self.__pool:
+                self.__pool = ThreadPoolExecutor(max_workers=1)
+
+            self.__pool.submit(self.receive_clients, thread=False)
+            return
+
+        self.__io_thread = threading.get_ident()
+        try:
+            self.__run()
+
+        finally:
+            self.__io_thread = None
+            self.__shutdown()
+
+    @print_traceback
+    def __run(self) -> None:
+        """
+        the I/O thread: wait for ready sockets and calls from other threads
+        """
+        next_sweep = time.monotonic() + HEARTBEAT_INTERVAL / 2
+        while self.running:
+            wake_at = min(next_sweep, self.__timers[0][0]) if self.__timers else next_sweep
+            for key, events in self.__selector.select(max(wake_at - time.monotonic(), 0)):
+                match key.data:
+                    case "accept":
+                        self.__accept()
+
+                    case "wake":
+                        with suppress(BlockingIOError):
+                            self.__wake_receive.recv(4096)
+
+                    case user:
+                        if events & selectors.EVENT_WRITE and user.running:
+                            user.flush(writable=True)
+
+                        if events & selectors.EVENT_READ and user.running:
+                            user.read()
+
+            self.__run_calls()
+
+            if time.monotonic() >= next_sweep:
+                self.__sweep()
+                next_sweep = time.monotonic() + HEARTBEAT_INTERVAL / 2
+
+    def __run_calls(self) -> None:
+        now = time.monotonic()
+        with self.__calls_lock:
+            calls, self.__calls = self.__calls, deque()
+            self.__woken = False
+            while self.__timers and self.__timers[0][0] <= now:
+                _, _, func, args = heapq.heappop(self.__timers)
+                calls.append((func, args))
+
+        for func, args in calls:
+            func(*args)
+
+    def __sweep(self) -> None:
+        """
+        ping idle clients, disconnect the ones that stopped answering
+        """
+        now = time.monotonic()
+        for user in tuple(self.__users):
+            if not user.heartbeat:
+                continue
+
+            idle = now - user.last_received
+            if idle > IDLE_TIMEOUT:
+                print(f"Idle: {user.username}")
+                user.end()
+
+            elif idle >= HEARTBEAT_INTERVAL:
+                user.ping()
+
+    def __accept(self) -> None:
+        """
+        accept the waiting clients and pass them to the login pool
+        """
+        while True:
+            # only HANDSHAKE_QUEUE logins at once, stop accepting until one is done
+            if not self.__login_slots.acquire(blocking=False):
+                self.__selector.unregister(self.__server)
+                self.__accepting = False
+                return
+
+            try:
+                client, _address = self.__server.accept()
+
+            except OSError:
+                self.__login_slots.release()
+                return
+
+            self.__login_pool.submit(self.__login, client)
+
+    def __login_done(self) -> None:
+        self.__login_slots.release()
+        if not self.__accepting and self.running:
+            self.__accepting = True
+            self.__selector.register(self.__server, selectors.EVENT_READ, "accept")
+
+    @print_traceback
+    def __login(self, client: socket.socket) -> None:
+        """
+        handle the handshake of a new client (runs in the login pool)
+        """
+        try:
+            if login_client(client, self.__fer, self.__login_lock, self.__new_user) is not None:
+                self.logins.tick()
+
+        finally:
+            self.call(self.__login_done)
+
+    def __new_user(self, client: socket.socket, init_mes: Dict[str, Any], key: bytes | None) -> SelectorUser:
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return SelectorUser(
+            self,
+            client,
+            self.__fer.encrypt,
+            init_mes["username"],
+            CODECS[init_mes["version"]],
+            init_mes.get("room_key", False),
+            login_compression(init_mes),
+            init_mes.get("heartbeat", False) is True,
+            key
+        )
+
+    def __shutdown(self) -> None:
+        """
+        disconnect everyone and release the sockets (after the I/O thread stopped)
+        """
+        self.__login_pool.shutdown(wait=True)
+        RUNNING_CLIENTS.end()
+        self.__workers.shutdown(wait=True, cancel_futures=True)
+        for user in tuple(self.__users):
+            self.remove_user(user)
+
+        self.__selector.close()
+        self.__server.close()
+        self.__wake_receive.close()
+        self.__wake_send.close()
+
+    def end(self) -> None:
+        self.running = False
+        with suppress(OSError):
+            self.__wake_send.send(b"\x00")
+
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
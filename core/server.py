@@ -5,24 +5,109 @@ Used for storing messages (encrypted)
 Author:
 Nilusink
 """
-from core import send_long, receive_long, print_traceback, key_func
+from core.compression import Compression, NO_COMPRESSION, negotiate
+from core.history import MessageHistory
+from core.protocol import CODECS, JsonCodec, ProtocolError, detect, blob_from_token
+from core.metrics import METRICS
+from core.tracing import TRACER, Trace
+from core import send_long, send_frames, set_nodelay, FrameReader, KeyPool, RateMeter, TokenBucket, print_traceback
 
 from cryptography.fernet import Fernet, InvalidToken
 from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Dict, Any, List
+from typing import Callable, Deque, Dict, Any, Tuple
+from collections import deque
 from types import ModuleType, FunctionType
 from contextlib import suppress
 from gc import get_referents
+import threading
 import socket
-import struct
-import json
+import time
 import sys
 
 
 BLACKLIST = type, ModuleType, FunctionType
 
-MESSAGES: list = []
 MAX_MESS_LIST_SIZE: int = 1_000_000  # in bytes, recommended to keep at a reasonable size, not too small
+MAX_FRAME_SIZE: int = 1_000_000  # in bytes, biggest request a client is allowed to send
+MAX_PAGE_SIZE: int = 500  # maximum number of messages per get_since page
+MAX_TIME_LENGTH: int = 32  # in characters, longest "time" a message may have
+
+# every user has a queue of frames waiting to be sent, if a client is too slow and its queue is full:
+# "drop_oldest": drop the oldest queued frame, "disconnect": disconnect the client,
+# "block": wait up to OUTBOUND_TIMEOUT seconds for space, then disconnect the client
+OUTBOUND_QUEUE_SIZE: int = 1000  # in frames
+OUTBOUND_POLICY: str = "drop_oldest"
+OUTBOUND_TIMEOUT: float = 1.0  # in seconds
+
+# optionally send the queued frames of a client together in one write: after the first frame, wait up to
+# COALESCE_DELAY seconds for more (0 disables it), until COALESCE_BYTES are collected.
+# Fewer syscalls and packets during bursts, but every frame can be delayed by up to COALESCE_DELAY
+COALESCE_DELAY: float = 0.0  # in seconds
+COALESCE_BYTES: int = 64 * 1024  # in bytes
+
+# compression algorithms clients may choose (in the handshake) with the highest level allowed for each,
+# history pages and long messages compress well. bz2 and lzma are a lot slower than zlib (tens of milliseconds
+# for a big history page), so only zlib is allowed by default. Frames smaller than COMPRESSION_THRESHOLD
+# aren't compressed, the clients can't change it
+COMPRESSION_LEVELS: Dict[str, int] = {"zlib": 6}
+COMPRESSION_THRESHOLD: int = 1024  # in bytes
+
+# logins are handled by a pool of worker threads instead of the accepting thread
+HANDSHAKE_WORKERS: int = 8
+HANDSHAKE_QUEUE: int = 64  # logins waiting for a worker, if full the accepting thread waits
+HANDSHAKE_TIMEOUT: float = 5.0  # in seconds, clients that take longer to log in are disconnected
+
+# selector engine (core.selector_server): threads processing the requests, requests of one client waiting
+# for a worker before its socket isn't read anymore. Clients that support heartbeats are pinged after
+# HEARTBEAT_INTERVAL seconds without a frame and disconnected after IDLE_TIMEOUT seconds
+SELECTOR_WORKERS: int = 8
+MAX_PENDING_REQUESTS: int = 64
+HEARTBEAT_INTERVAL: float = 30.0  # in seconds
+IDLE_TIMEOUT: float = 90.0  # in seconds
+
+# rate limits (token buckets, a rate of 0 disables them): every user may send USER_MESSAGE_RATE messages
+# per second (bursts of USER_MESSAGE_BURST), USER_HISTORY_RATE history pages (get_since, loaded right after
+# logging in) and USER_REQUEST_RATE other requests (stats, ...), all users together GLOBAL_MESSAGE_RATE messages.
+# Limited requests are dropped and answered with {"type": "throttled", "request_type": ..., "retry_after": seconds}
+USER_MESSAGE_RATE: float = 20.0  # per second
+USER_MESSAGE_BURST: int = 40
+USER_HISTORY_RATE: float = 20.0  # per second
+USER_HISTORY_BURST: int = 20
+USER_REQUEST_RATE: float = 10.0  # per second
+USER_REQUEST_BURST: int = 20
+GLOBAL_MESSAGE_RATE: float = 0.0  # per second
+GLOBAL_MESSAGE_BURST: int = 1000
+
+# logins are rejected ("ServerFull") while this many users are online (0 for no limit)
+MAX_SESSIONS: int = 10_000
+
+# clients get an encrypted session ticket on login, presenting it within TICKET_LIFETIME seconds resumes the
+# session: same key, no join message, a connection that dropped without the server noticing is replaced (0 disables it)
+TICKET_LIFETIME: int = 300  # in seconds
+
+# users allowed to request the server statistics with the "stats" action
+ADMINS: tuple = ()
+
+SESSION_KEYS = KeyPool()
+MESSAGES = MessageHistory(MAX_MESS_LIST_SIZE)
+GLOBAL_MESSAGES = TokenBucket(GLOBAL_MESSAGE_RATE, GLOBAL_MESSAGE_BURST)
+
+FRAMES_IN = METRICS.counter("frames_in")
+BYTES_IN = METRICS.counter("bytes_in")
+FRAMES_OUT = METRICS.counter("frames_out")
+BYTES_OUT = METRICS.counter("bytes_out")
+FRAMES_DROPPED = METRICS.counter("frames_dropped")
+DECRYPT_FAILURES = METRICS.counter("decrypt_failures")
+INVALID_REQUESTS = METRICS.counter("invalid_requests")
+HANDSHAKE_FAILURES = METRICS.counter("handshake_failures")
+LOGINS = METRICS.counter("logins")
+LOGOUTS = METRICS.counter("logouts")
+MESSAGES_IN = METRICS.counter("messages")
+THROTTLED = METRICS.counter("throttled")
+LOGINS_REJECTED = METRICS.counter("logins_rejected")
+RESUMED = METRICS.counter("sessions_resumed")
+BROADCAST_TIME = METRICS.histogram("broadcast_us")
+HANDSHAKE_TIME = METRICS.histogram("handshake_us")
 
 
 def getsize(obj):
@@ -45,38 +130,572 @@ def getsize(obj):
     return size
 
 
-class User:
-    running = True
+class OutboundQueue:
+    def __init__(self, max_size: int, policy: str = "drop_oldest", timeout: float = 1.0) -> None:
+        """
+        bounded queue of frames waiting to be sent to one client
 
-    def __init__(self, client: socket.socket, default_encryption: Callable, username: str) -> None:
+        :param max_size: maximum number of queued frames
+        :param policy: what to do if the queue is full ("drop_oldest", "disconnect" or "block")
+        :param timeout: how long "block" waits for space
         """
-        create a new client thread
+        if policy not in ("drop_oldest", "disconnect", "block"):
+            raise ValueError(f"Invalid overflow policy: {policy}")
 
-        :param client: The socket instance of the Client
+        self.max_size = max_size
+        self.policy = policy
+        self.timeout = timeout
+
+        self.dropped: int = 0
+        self.high_water: int = 0
+
+        self.__items: Deque[bytes] = deque()
+        self.__condition = threading.Condition()
+        self.__closed = False
+
+    @property
+    def depth(self) -> int:
         """
-        self.__client = client
-        self.__pool = ThreadPoolExecutor(max_workers=1)
+        number of frames waiting to be sent
+        """
+        return len(self.__items)
+
+    def put(self, frame: bytes) -> bool:
+        """
+        queue a frame
 
-        # create new encryption key for client
-        key = key_func(256)
-        self.__fer = Fernet(key)
-        client.send(default_encryption(json.dumps({"success": True, "key": key.decode()}).encode("utf-32")))
+        :param frame: the frame to send
+        :return: False if the client can't keep up and should be disconnected
+        """
+        with self.__condition:
+            if self.__closed:
+                return False
 
-        # start receiving thread
-        self.__pool.submit(self.__receive)
+            if len(self.__items) >= self.max_size:
+                match self.policy:
+                    case "drop_oldest":
+                        self.__items.popleft()
+                        self.dropped += 1
+                        FRAMES_DROPPED.inc()
 
-        # permanent variables
-        self.__username = username
+                    case "disconnect":
+                        return False
 
-        # mark current client as running
-        RUNNING_CLIENTS.append(self)
+                    case "block":
+                        if not self.__condition.wait_for(
+                                lambda: len(self.__items) < self.max_size or self.__closed,
+                                self.timeout
+                        ) or self.__closed:
+                            return False
 
-        print(f"Login: {username}")
+            self.__items.append(frame)
+            self.high_water = max(self.high_water, len(self.__items))
+            self.__condition.notify_all()
+            return True
+
+    def pop(self) -> bytes | None:
+        """
+        the next frame, None if the queue is empty (doesn't block)
+        """
+        with self.__condition:
+            if not self.__items:
+                return None
+
+            self.__condition.notify_all()
+            return self.__items.popleft()
+
+    def get(self) -> bytes | None:
+        """
+        wait for the next frame
+
+        :return: the frame, None once the queue is closed
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__items or self.__closed)
+            if self.__closed:
+                return None
+
+            self.__condition.notify_all()
+            return self.__items.popleft()
+
+    def get_batch(self, max_bytes: int, timeout: float) -> list[bytes]:
+        """
+        collect more frames to send with one write
+
+        :param max_bytes: stop once the collected frames are bigger than this
+        :param timeout: how long to wait for frames that aren't queued yet
+        :return: the frames (maybe none)
+        """
+        frames: list[bytes] = []
+        size = 0
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while size < max_bytes and not self.__closed:
+                if not self.__items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    self.__condition.wait(remaining)
+                    continue
+
+                frame = self.__items.popleft()
+                frames.append(frame)
+                size += len(frame)
+
+            self.__condition.notify_all()
+
+        return frames
+
+    def close(self) -> None:
+        """
+        wake up everyone waiting, no frames are accepted anymore
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__items.clear()
+            self.__condition.notify_all()
+
+
+def receive_handshake(client: socket.socket) -> bytes:
+    """
+    receive the (encrypted) login request of a client.
+    Version 2 clients frame it with send_long (so it starts with a zero byte),
+    version 1 clients send the bare Fernet token
+
+    :param client: the socket of the new client
+    """
+    if client.recv(1, socket.MSG_PEEK) == b"\x00":
+        return FrameReader(client, 2048).receive()
+
+    return client.recv(2048)
+
+
+def send_handshake(client: socket.socket, data: bytes, codec) -> None:
+    """
+    send the (encrypted) login response the same way the request was sent
+
+    :param client: the socket of the new client
+    :param data: the encrypted response
+    :param codec: the codec the request was encoded with
+    """
+    if codec.framed_handshake:
+        send_long(client, data)
+
+    else:
+        client.send(data)
+
+
+class SessionTickets:
+    def __init__(self) -> None:
+        """
+        issues and checks session tickets, encrypted with a key only the server knows
+        (created at import, so the forked processes of a cluster share it, a restart invalidates all tickets)
+        """
+        self.__fer = Fernet(Fernet.generate_key())
+
+    def issue(self, username: str, key: bytes) -> str | None:
+        """
+        a ticket resuming the session of username
+
+        :param username: the user the ticket is for
+        :param key: the session key of the user
+        :return: the ticket, None if tickets are disabled
+        """
+        if not TICKET_LIFETIME:
+            return None
+
+        return self.__fer.encrypt(key + b":" + username.encode()).decode()
+
+    def redeem(self, init_mes: Dict[str, Any]) -> bytes | None:
+        """
+        check the ticket of a login request
+
+        :param init_mes: the decrypted login request
+        :return: the session key to resume, None if there is no valid ticket
+        """
+        ticket = init_mes.get("ticket")
+        if not TICKET_LIFETIME or not isinstance(ticket, str):
+            return None
+
+        try:
+            key, username = self.__fer.decrypt(ticket.encode(), ttl=TICKET_LIFETIME).split(b":", 1)
+
+        except (InvalidToken, ValueError):
+            return None
+
+        if username.decode() != init_mes["username"]:
+            return None
+
+        return key
+
+
+TICKETS = SessionTickets()
+
+
+def login_response(
+        key: bytes,
+        room_key: bool,
+        compression: Compression = NO_COMPRESSION,
+        ticket: str | None = None,
+        resumed: bool = False
+) -> Dict[str, Any]:
+    """
+    the response to a successful login
+
+    :param key: the session key of the client
+    :param room_key: if the room key should be sent to the client
+    :param compression: the compression chosen for the client
+    :param ticket: the session ticket for the client
+    :param resumed: if the session was resumed with a ticket
+    """
+    response = {"success": True, "key": key.decode()}
+    if ticket is not None:
+        response["ticket"] = ticket
+
+    if resumed:
+        response["resumed"] = True
+
+    if room_key:
+        response["room_key"] = RUNNING_CLIENTS.room_key.decode()
+
+    if compression.algorithm is not None:
+        response["compression"] = compression.settings()
+
+    return response
+
+
+def login_compression(init_mes: Dict[str, Any]) -> Compression:
+    """
+    the compression for a new client, chosen from its offer in the handshake
+    """
+    return negotiate(init_mes.get("compression"), COMPRESSION_LEVELS, COMPRESSION_THRESHOLD)
+
+
+def read_login(fer: Fernet, handshake: bytes) -> Tuple[Any, Dict[str, Any], bytes | None]:
+    """
+    decrypt and check a login request (shared by every server engine)
+
+    :param fer: encryption with the server secret
+    :param handshake: the encrypted login request
+    :return: the codec the request was encoded with (the response uses the same), the request
+             and the session key to resume (None without a valid session ticket)
+    :raises InvalidToken, ValueError: invalid login request
+    """
+    data = fer.decrypt(handshake)
+    codec = detect(data)
+    init_mes = codec.loads(data)
+    if not isinstance(init_mes, dict) or not isinstance(init_mes.get("username"), str) \
+            or not isinstance(init_mes.get("version"), str):
+        raise ProtocolError("Invalid login request")
+
+    return codec, init_mes, TICKETS.redeem(init_mes)
+
+
+def login_rejection(default_encryption: Callable, codec, reason: str) -> bytes:
+    """
+    the (encrypted) response to a rejected login
+
+    :param default_encryption: function used to encrypt the login response
+    :param codec: the codec the request was encoded with
+    :param reason: why the login was rejected
+    """
+    return default_encryption(codec.dumps({"success": False, "reason": reason}))
+
+
+def count_login(start: int, resumed: bool) -> None:
+    """
+    update the metrics after a successful login
+
+    :param start: time.perf_counter_ns() when the client connected
+    :param resumed: if the session was resumed with a ticket
+    """
+    LOGINS.inc()
+    if resumed:
+        RESUMED.inc()
+
+    HANDSHAKE_TIME.observe((time.perf_counter_ns() - start) // 1000)
+
+
+class UserLimits:
+    def __init__(self) -> None:
+        """
+        the rate limits of one user
+        """
+        self.messages = TokenBucket(USER_MESSAGE_RATE, USER_MESSAGE_BURST)
+        self.history = TokenBucket(USER_HISTORY_RATE, USER_HISTORY_BURST)
+        self.requests = TokenBucket(USER_REQUEST_RATE, USER_REQUEST_BURST)
+
+        # throttle responses are only sent once per retry_after, a flood gets no answer to every frame
+        self.notified_until: float = 0.0
+
+
+def admit(user: "Session", request_type: str) -> bool:
+    """
+    check the rate limits for a request, a limited request is answered with a throttle response
+
+    :param user: the user that sent the request
+    :param request_type: "message" or the action
+    :return: if the request may be processed
+    """
+    if request_type in ("end", "pong"):
+        return True
+
+    limits: UserLimits = user.limits
+    if request_type == "message":
+        # the users token is only taken if the global limit lets the message through
+        # (only the thread processing the users requests takes from its bucket)
+        wait = limits.messages.wait() or GLOBAL_MESSAGES.take() or limits.messages.take()
+
+    elif request_type == "get_since":
+        wait = limits.history.take()
+
+    else:
+        wait = limits.requests.take()
+
+    if not wait:
+        return True
+
+    THROTTLED.inc()
+    now = time.monotonic()
+    if now >= limits.notified_until:
+        limits.notified_until = now + wait
+        user.send({
+            "type": "throttled",
+            "request_type": request_type,
+            "retry_after": round(wait, 3)
+        })
+
+    return False
+
+
+def replace_session(username: str) -> None:
+    """
+    end the old connection of a resumed session (dropped without the server noticing yet),
+    call after the login was validated
+    """
+    old = RUNNING_CLIENTS.get(username)
+    if old is not None:
+        old.end(wait=False)
+
+
+def request_name(init_mes: Any) -> str | None:
+    """
+    the name of a request: "message" or the action
+
+    :param init_mes: the decrypted request
+    :return: None if the request is malformed
+    """
+    if not isinstance(init_mes, dict):
+        return None
+
+    match init_mes.get("type"):
+        case "message":
+            return "message"
+
+        case "action":
+            action = init_mes.get("action")
+            return action if isinstance(action, str) else None
+
+    return None
+
+
+def process_request(user: "Session", init_mes: Dict[str, Any], trace: Trace | None = None) -> bool:
+    """
+    process a request of a logged-in client (shared by every server engine)
+
+    :param user: the user that sent the request
+    :param init_mes: the decrypted request
+    :param trace: the trace of the frame, if it is sampled
+    :return: False if the request is malformed (the client should be disconnected)
+    """
+    name = request_name(init_mes)
+    if name is None:
+        INVALID_REQUESTS.inc()
+        return False
+
+    if not admit(user, name):
+        return True
+
+    match init_mes["type"]:
+        case "action":
+            match init_mes["action"]:
+                case "end":
+                    user.end()
+
+                case "get_all":
+                    user.send({
+                        "type": "request_result",
+                        "request_type": "get_all",
+                        "request_result": MESSAGES.snapshot()
+                    })
+
+                case "get_since":
+                    # the cursor comes from the client, requests with invalid values are dropped
+                    try:
+                        since = int(init_mes.get("since", -1))
+                        before = init_mes.get("before")
+                        before = None if before is None else int(before)
+                        limit = max(1, min(int(init_mes.get("limit", MAX_PAGE_SIZE)), MAX_PAGE_SIZE))
+
+                    except (TypeError, ValueError, OverflowError):
+                        return True
+
+                    # one page of the messages after the clients cursor, newest page first
+                    messages, more = MESSAGES.page(since=since, before=before, limit=limit)
+                    user.send({
+                        "type": "request_result",
+                        "request_type": "get_since",
+                        "request_result": messages,
+                        "more": more
+                    })
+
+                case "stats":
+                    if user.username in ADMINS:
+                        user.send({
+                            "type": "request_result",
+                            "request_type": "stats",
+                            "request_result": METRICS.snapshot()
+                        })
+
+            if trace is not None:
+                trace.mark("dispatch")
+
+        case "message":
+            # the encrypted text is kept as raw bytes, version 1 clients send it as token string
+            message = init_mes.get("message")
+            if isinstance(message, str):
+                try:
+                    message = blob_from_token(message)
+
+                except ValueError:
+                    return True
+
+            # anything else would be broadcast to (and stored for) every client,
+            # the time is only shown by the clients (a huge int couldn't even be encoded)
+            sent_time = init_mes.get("time")
+            if not isinstance(message, bytes) or not isinstance(sent_time, str) or len(sent_time) > MAX_TIME_LENGTH:
+                return True
+
+            entry = {
+                "message": message,
+                "time": sent_time,
+                "user": user.username
+            }
+            MESSAGES_IN.inc()
+            if trace is not None:
+                trace.mark("dispatch")
+
+            # with multiple server processes, the bus assigns the id and delivers it to every process
+            if RUNNING_CLIENTS.bus is not None:
+                RUNNING_CLIENTS.bus.publish(entry)
+                if trace is not None:
+                    trace.mark("publish")
+
+            else:
+                deliver_message(entry, trace=trace)
+
+    return True
+
+
+def deliver_message(entry: Dict[str, Any], message_id: int | None = None, trace: Trace | None = None) -> None:
+    """
+    store a new message and send it to every client
+
+    :param entry: the history entry (message, time, user)
+    :param message_id: the id of the message, assigned by the history if not given
+    :param trace: the trace of the frame that contained the message, if it is sampled
+    """
+    message_id = MESSAGES.append(entry, message_id)
+    if trace is not None:
+        trace.mark("history")
+
+    RUNNING_CLIENTS.sendall({
+        "type": "message",
+        "message": entry["message"],
+        "time": entry["time"],
+        "user": entry["user"],
+        "id": message_id
+    })
+    if trace is not None:
+        trace.mark("broadcast")
+
+
+class Session:
+    running = True
+
+    def __init__(
+            self,
+            username: str,
+            codec=JsonCodec,
+            room_key: bool = False,
+            compression: Compression = NO_COMPRESSION,
+            key: bytes | None = None,
+            queue_timeout: float = OUTBOUND_TIMEOUT
+    ) -> None:
+        """
+        the state of a logged-in client shared by every server engine: encryption, outbound queue and login / logout
+
+        :param username: the name of the user
+        :param codec: the encoding matching the clients protocol version
+        :param room_key: if the client accepted broadcasts encrypted with the room key
+        :param compression: the compression negotiated with the client
+        :param key: the session key of a resumed session, None for a new one
+        :param queue_timeout: how long the "block" policy of the outbound queue waits for space
+        """
+        # end is called from several threads, only the first call may log out
+        self.__end_lock = threading.Lock()
+        self.__username = username
+        self.__codec = codec
+        self.__compression = compression
+        self.queue = OutboundQueue(OUTBOUND_QUEUE_SIZE, OUTBOUND_POLICY, queue_timeout)
+        self.limits = UserLimits()
+
+        # create new encryption key for client (unless the session is resumed)
+        self.resumed = key is not None
+        self.key = key or SESSION_KEYS.get()
+        self.__fer = Fernet(self.key)
+        self.__room_key = room_key and RUNNING_CLIENTS.room_key is not None
 
     @property
     def username(self) -> str:
         return self.__username
 
+    @property
+    def codec(self):
+        return self.__codec
+
+    @property
+    def uses_room_key(self) -> bool:
+        return self.__room_key
+
+    @property
+    def compression(self) -> Compression:
+        return self.__compression
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        number of frames waiting to be sent to the client
+        """
+        return self.queue.depth
+
+    def register(self, default_encryption: Callable) -> bytes:
+        """
+        mark the client as running before answering, broadcasts sent in between wait in the queue.
+        Fails if the name was just taken by another server process (running is False then)
+
+        :param default_encryption: function used to encrypt the login response
+        :return: the (encrypted) login response
+        """
+        if not RUNNING_CLIENTS.append(self):
+            self.running = False
+            return login_rejection(default_encryption, self.__codec, "UserOnline")
+
+        return default_encryption(self.__codec.dumps(login_response(
+            self.key, self.__room_key, self.__compression, TICKETS.issue(self.__username, self.key), self.resumed
+        )))
+
     def encrypt(self, message: str | dict) -> bytes:
         """
         encrypt a str or dictionary with the client secret
@@ -84,110 +703,297 @@ class User:
         :param message: the message to encrypt
         :return: the encrypted message
         """
-        return self.__fer.encrypt(json.dumps(message).encode("utf-32"))
+        return self.__fer.encrypt(self.__compression.pack(self.__codec.dumps(message)))
 
-    def decrypt(self, message: bytes) -> str | dict:
+    def decrypt(self, message: bytes, trace: Trace | None = None) -> str | dict:
         """
         decrypt a str or dictionary with the client secret
 
         :param message: the message to encrypt
+        :param trace: marks the end of the decryption, if given
         :return: the encrypted message
         """
-        return json.loads(self.__fer.decrypt(message).decode("utf-32"))
+        data = Compression.unpack(self.__fer.decrypt(message), MAX_FRAME_SIZE)
+        if trace is not None:
+            trace.mark("decrypt")
 
-    @print_traceback
-    def __receive(self) -> None:
-        self.__client.settimeout(.5)
-        while self.running:
-            try:
-                bytes_mes = receive_long(self.__client)
+        return self.__codec.loads(data)
 
-            except (socket.timeout, struct.error):
-                continue
+    def handle(self, frame: bytes, trace: Trace | None = None) -> bool:
+        """
+        decrypt and process a received request
 
-            except (ConnectionResetError, ConnectionAbortedError):
-                self.end(wait=False)
-                return
+        :param frame: the encrypted request
+        :param trace: the trace of the frame, if it is sampled
+        :return: False if the client has to be logged out (frame not decryptable or request malformed)
+        """
+        try:
+            init_mes: Dict[str, Any] = self.decrypt(frame, trace)
 
-            init_mes: Dict[str, Any] = self.decrypt(bytes_mes)
-            # process request
-            match init_mes["type"]:
-                case "action":
-                    match init_mes["action"]:
-                        case "end":
-                            self.end()
-
-                        case "get_all":
-                            self.send({
-                                "type": "request_result",
-                                "request_type": "get_all",
-                                "request_result": MESSAGES
-                            })
-
-                case "message":
-                    MESSAGES.append({
-                        "message": init_mes["message"],
-                        "time": init_mes["time"],
-                        "user": self.username
-                    })
-                    RUNNING_CLIENTS.sendall({
-                        "type": "message",
-                        "message": init_mes["message"],
-                        "time": init_mes["time"],
-                        "user": self.username
-                    })
+        except (InvalidToken, ProtocolError):
+            DECRYPT_FAILURES.inc()
+            return False
+
+        if trace is not None:
+            trace.mark("decode")
+
+        if not process_request(self, init_mes, trace):
+            return False
 
-                    # if the message list gets to big, delete a few elements
-                    while getsize(MESSAGES) > MAX_MESS_LIST_SIZE:
-                        MESSAGES.pop(0)
+        if trace is not None:
+            trace.finish(request_name(init_mes))
+
+        return True
 
     def send(self, message: dict) -> None:
         """
-        send a message to the client
+        queue a message for the client
 
         :param message: the message to send
         """
+        self.send_token(self.encrypt(message))
+
+    def send_encoded(self, message: bytes) -> None:
+        """
+        queue a message already encoded (and compressed) for the client
+
+        :param message: the encoded message
+        """
+        self.send_token(self.__fer.encrypt(message))
+
+    def send_token(self, token: bytes) -> None:
+        """
+        queue an already encrypted frame (depends on the engine)
+
+        :param token: the encrypted frame
+        """
+        raise NotImplementedError
+
+    def logout(self) -> bool:
+        """
+        mark the client as not running anymore and remove it from the running clients
+
+        :return: False if it was already logged out (only the first call may clean up)
+        """
+        with self.__end_lock:
+            if not self.running:
+                return False
+
+            self.running = False
+
+        print(f"Logout: {self.__username}")
+        LOGOUTS.inc()
+        with suppress(Exception):
+            RUNNING_CLIENTS.remove(self)
+            self.queue.close()
+
+        return True
+
+    def end(self, wait: bool = True) -> None:
+        """
+        log out and disconnect the client (depends on the engine)
+
+        :param wait: decides if to wait for the threads to finish (only set false within the thread itself)
+        """
+        raise NotImplementedError
+
+
+class User(Session):
+    def __init__(
+            self,
+            client: socket.socket,
+            default_encryption: Callable,
+            username: str,
+            codec=JsonCodec,
+            room_key: bool = False,
+            compression: Compression = NO_COMPRESSION,
+            key: bytes | None = None
+    ) -> None:
+        """
+        create a new client thread
+
+        :param client: The socket instance of the Client
+        :param codec: the encoding matching the clients protocol version
+        :param room_key: if the client accepted broadcasts encrypted with the room key
+        :param compression: the compression negotiated with the client
+        :param key: the session key of a resumed session, None for a new one
+        """
+        super().__init__(username, codec, room_key, compression, key)
+        self.__client = client
+        self.__reader = FrameReader(client, MAX_FRAME_SIZE)
+        self.__reader.timestamps = TRACER.rate > 0
+        self.__pool = ThreadPoolExecutor(max_workers=2)
+
+        response = self.register(default_encryption)
+        if not self.running:
+            send_handshake(client, response, codec)
+            client.close()
+            return
+
         try:
-            send_long(self.__client, self.encrypt(message))
+            send_handshake(client, response, codec)
 
-        except ConnectionAbortedError:
-            self.end()
+        except OSError:
+            self.end(wait=False)
+            raise
+
+        # start receiving and sending threads
+        self.__pool.submit(self.__receive)
+        self.__pool.submit(self.__write)
+
+        print(f"Login: {username}")
+
+    @print_traceback
+    def __receive(self) -> None:
+        # however receiving ends (connection lost, invalid or failing request), the client is logged out
+        try:
+            self.__client.settimeout(.5)
+            while self.running:
+                try:
+                    bytes_mes = self.__reader.receive()
+
+                except socket.timeout:
+                    continue
+
+                except OSError:
+                    # connection lost / closed by User.end
+                    return
+
+                FRAMES_IN.inc()
+                BYTES_IN.inc(len(bytes_mes))
+                trace = TRACER.sample(self.__reader.started, id(self), self.username) if TRACER.rate else None
+                if trace is not None:
+                    trace.mark("receive")
+
+                if not self.handle(bytes_mes, trace):
+                    return
+
+        finally:
+            self.end(wait=False)
+
+    @print_traceback
+    def __write(self) -> None:
+        """
+        send the queued frames, a slow client only delays its own queue
+        """
+        while self.running:
+            data = self.queue.get()
+            if data is None:
+                return
+
+            frames = [data]
+            if COALESCE_DELAY:
+                frames += self.queue.get_batch(COALESCE_BYTES - len(data), COALESCE_DELAY)
+
+            try:
+                # the socket timeout (set for receiving) doesn't abort half sent frames
+                send_frames(self.__client, frames, retry=lambda: self.running)
+
+            except OSError:
+                self.end(wait=False)
+                return
+
+    def send_token(self, token: bytes) -> None:
+        """
+        queue an already encrypted frame
+
+        :param token: the encrypted frame
+        """
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(token))
+        if not self.queue.put(token):
+            # the client is too slow
+            self.end(wait=False)
 
     def end(self, wait: bool = True) -> None:
         """
         :param wait: decides if to wait for the threads to finish (only set false within the thread itself)
         """
-        print(f"Logout: {self.username}")
+        if not self.logout():
+            return
+
         with suppress(Exception):
-            RUNNING_CLIENTS.remove(self)
-            self.running = False
+            self.__client.shutdown(socket.SHUT_RDWR)
+            self.__client.close()
             self.__pool.shutdown(wait=wait)
 
 
 class Clients:
     def __init__(self) -> None:
         """
-        Collector for multiple clients
+        Collector for multiple clients, indexed by username and safe to use from multiple threads
         """
-        self.__clients: List[User] = []
+        self.__clients: Dict[str, Session] = {}
+        self.__snapshot: Tuple[Session, ...] | None = ()
+        self.__lock = threading.Lock()
+        self.__room_fer: Fernet | None = None
+        self.room_key: bytes | None = None
+
+        # connection to the other server processes (see core.cluster)
+        self.bus = None
 
-    def append(self, client: User) -> None:
+    def enable_room_key(self) -> None:
+        """
+        encrypt every broadcast only once with a key shared by all clients that accept it,
+        instead of once per client with its own key
+        """
+        self.room_key = Fernet.generate_key()
+        self.__room_fer = Fernet(self.room_key)
+
+    def append(self, client: Session) -> bool:
         """
         append a client to the clients list
         :param client: the client to append
+        :return: False if a client with the same username is already online
         """
-        self.__clients.append(client)
+        with self.__lock:
+            if client.username in self.__clients:
+                return False
+
+            if self.bus is not None and not self.bus.claim(client.username):
+                return False
+
+            self.__clients[client.username] = client
+            self.__snapshot = None
+            return True
 
     @print_traceback
-    def remove(self, client: User) -> bool:
+    def remove(self, client: Session) -> bool:
         """
         remove a client from the clients list
         :param client: the client to remove
         """
-        if client in self.__clients:
-            self.__clients.remove(client)
+        with self.__lock:
+            if self.__clients.get(client.username) is not client:
+                return False
+
+            del self.__clients[client.username]
+            self.__snapshot = None
+            if self.bus is not None:
+                self.bus.release(client.username)
+
             return True
-        return False
+
+    def snapshot(self) -> Tuple[Session, ...]:
+        """
+        all clients online right now, unaffected by later logins / logouts
+        (reused until the next change, so iterating it is cheap)
+        """
+        snapshot = self.__snapshot
+        if snapshot is None:
+            with self.__lock:
+                if self.__snapshot is None:
+                    self.__snapshot = tuple(self.__clients.values())
+
+                snapshot = self.__snapshot
+
+        return snapshot
+
+    def get(self, username: str) -> Session | None:
+        """
+        the client logged in with username, None if nobody is
+        """
+        return self.__clients.get(username)
 
     @print_traceback
     def sendall(self, message: dict) -> None:
@@ -195,8 +1001,31 @@ class Clients:
         send to all clients
         :param message: message to send
         """
-        for client in self.__clients:
-            client.send(message)
+        # encode the message only once per protocol version and compression and encrypt it once for the room
+        start = time.perf_counter_ns()
+        encoded: Dict[Any, bytes] = {}
+        room_tokens: Dict[Any, bytes] = {}
+        for client in self.snapshot():
+            variant = client.codec, client.compression
+            if variant not in encoded:
+                encoded[variant] = client.compression.pack(client.codec.dumps(message))
+
+            if client.uses_room_key:
+                if variant not in room_tokens:
+                    room_tokens[variant] = self.__room_fer.encrypt(encoded[variant])
+
+                client.send_token(room_tokens[variant])
+
+            else:
+                client.send_encoded(encoded[variant])
+
+        BROADCAST_TIME.observe((time.perf_counter_ns() - start) // 1000)
+
+    def queue_depths(self) -> Dict[str, int]:
+        """
+        number of frames waiting to be sent, for every user
+        """
+        return {client.username: client.queue_depth for client in self.snapshot()}
 
     def is_online(self, username: str) -> bool:
         """
@@ -204,32 +1033,54 @@ class Clients:
 
         :param username: the user to search for
         """
-        for user in self.__clients:
-            if user.username == username:
-                return True
-        return False
+        if username in self.__clients:
+            return True
+
+        return self.bus is not None and self.bus.is_online(username)
 
     def end(self) -> None:
         """
         disconnect all clients
         """
-        for client in self.__clients.copy():
+        for client in self.snapshot():
             client.end()
 
+    def __len__(self) -> int:
+        return len(self.__clients)
+
 
 RUNNING_CLIENTS = Clients()
 
+METRICS.gauge("sessions", lambda: len(RUNNING_CLIENTS))
+METRICS.gauge("history_messages", lambda: len(MESSAGES))
+METRICS.gauge("history_bytes", lambda: MESSAGES.size)
+METRICS.gauge("history_evicted", lambda: MESSAGES.evicted)
+METRICS.gauge("queue_depth", lambda: queue_depth_stats(RUNNING_CLIENTS.queue_depths()))
+
+
+def queue_depth_stats(depths: Dict[str, int]) -> Dict[str, Any]:
+    """
+    summary of the outbound queue depths, with the fullest queues
+    """
+    fullest = sorted(depths.items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        "total": sum(depths.values()),
+        "max": fullest[0][1] if fullest else 0,
+        "fullest": dict(fullest),
+    }
+
 
 class Connection:
-    protocol_version = "1.0.0"
-    accepted_versions = {"1.0.0"}
+    protocol_version = "2.0.0"
+    accepted_versions = {"1.0.0", "2.0.0"}
 
-    def __init__(self, port: int, server_secret: bytes) -> None:
+    def __init__(self, port: int, server_secret: bytes, reuse_port: bool = False) -> None:
         """
         initialize the server, create socket
 
         :param port: the port to run on
         :param server_secret: Your custom secret key
+        :param reuse_port: let multiple processes accept on the same port (SO_REUSEPORT)
         """
         # validation of the secret and creation of the Fernet object
         try:
@@ -241,6 +1092,9 @@ class Connection:
         # create the socket object
         self.__server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self.__server.bind(("0.0.0.0", port))
         self.__server.settimeout(.5)
         self.__server.listen()
@@ -249,11 +1103,44 @@ class Connection:
         self.__secret = server_secret
         self.running = True
         self.__pool = None
+        self.__login_pool = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS)
+        self.__login_slots = threading.BoundedSemaphore(HANDSHAKE_QUEUE)
+        self.__login_lock = threading.Lock()
+        self.logins = RateMeter()
+        METRICS.gauge("logins_per_second", lambda: round(self.logins.rate, 2))
 
     @property
     def secret(self) -> bytes:
         return self.__secret
 
+    @classmethod
+    def login_error(cls, init_mes: Dict[str, Any], resuming: bool = False) -> str | None:
+        """
+        validate a login request
+
+        :param init_mes: the decrypted login request
+        :param resuming: if the request has a valid session ticket
+        :return: the reason why the login was rejected, None if it is valid
+        """
+        # validating version
+        if not init_mes["version"] in cls.accepted_versions:
+            return "InvalidVersion"
+
+        replaced = 0
+        if RUNNING_CLIENTS.is_online(init_mes["username"]):
+            # a resumed session replaces its old connection (see replace_session),
+            # unless that one is in another server process
+            if not resuming or RUNNING_CLIENTS.get(init_mes["username"]) is None:
+                return "UserOnline"
+
+            replaced = 1
+
+        if MAX_SESSIONS and len(RUNNING_CLIENTS) - replaced >= MAX_SESSIONS:
+            LOGINS_REJECTED.inc()
+            return "ServerFull"
+
+        return None
+
     def receive_clients(self, thread: bool = False) -> None:
         if thread:
             if not self.__pool:
@@ -263,32 +1150,95 @@ class Connection:
             return
 
         while self.running:
+            # wait for a free slot, so a login storm can't queue up unlimited work
+            if not self.__login_slots.acquire(timeout=.5):
+                continue
+
             try:
                 client, _address = self.__server.accept()
 
             except OSError:
+                self.__login_slots.release()
                 continue
 
-            init_mes = client.recv(2048)
-            init_mes = json.loads(self.__fer.decrypt(init_mes).decode("utf-32"))
+            self.__login_pool.submit(self.__login, client)
 
-            # validating version
-            if not init_mes["version"] in self.accepted_versions:
-                client.send(self.__fer.encrypt(json.dumps({"success": False, "reason": "InvalidVersion"}).encode("utf-32")))
-                client.close()
-                continue
+    @print_traceback
+    def __login(self, client: socket.socket) -> None:
+        """
+        handle the handshake of a new client (runs in the login pool)
+        """
+        try:
+            if login_client(client, self.__fer, self.__login_lock, self.__new_user) is not None:
+                self.logins.tick()
 
-            if RUNNING_CLIENTS.is_online(init_mes["username"]):
-                client.send(self.__fer.encrypt(json.dumps({"success": False, "reason": "UserOnline"}).encode("utf-32")))
-                client.close()
-                continue
+        finally:
+            self.__login_slots.release()
 
-            User(client, self.__fer.encrypt, init_mes["username"])
+    def __new_user(self, client: socket.socket, init_mes: Dict[str, Any], key: bytes | None) -> User:
+        return User(
+            client,
+            self.__fer.encrypt,
+            init_mes["username"],
+            CODECS[init_mes["version"]],
+            init_mes.get("room_key", False),
+            login_compression(init_mes),
+            key
+        )
 
     def end(self) -> None:
         self.running = False
         if self.__pool is not None:
             self.__pool.shutdown(wait=True)
 
+        self.__login_pool.shutdown(wait=True)
+
         # shutdown every running client
         RUNNING_CLIENTS.end()
+
+
+def login_client(
+        client: socket.socket,
+        fer: Fernet,
+        lock: threading.Lock,
+        new_user: Callable[[socket.socket, Dict[str, Any], bytes | None], Session]
+) -> Session | None:
+    """
+    handle the handshake of a new client on a blocking socket (thread and selector engine)
+
+    :param client: the socket of the new client
+    :param fer: encryption with the server secret
+    :param lock: held while checking and registering, or two clients could log in with the same name
+    :param new_user: creates the session: new_user(client, login request, key of a resumed session)
+    :return: the new session, None if the login failed or was rejected
+    """
+    start = time.perf_counter_ns()
+    try:
+        client.settimeout(HANDSHAKE_TIMEOUT)
+        set_nodelay(client)
+        codec, init_mes, key = read_login(fer, receive_handshake(client))
+
+        with lock:
+            reason = Connection.login_error(init_mes, key is not None)
+            if reason is not None:
+                send_handshake(client, login_rejection(fer.encrypt, codec, reason), codec)
+                client.close()
+                return None
+
+            if key is not None:
+                replace_session(init_mes["username"])
+
+            user = new_user(client, init_mes, key)
+
+        # the name was taken by another server process
+        if not user.running:
+            return None
+
+        count_login(start, key is not None)
+        return user
+
+    except (OSError, InvalidToken, ValueError, KeyError):
+        # timed out, disconnected or invalid handshake
+        HANDSHAKE_FAILURES.inc()
+        client.close()
+        return None
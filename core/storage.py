@@ -0,0 +1,299 @@
+"""
+storage.py
+Persistent, append-only log for the (end-to-end encrypted) messages
+
+A log is a directory of segments, each segment consists of two files named after
+the sequence number of its first record:
+    <first sequence>.log: records, (8 byte sequence, 4 byte length) header + payload
+    <first sequence>.idx: the offset of every record in the .log file (8 bytes each)
+
+Author:
+Nilusink
+"""
+from contextlib import suppress
+from typing import List, Tuple
+from array import array
+import threading
+import bisect
+import struct
+import mmap
+import time
+import sys
+import os
+
+
+RECORD_HEADER = struct.Struct(">QI")  # sequence, payload length
+
+
+class _Segment:
+    def __init__(self, directory: str, first_sequence: int) -> None:
+        """
+        one file pair of the log
+
+        :param directory: the directory of the log
+        :param first_sequence: sequence number of the first record in this segment
+        """
+        self.first_sequence = first_sequence
+        self.log_path = os.path.join(directory, f"{first_sequence:020d}.log")
+        self.index_path = os.path.join(directory, f"{first_sequence:020d}.idx")
+
+        self.offsets = array("Q")
+        self.size = 0
+
+        self.__map: mmap.mmap | None = None
+        self.__log_file = None
+        self.__index_file = None
+
+    @property
+    def next_sequence(self) -> int:
+        return self.first_sequence + len(self.offsets)
+
+    def load(self) -> None:
+        """
+        load the index of an existing segment, the log is only scanned if the
+        index doesn't match it (after a crash while writing)
+        """
+        self.size = os.path.getsize(self.log_path)
+        with suppress(FileNotFoundError):
+            with open(self.index_path, "rb") as index:
+                data = index.read()
+
+            self.offsets.frombytes(data[:len(data) - len(data) % 8])
+            if sys.byteorder == "big":
+                self.offsets.byteswap()
+
+        if not self.__index_valid():
+            self.__rebuild_index()
+
+    def __read_header(self, log, offset: int) -> Tuple[int, int] | None:
+        log.seek(offset)
+        header = log.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+
+        return RECORD_HEADER.unpack(header)
+
+    def __index_valid(self) -> bool:
+        if not self.offsets:
+            return self.size == 0
+
+        with open(self.log_path, "rb") as log:
+            header = self.__read_header(log, self.offsets[-1])
+
+        if header is None:
+            return False
+
+        sequence, length = header
+        return sequence == self.next_sequence - 1 and self.offsets[-1] + RECORD_HEADER.size + length == self.size
+
+    def __rebuild_index(self) -> None:
+        """
+        scan the record headers, drops a partially written last record
+        """
+        self.offsets = array("Q")
+        offset = 0
+        with open(self.log_path, "rb") as log:
+            while True:
+                header = self.__read_header(log, offset)
+                if header is None or offset + RECORD_HEADER.size + header[1] > self.size:
+                    break
+
+                self.offsets.append(offset)
+                offset += RECORD_HEADER.size + header[1]
+
+        if offset != self.size:
+            os.truncate(self.log_path, offset)
+            self.size = offset
+
+        offsets = array("Q", self.offsets)
+        if sys.byteorder == "big":
+            offsets.byteswap()
+
+        with open(self.index_path, "wb") as index:
+            index.write(offsets.tobytes())
+
+    def open_for_append(self) -> None:
+        self.__log_file = open(self.log_path, "ab")
+        self.__index_file = open(self.index_path, "ab")
+
+    def append(self, payload: bytes) -> int:
+        """
+        append a record
+
+        :return: the sequence number of the record
+        """
+        sequence = self.next_sequence
+        self.__log_file.write(RECORD_HEADER.pack(sequence, len(payload)))
+        self.__log_file.write(payload)
+        self.__log_file.flush()
+
+        self.__index_file.write(self.size.to_bytes(8, sys.byteorder))
+        self.__index_file.flush()
+
+        self.offsets.append(self.size)
+        self.size += RECORD_HEADER.size + len(payload)
+        return sequence
+
+    def read(self, sequence: int) -> bytes:
+        """
+        read the payload of a record through a memory map of the log file
+        """
+        offset = self.offsets[sequence - self.first_sequence]
+
+        # the active segment grows, map it again if the record isn't mapped yet
+        if self.__map is None or len(self.__map) < self.size:
+            if self.__map is not None:
+                self.__map.close()
+
+            with open(self.log_path, "rb") as log:
+                self.__map = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _sequence, length = RECORD_HEADER.unpack_from(self.__map, offset)
+        start = offset + RECORD_HEADER.size
+        return self.__map[start:start + length]
+
+    def close(self) -> None:
+        for file in (self.__map, self.__log_file, self.__index_file):
+            if file is not None:
+                file.close()
+
+        self.__map = self.__log_file = self.__index_file = None
+
+    def delete(self) -> None:
+        self.close()
+        for path in (self.log_path, self.index_path):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+
+class SegmentLog:
+    def __init__(
+            self,
+            directory: str,
+            segment_size: int = 16 * 1024 * 1024,
+            max_bytes: int | None = None,
+            max_age: float | None = None
+    ) -> None:
+        """
+        open (or create) a log
+
+        :param directory: where the segments are stored
+        :param segment_size: in bytes, a new segment is started once the active one is bigger
+        :param max_bytes: retention limit in bytes, the oldest segments are deleted
+        :param max_age: retention limit in seconds, segments without newer records are deleted
+        """
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.__directory = directory
+        self.__lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.__segments: List[_Segment] = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log"):
+                segment = _Segment(directory, int(name[:-4]))
+                segment.load()
+                self.__segments.append(segment)
+
+        if not self.__segments:
+            self.__segments.append(_Segment(directory, 0))
+
+        self.__firsts = [segment.first_sequence for segment in self.__segments]
+        self.__segments[-1].open_for_append()
+        self.enforce_retention()
+
+    @property
+    def first_sequence(self) -> int:
+        """
+        sequence number of the oldest record still stored
+        """
+        return self.__segments[0].first_sequence
+
+    @property
+    def next_sequence(self) -> int:
+        """
+        sequence number the next appended record will get
+        """
+        return self.__segments[-1].next_sequence
+
+    @property
+    def size(self) -> int:
+        """
+        size of all segments in bytes
+        """
+        return sum(segment.size for segment in self.__segments)
+
+    def start_at(self, sequence: int) -> None:
+        """
+        number the records of an empty log starting at sequence
+
+        :param sequence: the sequence number of the first record
+        """
+        with self.__lock:
+            if self.next_sequence != self.first_sequence:
+                raise ValueError("Only an empty log can start at another sequence")
+
+            for segment in self.__segments:
+                segment.delete()
+
+            active = _Segment(self.__directory, sequence)
+            active.open_for_append()
+            self.__segments = [active]
+            self.__firsts = [sequence]
+
+    def append(self, payload: bytes) -> int:
+        """
+        append a record
+
+        :param payload: the data to store
+        :return: the sequence number of the record
+        """
+        with self.__lock:
+            active = self.__segments[-1]
+            if active.size >= self.segment_size:
+                active.close()
+                active = _Segment(self.__directory, active.next_sequence)
+                active.open_for_append()
+                self.__segments.append(active)
+                self.__firsts.append(active.first_sequence)
+                self.enforce_retention()
+
+            return active.append(payload)
+
+    def read(self, sequence: int) -> bytes:
+        """
+        read the payload of a record
+
+        :param sequence: the sequence number of the record
+        """
+        with self.__lock:
+            if not self.first_sequence <= sequence < self.next_sequence:
+                raise KeyError(f"No record with sequence {sequence}")
+
+            segment = self.__segments[bisect.bisect_right(self.__firsts, sequence) - 1]
+            return segment.read(sequence)
+
+    def enforce_retention(self) -> None:
+        """
+        delete the oldest segments (never the active one) that exceed the retention limits
+        """
+        with self.__lock:
+            now = time.time()
+            while len(self.__segments) > 1:
+                oldest = self.__segments[0]
+                too_big = self.max_bytes is not None and self.size > self.max_bytes
+                too_old = self.max_age is not None and now - os.path.getmtime(oldest.log_path) > self.max_age
+
+                if not (too_big or too_old):
+                    break
+
+                oldest.delete()
+                self.__segments.pop(0)
+                self.__firsts.pop(0)
+
+    def close(self) -> None:
+        with self.__lock:
+            for segment in self.__segments:
+                segment.close()
@@ -0,0 +1,179 @@
+"""
+tracing.py
+Optional per-frame tracing of the server stages and a sampling profiler
+
+Only a fraction (TRACER.rate) of the received frames is traced, every traced frame records when each
+stage ended (receive, decrypt, decode, dispatch, history, broadcast). Without sampling a frame only costs
+one check. The traces are exported in the Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+
+The profiler samples the stacks of all threads (wall-clock) for a fixed time, the result is in the
+"folded" format of flamegraph.pl / speedscope (one line per stack: "a;b;c count").
+
+Author:
+Nilusink
+"""
+from collections import deque, Counter
+from typing import Deque, Dict, Any, List, Tuple
+from random import random
+import threading
+import json
+import time
+import sys
+import os
+
+
+class Trace:
+    __slots__ = ("__tracer", "start", "tid", "label", "marks")
+
+    def __init__(self, tracer: "Tracer", start: int, tid: int, label: str = "") -> None:
+        """
+        the timestamps of one frame, create with Tracer.sample()
+        """
+        self.__tracer = tracer
+        self.start = start
+        self.tid = tid
+        self.label = label
+        self.marks: List[Tuple[str, int]] = []
+
+    def mark(self, stage: str) -> None:
+        """
+        the stage just ended (it started at the end of the previous one)
+        """
+        self.marks.append((stage, time.perf_counter_ns()))
+
+    def finish(self, name: str) -> None:
+        """
+        store the trace
+
+        :param name: what the frame was (request type)
+        """
+        self.__tracer.record(name, self)
+
+
+class Tracer:
+    def __init__(self, rate: float = 0.0, buffer_size: int = 10_000) -> None:
+        """
+        collects sampled frame traces
+
+        :param rate: fraction of the frames to trace (0 disables tracing)
+        :param buffer_size: number of traces kept (the oldest ones are dropped)
+        """
+        self.rate = rate
+        self.__traces: Deque[Tuple[str, Trace]] = deque(maxlen=buffer_size)
+        self.__pid = os.getpid()
+
+    def configure(self, rate: float, buffer_size: int = 10_000) -> None:
+        """
+        change the settings, drops the stored traces (set before clients connect)
+        """
+        self.rate = rate
+        self.__traces = deque(maxlen=buffer_size)
+        self.__pid = os.getpid()
+
+    def sample(self, start: int = 0, tid: int = 0, label: str = "") -> Trace | None:
+        """
+        decide whether to trace a frame
+
+        :param start: perf_counter_ns() when the frame started arriving (now if not given)
+        :param tid: groups the traces (one row per connection in the viewer)
+        :param label: name of the row
+        :return: the trace, None if the frame isn't sampled
+        """
+        if not self.rate or random() >= self.rate:
+            return None
+
+        return Trace(self, start or time.perf_counter_ns(), tid, label)
+
+    def record(self, name: str, trace: Trace) -> None:
+        self.__traces.append((name, trace))
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """
+        the stored traces in the Chrome trace event format (timestamps in us)
+        """
+        events: List[Dict[str, Any]] = []
+
+        # row names come from the stored traces, so they are dropped together with them
+        names: Dict[int, str] = {}
+        for name, trace in list(self.__traces):
+            if not trace.marks:
+                continue
+
+            if trace.label:
+                names[trace.tid] = trace.label
+
+            events.append({
+                "name": name, "cat": "frame", "ph": "X", "pid": self.__pid, "tid": trace.tid,
+                "ts": trace.start / 1000, "dur": (trace.marks[-1][1] - trace.start) / 1000,
+            })
+
+            last = trace.start
+            for stage, end in trace.marks:
+                events.append({
+                    "name": stage, "cat": "stage", "ph": "X", "pid": self.__pid, "tid": trace.tid,
+                    "ts": last / 1000, "dur": (end - last) / 1000,
+                })
+                last = end
+
+        for tid, label in names.items():
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": self.__pid, "tid": tid,
+                "args": {"name": label},
+            })
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str) -> None:
+        """
+        write the stored traces to a file
+        """
+        with open(path, "w") as out:
+            json.dump(self.chrome_trace(), out)
+
+
+TRACER = Tracer()
+
+
+def profile(seconds: float, interval: float = 0.005) -> str:
+    """
+    sample the stacks of all other threads for some time
+
+    :param seconds: how long to profile
+    :param interval: time between two samples
+    :return: the stacks in the folded format, most frequent first
+    """
+    own = threading.get_ident()
+    stacks: Counter = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+
+            stacks[";".join(reversed(stack))] += 1
+
+        time.sleep(interval)
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def profile_to_file(seconds: float, path: str, interval: float = 0.005) -> threading.Thread:
+    """
+    run profile() in the background and write the result to path
+    """
+    def run() -> None:
+        result = profile(seconds, interval)
+        with open(path, "w") as out:
+            out.write(result)
+
+        print(f"profile written to {path}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,154 @@
+"""
+test_client.py
+Processing of the frames a client receives, without a real server
+
+Author:
+Nilusink
+"""
+from core.client import AsyncConnection, _Session
+from core.protocol import BinaryCodec, blob_from_token
+
+from cryptography.fernet import Fernet
+import asyncio
+import struct
+import json
+
+
+SERVER_SECRET = Fernet.generate_key()
+CLIENTS_SECRET = Fernet.generate_key()
+
+
+class FakeSession(_Session):
+    decrypt_workers = 0
+
+    def __init__(self, last_id: int = -1) -> None:
+        super().__init__("test", SERVER_SECRET, CLIENTS_SECRET, last_id)
+        self.key = Fernet.generate_key()
+        self.login(Fernet(SERVER_SECRET).encrypt(BinaryCodec.dumps({"success": True, "key": self.key.decode()})))
+        self.requests: list[dict] = []
+
+    def _send(self, data: bytes) -> None:
+        self.requests.append(self.decrypt(data))
+
+    def _call_later(self, delay: float, func, *args) -> None:
+        func(*args)
+
+    def receive(self, message: dict) -> list[dict]:
+        return self._handle(Fernet(self.key).encrypt(BinaryCodec.dumps(message)))
+
+
+def entry(message_id: int) -> dict:
+    token = Fernet(CLIENTS_SECRET).encrypt(json.dumps(f"text {message_id}").encode("utf-32"))
+    return {"message": blob_from_token(token), "time": "12:00:00", "user": "other", "id": message_id}
+
+
+def page(first: int, last: int, more: bool) -> dict:
+    return {
+        "type": "request_result",
+        "request_type": "get_since",
+        "request_result": [entry(message_id) for message_id in range(first, last)],
+        "more": more
+    }
+
+
+def ids(messages: list[dict]) -> list[int]:
+    return [message["id"] for message in messages]
+
+
+def test_newest_page_right_away():
+    session = FakeSession()
+    session.request_history()
+    assert session.requests[-1]["before"] is None
+
+    # the newest page is delivered at once, the next older one requested
+    assert ids(session.receive(page(900, 1000, True))) == list(range(900, 1000))
+    assert session.requests[-1]["before"] == 900
+
+    # live messages aren't held back while older pages load
+    assert ids(session.receive({"type": "message", **entry(1000)})) == [1000]
+    assert ids(session.receive(page(800, 900, True))) == list(range(800, 900))
+    assert session.last_id == 1000
+
+
+def test_history_limit():
+    session = FakeSession()
+    session.history_page_size = 100
+    session.history_limit = 250
+    session.request_history()
+
+    session.receive(page(900, 1000, True))
+    session.receive(page(800, 900, True))
+    assert session.requests[-1]["limit"] == 50
+
+    session.receive(page(750, 800, True))
+    assert len(session.requests) == 3
+
+
+def test_history_complete():
+    session = FakeSession()
+    session.request_history()
+    assert ids(session.receive(page(0, 10, False))) == list(range(10))
+    assert len(session.requests) == 1
+
+
+def test_ordered_history():
+    session = FakeSession()
+    session.ordered_history = True
+    session.request_history()
+
+    # messages received before the newest page are delivered with it, oldest first
+    assert session.receive({"type": "message", **entry(1000)}) == []
+    assert ids(session.receive(page(900, 1000, True))) == list(range(900, 1001))
+    assert len(session.requests) == 1
+
+    assert ids(session.receive({"type": "message", **entry(1001)})) == [1001]
+
+
+def test_throttled_page_retried():
+    session = FakeSession()
+    session.request_history()
+    session.receive(page(900, 1000, True))
+    session.receive({"type": "throttled", "request_type": "get_since", "retry_after": 0.1})
+    assert session.requests[-1]["before"] == session.requests[-2]["before"] == 900
+
+
+def test_duplicates_dropped():
+    session = FakeSession()
+    session.receive({"type": "message", **entry(5)})
+    assert session.receive({"type": "message", **entry(5)}) == []
+
+
+def test_lazy_text():
+    session = FakeSession()
+    (message,) = session.receive({"type": "message", **entry(5)})
+    assert not message.decrypted
+    assert message["message"] == "text 5"
+
+
+def test_async_end_after_receive_error():
+    class Broken(AsyncConnection):
+        def _handle(self, data: bytes) -> list[dict]:
+            raise OSError("broken")
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        (length,) = struct.unpack(">Q", await reader.readexactly(8))
+        await reader.readexactly(length)
+
+        key = Fernet.generate_key()
+        for frame in (Fernet(SERVER_SECRET).encrypt(BinaryCodec.dumps({"success": True, "key": key.decode()})), b"x"):
+            writer.write(struct.pack(">Q", len(frame)) + frame)
+
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+    async def run() -> None:
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        connection = await Broken("test", SERVER_SECRET, CLIENTS_SECRET).connect(*server.sockets[0].getsockname())
+        assert await connection.get_message(timeout=5) is None
+        await connection.end()
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
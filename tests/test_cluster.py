@@ -0,0 +1,114 @@
+"""
+test_cluster.py
+The bus connecting the server processes, all in one process
+
+Author:
+Nilusink
+"""
+from core.cluster import BusHub, ShardBus
+from core.protocol import BinaryCodec, ProtocolError
+from core import send_long, FrameReader
+
+from contextlib import closing
+import threading
+import socket
+import pytest
+import queue
+import time
+
+
+@pytest.fixture
+def hub(tmp_path):
+    hub = BusHub(str(tmp_path / "bus.sock"))
+    threading.Thread(target=hub.serve, daemon=True).start()
+    yield hub
+    hub.end()
+
+
+class Shard:
+    def __init__(self, hub: BusHub) -> None:
+        self.delivered: queue.Queue = queue.Queue()
+        self.bus = ShardBus(hub.path, lambda entry, message_id: self.delivered.put((entry, message_id)))
+
+    def next(self) -> tuple:
+        """
+        the next delivered message (without the ones sent by subscribed)
+        """
+        while True:
+            delivered = self.delivered.get(timeout=2)
+            if delivered[0]["message"] != b"ready":
+                return delivered
+
+
+def entry(text: str) -> dict:
+    return {"message": text.encode(), "time": "12:00:00", "user": "test"}
+
+
+def subscribed(*shards: Shard) -> None:
+    """
+    wait until the bus sends the messages to every shard
+    """
+    while not all(shard.delivered.qsize() for shard in shards):
+        shards[0].bus.publish(entry("ready"))
+        time.sleep(.02)
+
+
+def test_claims(hub):
+    first, second = Shard(hub), Shard(hub)
+    assert first.bus.claim("alice")
+    assert not second.bus.claim("alice")
+    assert second.bus.is_online("alice")
+
+    # the release isn't answered, a request on the same connection waits for it
+    first.bus.release("alice")
+    assert not first.bus.is_online("alice")
+    assert second.bus.claim("alice")
+
+
+def test_same_order_everywhere(hub):
+    first, second = Shard(hub), Shard(hub)
+    subscribed(first, second)
+
+    for number in range(20):
+        (first if number % 2 else second).bus.publish(entry(str(number)))
+
+    received = [first.next() for _ in range(20)]
+    assert [second.next() for _ in range(20)] == received
+    ids = [message_id for _, message_id in received]
+    assert ids == list(range(ids[0], ids[0] + 20))
+
+
+def test_invalid_entry_not_published(hub):
+    shard = Shard(hub)
+    with pytest.raises(ProtocolError):
+        shard.bus.publish({"message": b"blob", "time": 2 ** 70, "user": "test"})
+
+    # the shard is still connected and its claims kept
+    assert shard.bus.claim("alice")
+    shard.bus.publish(entry("valid"))
+    assert shard.next()[0]["message"] == b"valid"
+    assert shard.bus.is_online("alice")
+
+
+def test_invalid_request_keeps_connection(hub):
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as connection:
+        connection.connect(hub.path)
+        reader = FrameReader(connection)
+        send_long(connection, BinaryCodec.dumps({"op": "claim", "username": "alice"}))
+        assert BinaryCodec.loads(reader.receive()) == {"success": True}
+
+        for request in (b"garbage", BinaryCodec.dumps({"op": "release"}), BinaryCodec.dumps([1, 2])):
+            send_long(connection, request)
+
+        send_long(connection, BinaryCodec.dumps({"op": "online", "username": "alice"}))
+        assert BinaryCodec.loads(reader.receive()) == {"online": True}
+
+
+def test_stats(hub):
+    first, second = Shard(hub), Shard(hub)
+    subscribed(first, second)
+
+    # both shards run in this process, so only one process id
+    stats = hub.stats(timeout=.2)
+    assert len(stats) == 1
+    assert "uptime" in next(iter(stats.values()))
@@ -0,0 +1,90 @@
+"""
+test_compression.py
+Compressing frames and negotiating the compression in the handshake
+
+Author:
+Nilusink
+"""
+from core.compression import ALGORITHMS, MAGIC, NO_COMPRESSION, Compression, compression, negotiate
+from core.protocol import ProtocolError
+import core.server
+import pytest
+import os
+
+
+LEVELS = {"zlib": 6, "lzma": 1}
+DATA = b"a history page, it compresses well " * 100
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_round_trip(algorithm):
+    packed = compression(algorithm, 1).pack(DATA)
+    assert packed[:2] == MAGIC
+    assert len(packed) < len(DATA)
+    assert Compression.unpack(packed, len(DATA)) == DATA
+
+
+def test_small_frames_not_compressed():
+    assert compression("zlib", threshold=1024).pack(b"short") == b"short"
+    assert NO_COMPRESSION.pack(DATA) == DATA
+    assert Compression.unpack(b"short", 100) == b"short"
+
+
+def test_incompressible_sent_as_is():
+    data = os.urandom(2048)
+    assert compression("zlib", threshold=0).pack(data) == data
+
+
+@pytest.mark.parametrize("data", [MAGIC + b"\x09abc", MAGIC, MAGIC + b"\x01garbage"])
+def test_unpack_invalid(data):
+    with pytest.raises(ProtocolError):
+        Compression.unpack(data, 1000)
+
+
+def test_unpack_too_big():
+    with pytest.raises(ProtocolError):
+        Compression.unpack(compression("zlib").pack(DATA), len(DATA) - 1)
+
+
+def test_shared_instances():
+    assert compression("zlib", 6, 1024) is compression("zlib", 6, 1024)
+
+
+def test_negotiate_first_allowed():
+    chosen = negotiate({"algorithms": ["bz2", "lzma", "zlib"], "level": 1}, LEVELS)
+    assert (chosen.algorithm, chosen.level) == ("lzma", 1)
+
+
+def test_negotiate_limits_level():
+    assert negotiate({"algorithms": ["zlib"], "level": 9}, LEVELS).level == 6
+    assert negotiate({"algorithms": ["lzma"], "level": 9}, LEVELS).level == 1
+    assert negotiate({"algorithms": ["zlib"], "level": 2}, LEVELS).level == 2
+    assert negotiate({"algorithms": ["zlib"]}, LEVELS).level == 6
+
+
+def test_negotiate_ignores_client_threshold():
+    chosen = negotiate({"algorithms": ["zlib"], "threshold": 0}, LEVELS, threshold=2048)
+    assert chosen.threshold == 2048
+    assert chosen is negotiate({"algorithms": ["zlib"], "threshold": 1}, LEVELS, threshold=2048)
+
+
+@pytest.mark.parametrize("offer", [
+    None,
+    "zlib",
+    {},
+    {"algorithms": ["bz2"]},  # not allowed
+    {"algorithms": ["unknown"]},
+    {"algorithms": ["zlib"], "level": "high"},
+    {"algorithms": 5},
+])
+def test_negotiate_no_compression(offer):
+    assert negotiate(offer, LEVELS) is NO_COMPRESSION
+
+
+def test_login_compression_defaults():
+    # only zlib by default, bz2 and lzma are opt-in
+    assert core.server.login_compression({"compression": {"algorithms": ["lzma", "bz2"]}}) is NO_COMPRESSION
+
+    chosen = core.server.login_compression({"compression": {"algorithms": ["zlib"], "level": 9, "threshold": 0}})
+    assert (chosen.algorithm, chosen.level, chosen.threshold) == \
+           ("zlib", core.server.COMPRESSION_LEVELS["zlib"], core.server.COMPRESSION_THRESHOLD)
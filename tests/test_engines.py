@@ -0,0 +1,124 @@
+"""
+test_engines.py
+Sessions of every server engine, with real clients
+
+Author:
+Nilusink
+"""
+from core.async_server import AsyncConnection
+from core.selector_server import SelectorConnection
+from core.server import Connection, MESSAGES, RUNNING_CLIENTS
+from core.client import Connection as Client
+import core.async_server
+import core.selector_server
+import core.server
+
+from cryptography.fernet import Fernet
+import socket
+import time
+import pytest
+
+
+SERVER_SECRET = Fernet.generate_key()
+CLIENTS_SECRET = Fernet.generate_key()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+
+        time.sleep(.01)
+
+    return True
+
+
+@pytest.fixture(params=[Connection, AsyncConnection, SelectorConnection], ids=["thread", "asyncio", "selector"])
+def server(request):
+    port = free_port()
+    server = request.param(port, SERVER_SECRET)
+    server.receive_clients(thread=True)
+    yield port
+    server.end()
+    MESSAGES.clear()
+
+
+def connect(port: int, username: str = "test") -> Client:
+    for _ in range(50):
+        try:
+            return Client("127.0.0.1", port, username, SERVER_SECRET, CLIENTS_SECRET)
+
+        except ConnectionRefusedError:
+            # the server isn't listening yet
+            time.sleep(.05)
+
+    raise ConnectionRefusedError
+
+
+@pytest.mark.parametrize("request_", [{"type": "action"}, {"type": "action", "action": None}, [1, 2], "text"])
+def test_malformed_request_ends_session(server, request_):
+    client = connect(server)
+    assert wait_until(lambda: RUNNING_CLIENTS.get("test") is not None)
+
+    client._send(client.encrypt(request_))
+    assert wait_until(lambda: RUNNING_CLIENTS.get("test") is None)
+    client.end()
+
+    # the name can be used again
+    client = connect(server)
+    client.send_message("hello")
+    assert wait_until(lambda: any(message.get("user") == "test" for message in client.new_messages))
+    client.end()
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    for module in (core.server, core.async_server, core.selector_server):
+        monkeypatch.setattr(module, "COALESCE_DELAY", .005)
+        monkeypatch.setattr(module, "COALESCE_BYTES", 4096)
+
+
+def test_coalescing(coalescing, server):
+    sender = connect(server, "sender")
+    receiver = connect(server, "receiver")
+    sent = [f"message {number}" for number in range(30)]
+    for message in sent:
+        sender.send_message(message)
+
+    received = []
+    assert wait_until(lambda: received.extend(
+        message["message"] for message in receiver.new_messages if message["message"] in sent
+    ) or received == sent)
+
+    sender.end()
+    receiver.end()
+
+
+def test_resume(server):
+    client = connect(server, "client")
+    other = connect(server, "other")
+    assert wait_until(lambda: any(message["user"] == "other" for message in client.new_messages))
+    assert client.ticket is not None and not client.resumed
+    list(other.new_messages)
+
+    # the connection drops, messages sent meanwhile are loaded after resuming, without joining again
+    resumed = client.reconnect()
+    other.send_message("missed")
+    assert resumed.resumed
+    assert wait_until(lambda: any(message["message"] == "missed" for message in resumed.new_messages))
+    assert RUNNING_CLIENTS.get("client") is not None
+
+    resumed.send_message("back")
+    seen = []
+    assert wait_until(lambda: seen.extend(message["message"] for message in other.new_messages) or "back" in seen)
+    assert "Joined!" not in seen
+
+    resumed.end()
+    other.end()
@@ -0,0 +1,92 @@
+"""
+test_framing.py
+Receiving frames with FrameReader and sending them with send_frames
+
+Author:
+Nilusink
+"""
+from core import FrameReader, FrameTooLarge, send_frames, send_long, receive_long
+import threading
+import socket
+import struct
+import pytest
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_round_trip(pair):
+    left, right = pair
+    frames = [b"", b"a", b"x" * 100_000, bytes(range(256))]
+    send_frames(left, frames)
+
+    reader = FrameReader(right)
+    assert [reader.receive() for _ in frames] == frames
+
+
+def test_receive_long(pair):
+    left, right = pair
+    send_long(left, b"hello")
+    assert receive_long(right) == b"hello"
+
+
+def test_many_frames(pair):
+    # more buffers than one sendmsg call takes
+    left, right = pair
+    frames = [str(number).encode() for number in range(3000)]
+    sender = threading.Thread(target=send_frames, args=(left, frames))
+    sender.start()
+
+    reader = FrameReader(right)
+    assert [reader.receive() for _ in frames] == frames
+    sender.join()
+
+
+def test_partial_frame_survives_timeout(pair):
+    left, right = pair
+    right.settimeout(.05)
+    reader = FrameReader(right)
+
+    data = struct.pack(">Q", 10) + b"0123456789"
+    left.sendall(data[:4])
+    with pytest.raises(socket.timeout):
+        reader.receive()
+
+    left.sendall(data[4:12])
+    with pytest.raises(socket.timeout):
+        reader.receive()
+
+    left.sendall(data[12:])
+    assert reader.receive() == b"0123456789"
+
+
+def test_view_reuses_buffer(pair):
+    left, right = pair
+    send_frames(left, [b"first", b"other"])
+
+    reader = FrameReader(right)
+    first = reader.receive_view()
+    assert first == b"first"
+    second = reader.receive_view()
+    assert second == b"other"
+    assert first.obj is second.obj
+
+
+def test_frame_too_large(pair):
+    left, right = pair
+    left.sendall(struct.pack(">Q", 1025))
+    with pytest.raises(FrameTooLarge):
+        FrameReader(right, max_frame_size=1024).receive()
+
+
+def test_closed_connection(pair):
+    left, right = pair
+    left.sendall(struct.pack(">Q", 10) + b"abc")
+    left.close()
+    with pytest.raises(ConnectionAbortedError):
+        FrameReader(right).receive()
@@ -0,0 +1,203 @@
+"""
+test_history.py
+Paging through the history in memory and on disk
+
+Author:
+Nilusink
+"""
+from core.history import MessageHistory, entry_size
+from core.storage import SegmentLog
+import pytest
+
+
+def message(number: int) -> dict:
+    return {"type": "message", "user": "test", "message": f"message {number}".encode()}
+
+
+def test_ids_increase():
+    history = MessageHistory(1_000_000)
+    first = history.next_id
+    assert [history.append(message(number)) for number in range(10)] == list(range(first, first + 10))
+    assert [entry["id"] for entry in history.snapshot()] == list(range(first, first + 10))
+    assert history.next_id == first + 10
+
+
+def test_given_ids():
+    history = MessageHistory(1_000_000)
+    assert history.append(message(0), 500) == 500
+    assert history.append(message(1)) == 501
+
+
+def test_oldest_evicted():
+    history = MessageHistory(entry_size(message(0)) * 20)
+    for number in range(100):
+        history.append(message(number))
+
+    assert 0 < len(history) <= 20
+    assert history.evicted == 100 - len(history)
+    assert history.size <= history.max_size
+    assert history.size == sum(entry_size(entry) for entry in history.snapshot())
+    assert [entry["message"] for entry in history.snapshot()] == \
+           [message(number)["message"] for number in range(100 - len(history), 100)]
+
+
+def test_clear():
+    history = MessageHistory(1_000_000)
+    history.append(message(0))
+    history.clear()
+    assert len(history) == 0
+    assert history.size == 0
+    assert history.snapshot() == []
+
+
+def test_attach_loads_newest(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=500)
+    history = MessageHistory(entry_size(message(0)) * 20)
+    history.attach(log)
+    first = history.next_id
+    for number in range(100):
+        assert history.append(message(number)) == first + number
+
+    log.close()
+
+    # after a restart the newest messages that fit are loaded again
+    log = SegmentLog(str(tmp_path), segment_size=500)
+    restarted = MessageHistory(history.max_size)
+    restarted.attach(log)
+    assert restarted.next_id == first + 100
+    assert restarted.snapshot() == history.snapshot()
+    assert restarted.append(message(100)) == first + 100
+    log.close()
+
+
+def walk(history: MessageHistory, since: int = -1, limit: int = 10) -> list[int]:
+    """
+    request pages like a client does, return the ids oldest first
+    """
+    ids: list[int] = []
+    before = None
+    while True:
+        page, more = history.page(since=since, before=before, limit=limit)
+        assert len(page) <= limit
+        ids = [entry["id"] for entry in page] + ids
+        if not more:
+            return ids
+
+        assert page
+        before = page[0]["id"]
+
+
+@pytest.fixture
+def logged(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=500)
+    history = MessageHistory(entry_size(message(0)) * 20)
+    history.attach(log)
+    for number in range(100):
+        history.append(message(number))
+
+    yield history
+    log.close()
+
+
+def ids(history: MessageHistory, start: int, stop: int) -> list[int]:
+    """
+    the ids of the messages start to stop (numbered from 0) in the logged history
+    """
+    first = history.log.first_sequence
+    return list(range(first + start, first + stop))
+
+
+def test_newest_page(logged):
+    page, more = logged.page(limit=10)
+    assert [entry["id"] for entry in page] == ids(logged, 90, 100)
+    assert more
+
+
+def test_page_across_memory_and_log(logged):
+    first_in_memory = logged.snapshot()[0]["id"]
+    assert first_in_memory > logged.log.first_sequence + 10
+
+    page, more = logged.page(before=first_in_memory + 3, limit=10)
+    assert [entry["id"] for entry in page] == list(range(first_in_memory - 7, first_in_memory + 3))
+    assert page[0]["message"] == message(first_in_memory - 7 - logged.log.first_sequence)["message"]
+    assert more
+
+
+def test_walk_all_pages(logged):
+    assert walk(logged) == ids(logged, 0, 100)
+    assert walk(logged, limit=1) == ids(logged, 0, 100)
+    assert walk(logged, limit=1000) == ids(logged, 0, 100)
+
+
+def test_since(logged):
+    assert walk(logged, since=ids(logged, 41, 42)[0]) == ids(logged, 42, 100)
+    assert walk(logged, since=ids(logged, 98, 99)[0]) == ids(logged, 99, 100)
+    assert logged.page(since=ids(logged, 99, 100)[0]) == ([], False)
+
+
+def test_last_page(logged):
+    page, more = logged.page(before=ids(logged, 5, 6)[0], limit=5)
+    assert [entry["id"] for entry in page] == ids(logged, 0, 5)
+    assert not more
+
+    assert logged.page(before=logged.log.first_sequence) == ([], False)
+
+
+def test_pages_without_log():
+    history = MessageHistory(entry_size(message(0)) * 20)
+    first = history.next_id
+    for number in range(100):
+        history.append(message(number))
+
+    # evicted messages are gone
+    assert walk(history) == list(range(first + 100 - len(history), first + 100))
+    assert not history.page(limit=len(history))[1]
+
+
+def test_new_log_continues_ids(tmp_path):
+    history = MessageHistory(1_000_000)
+    seen = history.append(message(0))
+
+    log = SegmentLog(str(tmp_path))
+    history.attach(log)
+    assert history.append(message(1)) > seen
+    log.close()
+
+    log = SegmentLog(str(tmp_path))
+    restarted = MessageHistory(1_000_000)
+    restarted.attach(log)
+    assert restarted.snapshot()[0]["id"] == log.first_sequence == seen + 1
+    assert restarted.next_id == seen + 2
+    log.close()
+
+
+def test_failed_write_uses_no_id(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    history = MessageHistory(1_000_000)
+    history.attach(log)
+    first = history.append(message(0))
+
+    # can't be encoded
+    with pytest.raises(ValueError):
+        history.append({"message": b"blob", "time": 2 ** 70})
+
+    # the write fails
+    def full(_payload: bytes) -> int:
+        raise OSError("No space left on device")
+
+    log.append = full
+    with pytest.raises(OSError):
+        history.append(message(1))
+
+    del log.append
+    assert history.append(message(2)) == first + 1
+    assert [entry["id"] for entry in history.snapshot()] == [first, first + 1]
+    log.close()
+
+    # after a restart the ids continue without reusing one
+    log = SegmentLog(str(tmp_path))
+    restarted = MessageHistory(1_000_000)
+    restarted.attach(log)
+    assert [entry["id"] for entry in restarted.snapshot()] == [first, first + 1]
+    assert restarted.append(message(3)) == first + 2
+    log.close()
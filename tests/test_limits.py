@@ -0,0 +1,145 @@
+"""
+test_limits.py
+Token buckets, the rate limits of the server requests and the session limit
+
+Author:
+Nilusink
+"""
+from core.server import USER_MESSAGE_BURST, USER_REQUEST_BURST, RUNNING_CLIENTS, Connection, UserLimits, admit
+from core import TokenBucket
+import core.server
+import pytest
+import time
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeUser:
+    def __init__(self, username: str = "test") -> None:
+        self.username = username
+        self.limits = UserLimits()
+        self.sent: list[dict] = []
+
+    def send(self, message: dict) -> None:
+        self.sent.append(message)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_burst(clock):
+    bucket = TokenBucket(2, 3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == pytest.approx(.5)
+
+
+def test_refill(clock):
+    bucket = TokenBucket(2, 3)
+    for _ in range(3):
+        bucket.take()
+
+    clock.now += .25
+    assert bucket.take() == pytest.approx(.25)
+
+    clock.now += .25
+    assert bucket.take() == 0
+
+    # never more than burst tokens
+    clock.now += 100
+    assert [bucket.take() for _ in range(4)] == [0, 0, 0, pytest.approx(.5)]
+
+
+def test_wait_keeps_token(clock):
+    bucket = TokenBucket(1, 1)
+    assert bucket.wait() == 0
+    assert bucket.wait() == 0
+    assert bucket.take() == 0
+    assert bucket.wait() == pytest.approx(1)
+
+
+def test_no_limit(clock):
+    bucket = TokenBucket(0, 1)
+    assert all(bucket.take() == 0 for _ in range(100))
+    assert bucket.wait() == 0
+
+
+def test_user_message_limit(clock):
+    user = FakeUser()
+    assert all(admit(user, "message") for _ in range(USER_MESSAGE_BURST))
+    assert not admit(user, "message")
+    assert user.sent[-1]["type"] == "throttled"
+    assert user.sent[-1]["request_type"] == "message"
+
+
+def test_throttle_notice_once(clock):
+    user = FakeUser()
+    for _ in range(USER_REQUEST_BURST + 10):
+        admit(user, "stats")
+
+    # a flood is only answered once per retry_after
+    (notice,) = user.sent
+    assert notice["retry_after"] > 0
+
+    clock.now += notice["retry_after"]
+    assert admit(user, "stats")
+    assert not admit(user, "stats")
+    assert len(user.sent) == 2
+
+
+def test_end_never_limited(clock):
+    user = FakeUser()
+    for _ in range(USER_REQUEST_BURST):
+        admit(user, "stats")
+
+    assert admit(user, "end")
+    assert admit(user, "pong")
+
+
+def test_global_limit_keeps_user_tokens(clock, monkeypatch):
+    monkeypatch.setattr(core.server, "GLOBAL_MESSAGES", TokenBucket(1, 1))
+    user = FakeUser()
+    assert admit(user, "message")
+    assert not admit(user, "message")
+    assert user.sent[-1]["retry_after"] == pytest.approx(1)
+
+    # the messages dropped by the global limit didn't use the users tokens
+    monkeypatch.setattr(core.server, "GLOBAL_MESSAGES", TokenBucket(0, 0))
+    assert sum(admit(user, "message") for _ in range(USER_MESSAGE_BURST)) == USER_MESSAGE_BURST - 1
+
+
+@pytest.fixture
+def online():
+    users = [FakeUser(f"user {number}") for number in range(3)]
+    for user in users:
+        assert RUNNING_CLIENTS.append(user)
+
+    yield users
+    for user in users:
+        RUNNING_CLIENTS.remove(user)
+
+
+def test_server_full(online, monkeypatch):
+    request = {"username": "test", "version": "2.0.0"}
+    monkeypatch.setattr(core.server, "MAX_SESSIONS", 3)
+    assert Connection.login_error(request) == "ServerFull"
+
+    monkeypatch.setattr(core.server, "MAX_SESSIONS", 4)
+    assert Connection.login_error(request) is None
+
+    monkeypatch.setattr(core.server, "MAX_SESSIONS", 0)
+    assert Connection.login_error(request) is None
+
+
+def test_login_errors(online):
+    assert Connection.login_error({"username": "test", "version": "0.1.0"}) == "InvalidVersion"
+    assert Connection.login_error({"username": "user 1", "version": "2.0.0"}) == "UserOnline"
@@ -0,0 +1,96 @@
+"""
+test_protocol.py
+Round trips and malformed frames of the frame encodings
+
+Author:
+Nilusink
+"""
+from core.protocol import BinaryCodec, JsonCodec, ProtocolError, MAGIC, detect, blob_from_token, token_from_blob
+from cryptography.fernet import Fernet
+import pytest
+
+
+VALUES = [
+    None, True, False, 0, -1, 2 ** 63 - 1, -2 ** 63, 1.5, float("-inf"),
+    "", "text", "äöü 🔒", b"", b"\x00\xff" * 100,
+    [], [1, "a", None, [2, [3]]],
+    {}, {"type": "message", "id": 7, "message": b"blob", "nested": {"list": [True, 1.0]}},
+]
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_binary_round_trip(value):
+    data = BinaryCodec.dumps(value)
+    assert data[:2] == MAGIC
+    assert BinaryCodec.loads(data) == value
+
+
+def test_binary_tuple_decodes_as_list():
+    assert BinaryCodec.loads(BinaryCodec.dumps((1, 2))) == [1, 2]
+
+
+def test_binary_loads_memoryview():
+    data = BinaryCodec.dumps({"a": "b"})
+    assert BinaryCodec.loads(memoryview(data)) == {"a": "b"}
+
+
+def test_binary_unsupported_type():
+    with pytest.raises(TypeError):
+        BinaryCodec.dumps({"a": object()})
+
+
+@pytest.mark.parametrize("value", [2 ** 63, -2 ** 63 - 1, 2 ** 70])
+def test_binary_int_out_of_range(value):
+    with pytest.raises(ProtocolError):
+        BinaryCodec.dumps({"time": value})
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"SM",
+    b"XX\x02\x00N",  # wrong magic
+    b"SM\x03\x00N",  # wrong version
+    b"SM\x02\x00Z",  # invalid tag
+    b"SM\x02\x00s\x00\x00\x00\x05abc",  # string longer than the frame
+    b"SM\x02\x00l\x00\x00\x00\x02N",  # list with a missing item
+    b"SM\x02\x00s\x00\x00\x00\x02\xff\xfe",  # invalid UTF-8
+    b"SM\x02\x00NN",  # trailing data
+])
+def test_binary_malformed(data):
+    with pytest.raises(ProtocolError):
+        BinaryCodec.loads(data)
+
+
+def test_binary_deep_nesting():
+    # about 5 bytes per level, a small frame can exceed the recursion limit
+    data = MAGIC + b"\x02\x00" + b"l\x00\x00\x00\x01" * 10_000 + b"N"
+    with pytest.raises(ProtocolError):
+        BinaryCodec.loads(data)
+
+
+@pytest.mark.parametrize("value", [None, 1, "text", [1, 2], {"a": {"b": None}}])
+def test_json_round_trip(value):
+    assert JsonCodec.loads(JsonCodec.dumps(value)) == value
+
+
+def test_json_sends_blobs_as_tokens():
+    token = Fernet(Fernet.generate_key()).encrypt(b"secret")
+    data = JsonCodec.dumps({"message": blob_from_token(token)})
+    assert JsonCodec.loads(data) == {"message": token.decode()}
+
+
+@pytest.mark.parametrize("data", [b"xx", "{".encode("utf-32"), ("[" * 100_000).encode("utf-32")])
+def test_json_malformed(data):
+    with pytest.raises(ProtocolError):
+        JsonCodec.loads(data)
+
+
+def test_token_blob_round_trip():
+    token = Fernet(Fernet.generate_key()).encrypt(b"secret")
+    assert token_from_blob(blob_from_token(token)) == token
+    assert len(blob_from_token(token)) < len(token)
+
+
+def test_detect():
+    assert detect(BinaryCodec.dumps({})) is BinaryCodec
+    assert detect(JsonCodec.dumps({})) is JsonCodec
@@ -0,0 +1,173 @@
+"""
+test_server.py
+Request processing, logins and the outbound queues shared by every server engine
+
+Author:
+Nilusink
+"""
+from core.server import MESSAGES, USER_HISTORY_BURST, USER_REQUEST_BURST, OutboundQueue, UserLimits, process_request
+from core.server import read_login
+from core.protocol import BinaryCodec, JsonCodec, ProtocolError, token_from_blob
+
+from cryptography.fernet import Fernet
+import threading
+import pytest
+
+
+class FakeUser:
+    def __init__(self, username: str = "test") -> None:
+        self.username = username
+        self.limits = UserLimits()
+        self.sent: list[dict] = []
+        self.ended = False
+
+    def send(self, message: dict) -> None:
+        self.sent.append(message)
+
+    def end(self, wait: bool = True) -> None:
+        self.ended = True
+
+
+@pytest.fixture(autouse=True)
+def empty_history():
+    MESSAGES.clear()
+    yield
+    MESSAGES.clear()
+
+
+def test_message_stored():
+    process_request(FakeUser(), {"type": "message", "message": b"blob", "time": "12:00:00"})
+    (entry,) = MESSAGES.snapshot()
+    assert (entry["message"], entry["time"], entry["user"]) == (b"blob", "12:00:00", "test")
+
+    # every stored entry can be sent to version 2 clients
+    BinaryCodec.dumps(MESSAGES.snapshot())
+
+
+def test_version_1_token():
+    process_request(FakeUser(), {"type": "message", "message": token_from_blob(b"blob").decode(), "time": "12:00:00"})
+    assert MESSAGES.snapshot()[0]["message"] == b"blob"
+
+
+@pytest.mark.parametrize("message", [
+    {"type": "message", "message": b"blob", "time": 2 ** 70},
+    {"type": "message", "message": b"blob", "time": None},
+    {"type": "message", "message": b"blob", "time": "x" * 1000},
+    {"type": "message", "message": b"blob"},
+    {"type": "message", "message": 5, "time": "12:00:00"},
+    {"type": "message", "message": "not a token!", "time": "12:00:00"},
+])
+def test_invalid_message_dropped(message):
+    next_id = MESSAGES.next_id
+    process_request(FakeUser(), message)
+    assert len(MESSAGES) == 0
+    assert MESSAGES.next_id == next_id
+
+
+@pytest.mark.parametrize("request_", [
+    None,
+    [1, 2],
+    {},
+    {"type": "action"},
+    {"type": "action", "action": 5},
+    {"type": "unknown"},
+])
+def test_malformed_request(request_):
+    assert process_request(FakeUser(), request_) is False
+
+
+def test_unknown_action_ignored():
+    user = FakeUser()
+    assert process_request(user, {"type": "action", "action": "unknown"}) is True
+    assert user.sent == []
+
+
+def test_read_login():
+    fer = Fernet(Fernet.generate_key())
+    for codec in (BinaryCodec, JsonCodec):
+        request = {"username": "test", "version": "2.0.0"}
+        assert read_login(fer, fer.encrypt(codec.dumps(request))) == (codec, request, None)
+
+
+@pytest.mark.parametrize("request_", [
+    None,
+    [1, 2],
+    {"username": "test"},
+    {"username": 5, "version": "2.0.0"},
+    {"username": "test", "version": ["2.0.0"]},
+])
+def test_read_login_invalid(request_):
+    fer = Fernet(Fernet.generate_key())
+    with pytest.raises(ProtocolError):
+        read_login(fer, fer.encrypt(BinaryCodec.dumps(request_)))
+
+
+def test_history_pages_own_budget():
+    user = FakeUser()
+    for _ in range(USER_REQUEST_BURST):
+        process_request(user, {"type": "action", "action": "stats"})
+
+    process_request(user, {"type": "action", "action": "stats"})
+    assert user.sent[-1]["type"] == "throttled"
+
+    # loading the history isn't limited by the other requests
+    user.sent.clear()
+    for _ in range(USER_HISTORY_BURST):
+        process_request(user, {"type": "action", "action": "get_since", "since": -1})
+
+    assert [response["request_type"] for response in user.sent] == ["get_since"] * USER_HISTORY_BURST
+    assert all(response["type"] == "request_result" for response in user.sent)
+
+
+def test_queue_drop_oldest():
+    queue = OutboundQueue(3, "drop_oldest")
+    for frame in (b"1", b"2", b"3", b"4"):
+        assert queue.put(frame)
+
+    assert queue.dropped == 1
+    assert [queue.pop() for _ in range(4)] == [b"2", b"3", b"4", None]
+
+
+def test_queue_disconnect():
+    queue = OutboundQueue(2, "disconnect")
+    assert queue.put(b"1") and queue.put(b"2")
+    assert not queue.put(b"3")
+    assert queue.depth == 2
+
+
+def test_queue_block():
+    queue = OutboundQueue(1, "block", timeout=1)
+    queue.put(b"1")
+    threading.Timer(.05, queue.pop).start()
+    assert queue.put(b"2")
+    assert queue.pop() == b"2"
+
+    # nobody makes room in time
+    queue = OutboundQueue(1, "block", timeout=.05)
+    queue.put(b"1")
+    assert not queue.put(b"2")
+
+
+def test_queue_close():
+    queue = OutboundQueue(1, "block", timeout=5)
+    queue.put(b"1")
+    threading.Timer(.05, queue.close).start()
+    assert not queue.put(b"2")
+    assert queue.get() is None
+    assert not queue.put(b"3")
+
+
+def test_queue_batch():
+    queue = OutboundQueue(10)
+    for frame in (b"aa", b"bb", b"cc"):
+        queue.put(frame)
+
+    assert queue.get() == b"aa"
+    assert queue.get_batch(max_bytes=3, timeout=0) == [b"bb", b"cc"]
+    assert queue.get_batch(max_bytes=3, timeout=.01) == []
+    assert queue.high_water == 3
+
+
+def test_queue_invalid_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(1, "wait")
@@ -0,0 +1,184 @@
+"""
+test_storage.py
+Appending, reopening, crash recovery and retention of the segment log
+
+Author:
+Nilusink
+"""
+from core.storage import SegmentLog, RECORD_HEADER
+import pytest
+import time
+import os
+
+
+def payload(sequence: int) -> bytes:
+    return f"record {sequence}".encode() * 3
+
+
+def fill(log: SegmentLog, count: int) -> None:
+    for _ in range(count):
+        sequence = log.next_sequence
+        assert log.append(payload(sequence)) == sequence
+
+
+def files(directory, suffix: str) -> list[str]:
+    return sorted(name for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def test_append_and_read(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    assert (log.first_sequence, log.next_sequence) == (0, 0)
+
+    fill(log, 100)
+    assert [log.read(sequence) for sequence in range(100)] == [payload(sequence) for sequence in range(100)]
+    log.close()
+
+
+def test_read_missing(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    fill(log, 3)
+    for sequence in (-1, 3, 100):
+        with pytest.raises(KeyError):
+            log.read(sequence)
+
+    log.close()
+
+
+def test_segments_roll_over(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=200)
+    fill(log, 50)
+    assert len(files(tmp_path, ".log")) > 1
+    assert [log.read(sequence) for sequence in range(50)] == [payload(sequence) for sequence in range(50)]
+    log.close()
+
+
+def test_reopen(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=200)
+    fill(log, 30)
+    log.close()
+
+    log = SegmentLog(str(tmp_path), segment_size=200)
+    assert (log.first_sequence, log.next_sequence) == (0, 30)
+    fill(log, 10)
+    assert [log.read(sequence) for sequence in range(40)] == [payload(sequence) for sequence in range(40)]
+    log.close()
+
+
+def test_truncated_record_is_dropped(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    fill(log, 10)
+    log.close()
+
+    # crash in the middle of writing the last record
+    log_path = os.path.join(tmp_path, files(tmp_path, ".log")[-1])
+    size = os.path.getsize(log_path)
+    os.truncate(log_path, size - 5)
+
+    log = SegmentLog(str(tmp_path))
+    assert log.next_sequence == 9
+    assert os.path.getsize(log_path) == size - RECORD_HEADER.size - len(payload(9))
+    assert [log.read(sequence) for sequence in range(9)] == [payload(sequence) for sequence in range(9)]
+
+    # the next record takes the place of the lost one
+    assert log.append(b"new") == 9
+    assert log.read(9) == b"new"
+    log.close()
+
+
+def test_truncated_header_is_dropped(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    fill(log, 5)
+    log.close()
+
+    log_path = os.path.join(tmp_path, files(tmp_path, ".log")[-1])
+    with open(log_path, "ab") as file:
+        file.write(RECORD_HEADER.pack(5, 100)[:7])
+
+    log = SegmentLog(str(tmp_path))
+    assert log.next_sequence == 5
+    assert log.read(4) == payload(4)
+    log.close()
+
+
+def test_index_rebuilt(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    fill(log, 20)
+    log.close()
+
+    # the index is behind the log (crash after writing the record)
+    index_path = os.path.join(tmp_path, files(tmp_path, ".idx")[-1])
+    os.truncate(index_path, os.path.getsize(index_path) - 8 - 3)
+
+    log = SegmentLog(str(tmp_path))
+    assert log.next_sequence == 20
+    assert os.path.getsize(index_path) == 20 * 8
+    assert [log.read(sequence) for sequence in range(20)] == [payload(sequence) for sequence in range(20)]
+    log.close()
+
+
+def test_index_missing(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    fill(log, 7)
+    log.close()
+
+    os.remove(os.path.join(tmp_path, files(tmp_path, ".idx")[-1]))
+    log = SegmentLog(str(tmp_path))
+    assert log.next_sequence == 7
+    assert log.read(6) == payload(6)
+    log.close()
+
+
+def test_retention_by_size(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=200, max_bytes=600)
+    fill(log, 100)
+    assert log.size <= 600 + 200 + RECORD_HEADER.size + len(payload(99))
+    assert log.first_sequence > 0
+    assert log.next_sequence == 100
+
+    # deleted records are gone, the rest is still readable
+    with pytest.raises(KeyError):
+        log.read(log.first_sequence - 1)
+
+    assert [log.read(sequence) for sequence in range(log.first_sequence, 100)] == \
+           [payload(sequence) for sequence in range(log.first_sequence, 100)]
+    log.close()
+
+
+def test_retention_keeps_active_segment(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=10_000, max_bytes=10)
+    fill(log, 20)
+    assert (log.first_sequence, log.next_sequence) == (0, 20)
+    assert len(files(tmp_path, ".log")) == 1
+    log.close()
+
+
+def test_retention_by_age(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=200)
+    fill(log, 30)
+    log.close()
+
+    # make every segment but the newest one old
+    old = time.time() - 3600
+    for name in files(tmp_path, ".log")[:-1]:
+        os.utime(os.path.join(tmp_path, name), (old, old))
+
+    log = SegmentLog(str(tmp_path), segment_size=200, max_age=60)
+    assert len(files(tmp_path, ".log")) == 1
+    assert log.next_sequence == 30
+    assert log.read(29) == payload(29)
+    log.close()
+
+
+def test_start_at(tmp_path):
+    log = SegmentLog(str(tmp_path))
+    log.start_at(1000)
+    assert log.append(b"first") == 1000
+    with pytest.raises(ValueError):
+        log.start_at(5000)
+
+    log.close()
+
+    log = SegmentLog(str(tmp_path))
+    assert (log.first_sequence, log.next_sequence) == (1000, 1001)
+    assert log.read(1000) == b"first"
+    log.close()
@@ -0,0 +1,89 @@
+"""
+test_tickets.py
+Issuing and redeeming session tickets, resuming a session on login
+
+Author:
+Nilusink
+"""
+from core.server import RUNNING_CLIENTS, Connection, SessionTickets, replace_session
+from cryptography.fernet import Fernet
+import core.server
+import pytest
+import time
+
+
+class FakeUser:
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.ended = False
+
+    def end(self, wait: bool = True) -> None:
+        self.ended = True
+        RUNNING_CLIENTS.remove(self)
+
+
+@pytest.fixture
+def tickets():
+    return SessionTickets()
+
+
+def login(ticket: str | None, username: str = "test") -> dict:
+    return {"username": username, "version": "2.0.0", "ticket": ticket}
+
+
+def test_redeem(tickets):
+    key = Fernet.generate_key()
+    assert tickets.redeem(login(tickets.issue("test", key))) == key
+
+
+def test_other_user(tickets):
+    ticket = tickets.issue("test", Fernet.generate_key())
+    assert tickets.redeem(login(ticket, "other")) is None
+
+
+def test_other_server(tickets):
+    # tickets are only valid for the server (process group) that issued them
+    ticket = SessionTickets().issue("test", Fernet.generate_key())
+    assert tickets.redeem(login(ticket)) is None
+
+
+@pytest.mark.parametrize("ticket", [None, 5, "", "garbage", Fernet(Fernet.generate_key()).encrypt(b"x").decode()])
+def test_invalid(tickets, ticket):
+    assert tickets.redeem(login(ticket)) is None
+
+
+def test_expired(tickets, monkeypatch):
+    ticket = tickets.issue("test", Fernet.generate_key())
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + core.server.TICKET_LIFETIME + 120)
+    assert tickets.redeem(login(ticket)) is None
+
+
+def test_disabled(tickets, monkeypatch):
+    key = Fernet.generate_key()
+    ticket = tickets.issue("test", key)
+    monkeypatch.setattr(core.server, "TICKET_LIFETIME", 0)
+    assert tickets.issue("test", key) is None
+    assert tickets.redeem(login(ticket)) is None
+
+
+@pytest.fixture
+def online():
+    user = FakeUser("test")
+    assert RUNNING_CLIENTS.append(user)
+    yield user
+    RUNNING_CLIENTS.remove(user)
+
+
+def test_resume_replaces_session(online, monkeypatch):
+    # the old connection dropped without the server noticing yet
+    assert Connection.login_error(login(None)) == "UserOnline"
+    assert Connection.login_error(login(None), resuming=True) is None
+
+    # the replaced session doesn't count against the session limit
+    monkeypatch.setattr(core.server, "MAX_SESSIONS", 1)
+    assert Connection.login_error(login(None), resuming=True) is None
+
+    replace_session("test")
+    assert online.ended
+    assert RUNNING_CLIENTS.get("test") is None